@@ -0,0 +1,316 @@
+import time
+import random
+import asyncio
+import threading
+
+import httpx
+from openai import APIError, APIConnectionError, RateLimitError, InternalServerError, AsyncStream, Stream
+
+from utils.metrics import metrics
+from utils.rate_limit import TokenBucket
+
+
+
+# Errors worth retrying as they're likely gone after a while.
+RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+# Errors raised while reading a stream, once the API accepted the
+# request they're its fault.
+STREAM_ERRORS = (APIError, httpx.TransportError)
+
+
+class GovernorError(APIError):
+	"""Raised when a request is rejected before reaching the API."""
+
+	def __init__(self, message):
+		super().__init__(message, None, body=None)
+
+
+class CircuitBreaker:
+	"""
+	Thread-safe circuit breaker. It opens after a number of failures
+	in a row, rejecting the requests for a while, then lets one request
+	through and closes if it succeeds.
+
+	Args:
+		failures:		Failures in a row that open the breaker.
+		cooldown_s:		Seconds the breaker stays open for.
+	"""
+
+	def __init__(self, failures, cooldown_s):
+		self.failures = failures
+		self.cooldown_s = cooldown_s
+		self._lock = threading.Lock()
+		self._failure_count = 0
+		self._opened_at = None
+		self._trying = False
+
+
+	def allow(self):
+		"""Return True if a request may be sent."""
+		with self._lock:
+			if self._opened_at is None:
+				return True
+			if self._trying or time.monotonic() - self._opened_at < self.cooldown_s:
+				return False
+			# Half-open, try a request.
+			self._trying = True
+			return True
+
+
+	def on_success(self):
+		with self._lock:
+			self._failure_count = 0
+			self._opened_at = None
+			self._trying = False
+
+
+	def on_failure(self):
+		with self._lock:
+			self._failure_count += 1
+			if self._trying or self._failure_count >= self.failures:
+				if self._opened_at is None or self._trying:
+					metrics.inc('governor.breaker_opened')
+				self._opened_at = time.monotonic()
+			self._trying = False
+
+
+	def release(self):
+		"""Give up a request that got no answer from the API, e.g.
+		cancelled, letting another one try if it was the trial."""
+		with self._lock:
+			self._trying = False
+
+
+class GovernedStream:
+	"""
+	Stream of a reply which reports the errors raised while it's read
+	to the circuit breaker.
+
+	Args:
+		stream:			openai.Stream or openai.AsyncStream.
+		breaker:		Circuit breaker of the model.
+	"""
+
+	def __init__(self, stream, breaker):
+		self.stream = stream
+		self.breaker = breaker
+
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+
+	def __iter__(self):
+		try:
+			yield from self.stream
+		except STREAM_ERRORS:
+			self.breaker.on_failure()
+			raise
+
+
+	async def __aiter__(self):
+		try:
+			async for chunk in self.stream:
+				yield chunk
+		except STREAM_ERRORS:
+			self.breaker.on_failure()
+			raise
+
+
+class ModelGovernor:
+	"""Request and token budgets, and circuit breaker, of a model."""
+
+	def __init__(self, limits, breaker, share=1):
+		self.limits = limits
+		self.share = share
+		rpm = limits['rpm'] * share
+		self.requests = TokenBucket(rpm / 60, max(1, rpm))
+		self.tokens = None
+		if tpm := limits.get('tpm'):
+			self.tokens = TokenBucket(tpm * share / 60, tpm * share)
+		self.breaker = breaker
+
+
+class Governor:
+	"""
+	Admission control of the requests to an AI API. It keeps the
+	requests and tokens per minute of each model within limits, queuing
+	the requests until there's budget for them or rejecting them if
+	they would wait too long, retries the transient errors with jittered
+	exponential backoff, and fails fast while a model keeps failing.
+
+	Options are read from the 'governor' section of the AI options.
+
+	Args:
+		options:		AI options configuration manager.
+	"""
+
+	def __init__(self, options):
+		self.options = options
+		# Share of the limits this process may use, e.g. when several
+		# processes call the API with the same key.
+		self.share = 1
+		self._lock = threading.Lock()
+		self._models = {}
+
+
+	def get_model_governor(self, model):
+		"""Return the governor of a model, created again if its limits
+		changed."""
+		limits = self.options.get('governor.limits')
+		limits = limits.get(model, limits['default'])
+		with self._lock:
+			governor = self._models.get(model)
+			if governor is None or governor.limits != limits or governor.share != self.share:
+				breaker = governor.breaker if governor else CircuitBreaker(
+					self.options.get('governor.breaker_failures'),
+					self.options.get('governor.breaker_cooldown_s')
+				)
+				governor = self._models[model] = ModelGovernor(limits, breaker, self.share)
+			return governor
+
+
+	def _reserve(self, governor, tokens):
+		"""Take the budget of a request and return 0, or return the
+		seconds to wait for it."""
+		if governor.tokens:
+			# A request can't take more than the whole budget.
+			tokens = min(tokens, governor.tokens.capacity)
+		with self._lock:
+			wait = governor.requests.get_wait_time()
+			if governor.tokens:
+				wait = max(wait, governor.tokens.get_wait_time(tokens))
+			if wait > 0 or not governor.requests.try_acquire():
+				return wait
+			if governor.tokens:
+				governor.tokens.consume(tokens)
+			return 0
+
+
+	def _check_wait(self, model, wait, waited):
+		if waited + wait > self.options.get('governor.max_wait_s'):
+			metrics.inc('governor.rejected')
+			raise GovernorError(f'Too many requests to {model}, try again later')
+
+
+	def _admit(self, model, governor):
+		if not governor.breaker.allow():
+			metrics.inc('governor.fast_failures')
+			raise GovernorError(f'{model} is failing, try again later')
+
+
+	def _get_backoff(self, exc, attempt):
+		"""Return the seconds to wait for before retrying."""
+		backoff = min(
+			self.options.get('governor.max_backoff_s'),
+			self.options.get('governor.backoff_s') * 2**attempt
+		)
+		# Full jitter spreads the retries of concurrent requests.
+		backoff = random.uniform(0, backoff)
+		if isinstance(exc, RateLimitError):
+			retry_after = exc.response.headers.get('retry-after')
+			try:
+				backoff = max(backoff, float(retry_after))
+			except (TypeError, ValueError):
+				pass
+		return backoff
+
+
+	def _on_result(self, governor, resp, tokens):
+		"""Account for a reply and return it."""
+		governor.breaker.on_success()
+		if isinstance(resp, (Stream, AsyncStream)):
+			# Its errors are raised once the caller reads it.
+			return GovernedStream(resp, governor.breaker)
+		usage = getattr(resp, 'usage', None)
+		if usage and governor.tokens and (total_tokens := getattr(usage, 'total_tokens', None)):
+			# Account for the tokens used instead of the estimate.
+			governor.tokens.consume(total_tokens - min(tokens, governor.tokens.capacity))
+			metrics.inc('governor.tokens', total_tokens)
+		return resp
+
+
+	def _should_retry(self, governor, exc, tokens, attempt):
+		if governor.tokens:
+			# Failed requests don't use their tokens.
+			governor.tokens.consume(-min(tokens, governor.tokens.capacity))
+
+		if not isinstance(exc, RETRYABLE_ERRORS):
+			# The request is at fault, the API works.
+			governor.breaker.on_success()
+			return False
+
+		governor.breaker.on_failure()
+		if attempt == self.options.get('governor.retries'):
+			return False
+		metrics.inc('governor.retries')
+		return True
+
+
+	def call(self, model, tokens, fn, /, *args, **kwargs):
+		"""
+		Call an API function once the model's budget allows it.
+
+		Args:
+			model:			Model the request is sent to.
+			tokens:			Estimated tokens the request takes.
+			fn:				API function.
+			args:			Positional arguments to call it with.
+			kwargs:			Keyword arguments to call it with, which
+							may include a 'model'.
+		"""
+
+		governor = self.get_model_governor(model)
+		attempt = 0
+		while True:
+			start = time.monotonic()
+			while wait := self._reserve(governor, tokens):
+				self._check_wait(model, wait, time.monotonic() - start)
+				time.sleep(wait)
+			metrics.observe('governor.wait_s', time.monotonic() - start)
+			self._admit(model, governor)
+
+			try:
+				resp = fn(*args, **kwargs)
+			except APIError as e:
+				if not self._should_retry(governor, e, tokens, attempt):
+					raise
+				time.sleep(self._get_backoff(e, attempt))
+				attempt += 1
+				continue
+			except BaseException:
+				# No answer from the API, e.g. cancelled.
+				governor.breaker.release()
+				raise
+
+			return self._on_result(governor, resp, tokens)
+
+
+	async def acall(self, model, tokens, fn, /, *args, **kwargs):
+		"""Async counterpart of call(), calls a coroutine function."""
+
+		governor = self.get_model_governor(model)
+		attempt = 0
+		while True:
+			start = time.monotonic()
+			while wait := self._reserve(governor, tokens):
+				self._check_wait(model, wait, time.monotonic() - start)
+				await asyncio.sleep(wait)
+			metrics.observe('governor.wait_s', time.monotonic() - start)
+			self._admit(model, governor)
+
+			try:
+				resp = await fn(*args, **kwargs)
+			except APIError as e:
+				if not self._should_retry(governor, e, tokens, attempt):
+					raise
+				await asyncio.sleep(self._get_backoff(e, attempt))
+				attempt += 1
+				continue
+			except BaseException:
+				# No answer from the API, e.g. cancelled.
+				governor.breaker.release()
+				raise
+
+			return self._on_result(governor, resp, tokens)
\ No newline at end of file
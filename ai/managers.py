@@ -1,9 +1,12 @@
 from abc import ABC, abstractmethod
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 
+from ai.governor import Governor
 from ai.schemas import Translation
+from ai.tokens import count_msg_tokens
 from file_managers.config import ConfigurationManager
+from utils.http import aprewarm, create_openai_http_client, prewarm
 
 
 
@@ -14,6 +17,7 @@ class AIManager(ABC):
 
 	def __init__(self, options_path):
 		self.options = ConfigurationManager(options_path)
+		self.governor = Governor(self.options)
 	
 
 	def check_for_visual_content(self, messages):
@@ -37,6 +41,32 @@ class AIManager(ABC):
 		max_tokens = self.options.get('vision.max_tokens') if has_visual_ctx else self.options.get('chat.max_tokens')
 		
 		return model, max_tokens
+
+
+	def get_context_max_tokens(self, model):
+		"""Return the token budget for the context passed to a model."""
+		max_tokens = self.options.get('context.max_tokens')
+		return max_tokens.get(model, max_tokens['default'])
+	
+
+	def estimate_chat_tokens(self, messages, options):
+		"""Estimate the tokens a chat request takes, which are the
+		tokens of the messages plus the max tokens of the reply."""
+		max_tokens = options.get('max_tokens') or options.get('max_completion_tokens') or 0
+		return max_tokens + sum(count_msg_tokens(msg['content']) for msg in messages)
+
+
+	def build_translation_msgs(self, text, dst_lang):
+		return [
+			{
+				'role': 'system',
+				'content': f'Translate the prompt to "{dst_lang}".',
+			},
+			{
+				'role': 'user',
+				'content': text,
+			}
+		]
 	
 
 	def build_msg_content(self, texts=[], image_urls=[]):
@@ -89,6 +119,31 @@ class AIManager(ABC):
 
 			yield chunk
 
+
+	async def aget_stream_chunks(self, resp):
+		"""Yield chunks from an asynchronously streamed reply."""
+		async for chunk in resp:
+			if chunk:
+				yield chunk
+
+
+	async def aget_choice_stream_chunks(self, resp, choice=0):
+		"""Yield chunks for a specific choice from an asynchronously
+		streamed reply."""
+
+		i = 0
+		async for chunk in self.aget_stream_chunks(resp):
+			i += 1
+			if i == 1:
+				# The first chunk is always empty.
+				continue
+
+			c = chunk.choices[choice]
+			if c.finish_reason == 'stop':
+				return
+
+			yield chunk
+
 	
 	@abstractmethod
 	def get_content(self, output_data, choice=0):
@@ -135,7 +190,17 @@ class OpenAIManager(AIManager):
 	def __init__(self, api_key, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 
-		self.client = OpenAI(api_key=api_key)
+		# The governor retries the requests.
+		self.client = OpenAI(
+			api_key=api_key,
+			max_retries=0,
+			http_client=create_openai_http_client(self.options, DefaultHttpxClient)
+		)
+
+
+	def prewarm(self):
+		"""Open connections to the API before they're needed."""
+		prewarm(self.client.models.list, self.options.get('http.prewarm'))
 
 
 	def get_content(self, output_data, choice=0):
@@ -147,47 +212,140 @@ class OpenAIManager(AIManager):
 
 
 	def chat(self, messages, stream=False, **options):
-		return self.client.chat.completions.create(
+		options = self.options.get('chat') | options
+		return self.governor.call(
+			options['model'],
+			self.estimate_chat_tokens(messages, options),
+			self.client.chat.completions.create,
 			messages=messages,
 			temperature=0,
 			stream=stream,
-			**(self.options.get('chat') | options)
+			**options
 		)
 		
 		
 	def translate(self, text, dst_lang='English', response_format=Translation, **options):
-		return self.client.beta.chat.completions.parse(
-			messages=[
-				{
-					'role': 'system',
-					'content': f'Translate the prompt to "{dst_lang}".',
-				},
-				{
-					'role': 'user',
-					'content': text,
-				}
-			],
+		options = self.options.get('translation') | options
+		messages = self.build_translation_msgs(text, dst_lang)
+		return self.governor.call(
+			options['model'],
+			self.estimate_chat_tokens(messages, options),
+			self.client.beta.chat.completions.parse,
+			messages=messages,
 			response_format=response_format,
-			**(self.options.get('translation') | options)
+			**options
 		)
 
 		
 	def tts(self, text, **options):
-		return self.client.audio.speech.create(
+		options = self.options.get('tts') | options
+		return self.governor.call(
+			options['model'],
+			0,
+			self.client.audio.speech.create,
 			input=text,
-			**(self.options.get('tts') | options)
+			**options
 		)
 
 
 	def stt(self, audio, **options):
-		return self.client.audio.transcriptions.create(
+		options = self.options.get('stt') | options
+		return self.governor.call(
+			options['model'],
+			0,
+			self.client.audio.transcriptions.create,
 			file=audio,
-			**(self.options.get('stt') | options)
+			**options
 		)
 	
 
 	def gen_imgs(self, prompt, **options):
-		return self.client.images.generate(
+		options = self.options.get('image') | options
+		return self.governor.call(
+			options['model'],
+			0,
+			self.client.images.generate,
+			prompt=prompt,
+			**options
+		)
+
+
+class AsyncOpenAIManager(OpenAIManager):
+	"""OpenAI API manager for the asyncio runtime. API calls return
+	coroutines."""
+
+
+	def __init__(self, api_key, *args, **kwargs):
+		AIManager.__init__(self, *args, **kwargs)
+
+		self.client = AsyncOpenAI(
+			api_key=api_key,
+			max_retries=0,
+			http_client=create_openai_http_client(self.options, DefaultAsyncHttpxClient)
+		)
+
+
+	async def prewarm(self):
+		await aprewarm(self.client.models.list, self.options.get('http.prewarm'))
+
+
+	async def chat(self, messages, stream=False, **options):
+		options = self.options.get('chat') | options
+		return await self.governor.acall(
+			options['model'],
+			self.estimate_chat_tokens(messages, options),
+			self.client.chat.completions.create,
+			messages=messages,
+			temperature=0,
+			stream=stream,
+			**options
+		)
+
+
+	async def translate(self, text, dst_lang='English', response_format=Translation, **options):
+		options = self.options.get('translation') | options
+		messages = self.build_translation_msgs(text, dst_lang)
+		return await self.governor.acall(
+			options['model'],
+			self.estimate_chat_tokens(messages, options),
+			self.client.beta.chat.completions.parse,
+			messages=messages,
+			response_format=response_format,
+			**options
+		)
+
+
+	async def tts(self, text, **options):
+		options = self.options.get('tts') | options
+		resp = await self.governor.acall(
+			options['model'],
+			0,
+			self.client.audio.speech.create,
+			input=text,
+			**options
+		)
+		# The async binary response can't be read lazily by the
+		# Telegram client, return the audio bytes instead.
+		return await resp.aread()
+
+
+	async def stt(self, audio, **options):
+		options = self.options.get('stt') | options
+		return await self.governor.acall(
+			options['model'],
+			0,
+			self.client.audio.transcriptions.create,
+			file=audio,
+			**options
+		)
+
+
+	async def gen_imgs(self, prompt, **options):
+		options = self.options.get('image') | options
+		return await self.governor.acall(
+			options['model'],
+			0,
+			self.client.images.generate,
 			prompt=prompt,
-			**(self.options.get('image') | options)
+			**options
 		)
\ No newline at end of file
@@ -0,0 +1,44 @@
+import functools
+
+import tiktoken
+
+from constants.ai import CHARS_PER_TOKEN, TOKENIZER_ENCODING, IMAGE_TOKENS, MSG_OVERHEAD_TOKENS
+
+
+
+@functools.cache
+def get_encoding():
+	"""Return the tokenizer, or None if it could not be loaded (tiktoken
+	downloads the encoding the first time it's used)."""
+	try:
+		return tiktoken.get_encoding(TOKENIZER_ENCODING)
+	except Exception as e:
+		print(f'WARNING - Tokenizer unavailable, token counts will be estimated: {e}')
+		return None
+
+
+def count_text_tokens(text):
+	"""Count the tokens in a text."""
+	if encoding := get_encoding():
+		return len(encoding.encode(text, disallowed_special=()))
+	return len(text) // CHARS_PER_TOKEN + 1
+
+
+def count_content_tokens(content):
+	"""Count the tokens in a message's content, which is either a text
+	or a list of content items."""
+	if isinstance(content, str):
+		return count_text_tokens(content)
+
+	tokens = 0
+	for item in content or []:
+		if item['type'] == 'text':
+			tokens += count_text_tokens(item['text'])
+		elif item['type'] == 'image_url':
+			tokens += IMAGE_TOKENS[item['image_url'].get('detail', 'auto')]
+	return tokens
+
+
+def count_msg_tokens(content):
+	"""Count the tokens a message takes in the context."""
+	return MSG_OVERHEAD_TOKENS + count_content_tokens(content)
\ No newline at end of file
@@ -8,4 +8,9 @@ parser.add_argument('--config', default='config.json', help='Configuration path'
 parser.add_argument('--ai_options', default='ai_options.json', help='AI Options path')
 parser.add_argument('--wlist', default='whitelist.txt', help='Whitelist path')
 parser.add_argument('--no_introduce', action='store_true', help="Don't send a /start command automatically when the bot joins a group")
-parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose mode')
\ No newline at end of file
+parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose mode')
+parser.add_argument('--runtime', choices=['threaded', 'asyncio'], default='threaded', help='Execution mode, "asyncio" runs the handlers on an event loop')
+parser.add_argument('--webhook_url', help='Public URL of the webhook, if set the bot receives updates through a webhook instead of polling')
+parser.add_argument('--webhook_host', default='0.0.0.0', help='Address the webhook server listens on')
+parser.add_argument('--webhook_port', type=int, default=8443, help='Port the webhook server listens on')
+parser.add_argument('--workers', type=int, default=0, help='Number of worker processes the chats are spread across, 0 runs the bot in this process')
\ No newline at end of file
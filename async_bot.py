@@ -0,0 +1,734 @@
+"""
+Asyncio runtime of the bot.
+
+It mirrors the handlers in bot.py, but every Telegram, AI and database
+call is awaited so that a single process can serve many chats while
+their replies are being generated.
+"""
+
+from json import JSONDecodeError
+import os
+import secrets
+from base64 import b64decode
+from urllib.parse import urlparse
+
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import BotCommand
+
+# OpenAIError, APIError, APIStatusError.
+from openai import APIError
+
+
+from models.chat import Base,  MessageRole
+from constants.telegram import BOT_SHORT_DESCR, ALLOWED_UPDATES
+
+from utils.prompt import aextract_img_urls, atranscribe
+from utils.messages import build_help_text, build_start_text, aprint_exc, process_text, areply_chat_msg_stream, areply_chat_msg_stream_edits, areply_error, areply_info, areply_chat_msg, areply_voice_msg, areply_voice_msg_stream, asynthesize_voice
+from utils.chat import aget_chat, aget_or_create_chat, aget_cached_context, ainvalidate_cached_context, aadd_telegram_msg, apurge_old_chats
+from utils.context_cache import context_cache
+from utils.media_executor import media_executor
+from utils.db import get_async_database_url, run_migration, upgrade_schema
+from utils.blobs import add_blob, migrate_data_urls, resolve_blob_urls
+
+from utils.dispatcher import AsyncChatDispatcher
+from utils.metrics import metrics
+from utils.outbound import install_outbound_limiter, outbound_limiter
+from utils.http import aprewarm, configure_async_telegram_http
+from utils.webhook import UpdateDeduplicator, arun_webhook_server
+from utils.sharding import ShardWorker
+
+from file_managers.config import ConfigurationManager
+from file_managers.lists import TelegramWhitelistManager
+from file_managers.watcher import FileWatcher
+from ai.managers import AsyncOpenAIManager
+
+from decorators.telegram import dispatched, from_admin, split_cmd, whitelisted, prompt_required
+from args import parser
+from utils.telegram import aparse_cmd_args
+
+
+
+args = parser.parse_args()
+# Set if this process is a worker run by a supervisor.
+shard_worker = ShardWorker.from_env()
+
+# Load the db models.
+engine = create_async_engine(
+	get_async_database_url(os.environ['DATABASE_URL']),
+	echo=args.verbose
+)
+# Objects must not expire on commit as expired attributes can't be
+# lazily reloaded from an async session.
+Session = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+# Load the config and AI managers.
+config = ConfigurationManager(config_path=args.config)
+# Fork the media workers before any thread is started.
+media_executor.start(config.get('media.workers'))
+wlist = TelegramWhitelistManager(list_path=args.wlist)
+ai = AsyncOpenAIManager(api_key=os.environ['OPENAI_API_KEY'], options_path=args.ai_options)
+
+# Load the files again once edited, e.g. by hand or by another
+# process running the bot.
+file_watcher = FileWatcher(config.get('reload.interval_s'))
+file_watcher.watch(config, 'Bot configuration')
+file_watcher.watch(ai.options, 'AI options')
+file_watcher.watch(wlist, 'Whitelist')
+file_watcher.start()
+
+# Replicas behind a load balancer must share the secret token.
+webhook_secret = os.environ.get('TELEGRAM_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+print('Bot configuration path:', args.config)
+print('Whitelist path:', args.wlist)
+print('AI options path:', args.ai_options)
+
+bot = AsyncTeleBot(os.environ['TELEGRAM_API_KEY'], parse_mode=None)
+# Send messages within Telegram's rate limits.
+install_outbound_limiter()
+configure_async_telegram_http(config)
+if shard_worker:
+	# The bot's and the AI's budgets are split between the workers.
+	outbound_limiter.set_share(1 / shard_worker.count)
+	ai.governor.share = 1 / shard_worker.count
+
+dispatcher = AsyncChatDispatcher(
+	workers=config.get('dispatcher.async_workers'),
+	max_queue_per_chat=config.get('dispatcher.max_queue_per_chat')
+)
+
+context_cache.resize(config.get('context_cache.max_mb') * 2**20)
+# Webhook replicas behind a load balancer may write to the same chats.
+context_cache.validate = bool(args.webhook_url)
+
+
+# Debug and info ops.
+
+
+@bot.message_handler(commands=['start'])
+@dispatched(dispatcher)
+@split_cmd
+async def bot_start(msg, cmd, cmd_args):
+	"""Inform about the capabilities of this bot."""
+
+	if not cmd_args:
+		await bot.send_message(
+			msg.chat.id,
+			build_start_text((await bot.get_me()).username),
+			message_thread_id=msg.message_thread_id,
+			parse_mode='Markdown'
+		)
+
+	elif cmd_args == 'commands':
+		msg.text = '/help'
+		await send_help(msg)
+
+
+@bot.message_handler(commands=['help'])
+@dispatched(dispatcher)
+async def send_help(msg):
+	await bot.send_message(
+		msg.from_user.id,
+		build_help_text(),
+		message_thread_id=msg.message_thread_id,
+		parse_mode='Markdown',
+		disable_web_page_preview=True
+	)
+
+
+@bot.message_handler(commands=['status'])
+@dispatched(dispatcher, whitelisted(wlist))
+async def bot_status(msg):
+	"""Show the bot's status."""
+	await bot.send_message(
+		msg.chat.id,
+		'ONLINE',
+		message_thread_id=msg.message_thread_id,
+	)
+
+
+@bot.message_handler(commands=['chatinfo'])
+@dispatched(dispatcher, from_admin, priority=True)
+async def bot_get_chat_info(msg):
+	"""Show the id of the chat the message was sent in."""
+	await areply_info(bot, msg, f'Chat ID: {msg.chat.id}')
+
+
+@bot.message_handler(commands=['metrics'])
+@dispatched(dispatcher, from_admin, priority=True)
+async def bot_metrics(msg):
+	"""Show the runtime metrics."""
+	await bot.send_message(
+		msg.chat.id,
+		f'```\n{metrics.to_text(shard_worker.get_snapshot() if shard_worker else None)}\n```',
+		message_thread_id=msg.message_thread_id,
+		parse_mode='Markdown'
+	)
+
+
+# Config ops.
+
+
+@bot.message_handler(commands=['config', 'conf'])
+@dispatched(dispatcher, from_admin, priority=True)
+@split_cmd
+async def bot_config(msg, cmd, cmd_args):
+	"""
+	Handle a configuration file.
+	Format: /config <bot|ai> <get|set|reset|show> [key_path [value]]
+	"""
+
+	parsed_cmd_args = await aparse_cmd_args(
+		bot, msg, cmd_args,
+		('configuration type', ['bot', 'ai'], None),
+		('operation type', ['get', 'set', 'reset', 'show'], None)
+	)
+	if not parsed_cmd_args:
+		return
+
+	cmd_args, cfg_type, op = parsed_cmd_args
+
+	cfg = None
+	if cfg_type == 'bot':
+		cfg = config
+	elif cfg_type == 'ai':
+		cfg = ai.options
+
+	if op == 'show':
+		await bot.send_message(
+			msg.chat.id,
+			f'```json\n{cfg.to_json(indent=4, sort_keys=True)}\n```',
+			message_thread_id=msg.message_thread_id,
+			parse_mode='Markdown'
+		)
+		return
+
+	else:
+		parsed_cmd_args = await aparse_cmd_args(bot, msg, cmd_args, ('key path', None, None))
+		if not parsed_cmd_args:
+			return
+
+		cmd_args, key_path = parsed_cmd_args
+
+		try:
+			if op == 'get':
+				await areply_info(bot, msg, f'The value at "{key_path}" is set to: {cfg.get(key_path)}')
+
+			elif op == 'reset':
+				cfg.reset(key_path)
+				await areply_info(bot, msg, f'"{key_path}" was reset to its default value ({cfg.get(key_path)}).')
+
+			elif op == 'set':
+				if await aparse_cmd_args(bot, msg, cmd_args, ('value', None, None)):
+					try:
+						cfg.set(key_path, cmd_args, match_type=True)
+						await areply_info(bot, msg, f'"{key_path}" was set to: {cfg.get(key_path)}')
+					except (ValueError, JSONDecodeError):
+						await areply_error(bot, msg, f'The value you specified for "{key_path}" is invalid.')
+
+		except KeyError:
+			await areply_error(bot, msg, f'"{key_path}" is not present in the "{cfg_type}" configuration.')
+
+
+@bot.message_handler(commands=['wlist'])
+@dispatched(dispatcher, from_admin, priority=True)
+@split_cmd
+async def bot_wlist(msg, cmd, cmd_args):
+	"""
+	Handle the whitelist.
+	Format: /wlist <has|add|remove|show> [id]
+	"""
+
+	parsed_cmd_args = await aparse_cmd_args(
+		bot, msg, cmd_args,
+		('operation type', ['has', 'add', 'remove', 'show'], None)
+	)
+	if not parsed_cmd_args:
+		return
+
+	cmd_args, op = parsed_cmd_args
+
+	if op == 'show':
+		list_str = '\n'.join([str(id) for id in wlist.list])
+		await bot.send_message(
+			msg.chat.id,
+			f"```\n{list_str}\n```",
+			message_thread_id=msg.message_thread_id,
+			parse_mode='Markdown'
+		)
+		return
+
+	else:
+		parsed_cmd_args = await aparse_cmd_args(bot, msg, cmd_args, ('id', None, int))
+		if not parsed_cmd_args:
+			return
+
+		_, id = parsed_cmd_args
+
+		if op == 'has':
+			await areply_info(bot, msg, f'"{id}" is{" not" if not wlist.has(id) else ""} present in the whitelist.')
+
+		if op == 'add':
+			wlist.add(id)
+			await areply_info(bot, msg, f'"{id}" was added to the whitelist.')
+
+		elif op == 'remove':
+			wlist.remove(id)
+			await areply_info(bot, msg, f'"{id}" was removed from the whitelist.')
+
+
+# Chat ops.
+
+
+@bot.message_handler(commands=['sysmsg'])
+@dispatched(dispatcher, whitelisted(wlist))
+@split_cmd
+async def bot_set_sys_msg(msg, cmd, cmd_args):
+	"""
+	Handle the chat's system message.
+	Format: /sysmsg <set|reset|show> [message]
+	"""
+
+	parsed_cmd_args = await aparse_cmd_args(
+		bot, msg, cmd_args,
+		('operation type', ['set', 'reset', 'show'], None)
+	)
+	if not parsed_cmd_args:
+		return
+
+	cmd_args, op = parsed_cmd_args
+
+	async with Session() as ses:
+		chat = await aget_chat(ses, msg.chat.id, thread_id=msg.message_thread_id)
+
+		if op == 'show':
+			if chat:
+				await areply_info(bot, msg, f"Current system message: {chat.sys_msg}")
+			else:
+				await areply_info(bot, msg, f"This chat hasn't been registered yet.")
+
+		elif op == 'reset':
+			config.reset('chat.default_sys_msg')
+			default_sys_msg = config.get('chat.default_sys_msg')
+			if chat:
+				chat.sys_msg = default_sys_msg
+				await ainvalidate_cached_context(ses, msg.chat.id, thread_id=msg.message_thread_id)
+				await ses.commit()
+			await areply_info(bot, msg, f"The system message was reset to default: {default_sys_msg}")
+
+		elif op == 'set':
+			if await aparse_cmd_args(bot, msg, cmd_args, ('message', None, None)):
+				chat = await aget_or_create_chat(ses, msg.chat.id, config, thread_id=msg.message_thread_id)
+				chat.sys_msg = cmd_args
+				await ainvalidate_cached_context(ses, msg.chat.id, thread_id=msg.message_thread_id)
+				await ses.commit()
+
+				await areply_info(bot, msg, f"The system message was set to: {chat.sys_msg}")
+
+
+@bot.message_handler(commands=['purgechats'])
+@dispatched(dispatcher, from_admin, priority=True)
+async def bot_purge_chats(msg):
+	async with Session() as ses:
+		await apurge_old_chats(ses, config)
+		await ses.commit()
+		await areply_info(bot, msg, 'Old chats were purged.')
+
+
+@bot.message_handler(commands=['cansee'])
+@dispatched(dispatcher, whitelisted(wlist))
+async def bot_cansee(msg):
+	"""Tell if there are images in the chat's messages as that means the
+	vision model may be used."""
+
+	has_visual_content = False
+	async with Session() as ses:
+		if chat := await aget_chat(ses, msg.chat.id, thread_id=msg.message_thread_id):
+			# Only the messages that may be in the context.
+			has_visual_content = await ses.run_sync(
+				lambda _: ai.check_for_visual_content(
+					chat.get_recent_messages(config.get('chat.max_msgs'))
+				)
+			)
+
+	if has_visual_content:
+		await areply_info(bot, msg, 'Images were referenced in the conversation.')
+	else:
+		await areply_info(bot, msg, 'No images were referenced in the conversation.')
+
+
+@bot.message_handler(commands=['forget'])
+@dispatched(dispatcher, whitelisted(wlist))
+async def bot_forget(msg):
+	"""Erase the bot's memory for this chat."""
+
+	async with Session() as ses:
+		if chat := await aget_chat(ses, msg.chat.id, thread_id=msg.message_thread_id):
+			await ses.run_sync(lambda _: chat.erase())
+			await ainvalidate_cached_context(ses, msg.chat.id, thread_id=msg.message_thread_id)
+			await ses.commit()
+
+	await areply_info(bot, msg, f"Past messages from this chat erased from the bot's memory.")
+
+
+@bot.message_handler(commands=['chat', 'llm', 'gpt', 'achat', 'allm', 'agpt'])
+@dispatched(dispatcher, whitelisted(wlist))
+@prompt_required(bot=bot, ai=ai, config=config)
+async def bot_chat(msg, prompt):
+	"""Chat with the AI, by either a textual or a voice message, and show
+	the response."""
+
+	async def reply(text):
+		if msg.text.startswith('/a'):
+			# /allm (audio prompt).
+			return await areply_voice_msg(bot, msg, text, ai)
+		else:
+			# /llm (text prompt).
+			return await areply_chat_msg(bot, msg, text)
+
+
+	async def reply_stream(msg, chunks):
+		if msg.chat.type == 'private':
+			telegram_resp_msg = await areply_chat_msg_stream(bot, msg, chunks)
+			return telegram_resp_msg, telegram_resp_msg.text
+		# Telegram allows drafts in private chats only, edit a message
+		# instead.
+		return await areply_chat_msg_stream_edits(bot, msg, chunks)
+
+
+	# Same settings for the whole reply even if changed meanwhile.
+	cfg = config.snapshot()
+
+	if prompt:
+		text, img_urls, blobs = await aextract_img_urls(bot, msg, prompt, ai=ai, config=cfg)
+		content = ai.build_msg_content([text], img_urls)
+
+		async with Session() as ses:
+			for blob in blobs:
+				await ses.run_sync(add_blob, blob)
+			# Don't commit until there is absolute certainty that the AI
+			# replied.
+			await aadd_telegram_msg(
+				ses,
+				msg,
+				cfg,
+				content=content,
+				role=MessageRole.user
+			)
+			# Cached along with the message, no need to query it.
+			ctx = await aget_cached_context(ses, msg.chat.id, cfg, thread_id=msg.message_thread_id)
+			model, max_tokens = ai.get_preferred_model_settings(ctx.messages)
+
+			try:
+				should_stream =\
+					cfg.get('chat.streaming')\
+					and not msg.text.startswith('/a')\
+					and (
+						msg.chat.type == 'private'\
+						or cfg.get('chat.group_streaming')\
+					)
+				# Synthesize the voice reply while it's being generated.
+				should_stream_voice =\
+					cfg.get('chat.voice_streaming')\
+					and msg.text.startswith('/a')
+
+				resp = await ai.chat(
+					await ses.run_sync(
+						resolve_blob_urls,
+						ctx.get_context(max_tokens=ai.get_context_max_tokens(model))
+					),
+					model=model,
+					max_tokens=max_tokens,
+					stream=should_stream or should_stream_voice
+				)
+
+				resp_msg_content = ''
+				if should_stream:
+					telegram_resp_msg, resp_msg_content = await reply_stream(
+						msg,
+						(
+							ai.get_content(chunk)
+							async for chunk in ai.aget_choice_stream_chunks(resp)
+						)
+					)
+				elif should_stream_voice:
+					telegram_resp_msg, resp_msg_content = await areply_voice_msg_stream(
+						bot,
+						msg,
+						(
+							ai.get_content(chunk)
+							async for chunk in ai.aget_choice_stream_chunks(resp)
+						),
+						ai,
+						cfg
+					)
+				else:
+					resp_msg_content = ai.get_content(resp)
+					telegram_resp_msg = await reply(resp_msg_content)
+
+
+				# Add the AI's reply to the db and commit.
+				await aadd_telegram_msg(
+					ses,
+					telegram_resp_msg,
+					cfg,
+					process_text(resp_msg_content),
+					MessageRole.assistant
+				)
+
+				await ses.commit()
+
+			except APIError as e:
+				await aprint_exc(e, bot, msg)
+
+
+@bot.message_handler(commands=['oldmsg'])
+@dispatched(dispatcher, whitelisted(wlist))
+async def bot_oldmsg(msg):
+	"""Show the oldest message in the chat that the bot has access
+	to."""
+
+	# Get the oldest message, older ones are kept until trimmed but
+	# aren't in the context.
+	oldest_msg = None
+	async with Session() as ses:
+		if chat := await aget_chat(ses, msg.chat.id, thread_id=msg.message_thread_id):
+			recent_msgs = await ses.run_sync(
+				lambda _: chat.get_recent_messages(config.get('chat.max_msgs')).all()
+			)
+			oldest_msg = recent_msgs[-1] if recent_msgs else None
+
+	# Show the oldest message.
+	if oldest_msg:
+		await bot.send_message(
+			msg.chat.id,
+			'☝ This is the oldest message the bot has access to',
+			reply_to_message_id=oldest_msg.id,
+			message_thread_id=msg.message_thread_id
+		)
+	else:
+		await bot.reply_to(
+			msg,
+			'Could not find any message on this chat.',
+			message_thread_id=msg.message_thread_id
+		)
+
+
+# Other AI ops.
+
+
+@bot.message_handler(commands=['translate', 'to'])
+@dispatched(dispatcher, whitelisted(wlist))
+@prompt_required(from_reply=True, bot=bot, ai=ai, config=config)
+async def bot_translate(msg, prompt):
+	"""
+	Translate the quoted message's text to the specified language.
+	Format: /to <language>
+	"""
+
+	lang = msg.text.split(' ', 1)[1]
+
+	try:
+		resp = await ai.translate(prompt, lang)
+		trans = resp.choices[0].message.parsed
+		trans.translated_text = process_text(trans.translated_text)
+
+		# Show the translated text.
+		await bot.send_message(
+			msg.chat.id,
+			f'[{trans.src_lang}->{trans.dst_lang}] {trans.translated_text}',
+			reply_to_message_id=msg.reply_to_message.id,
+			message_thread_id=msg.message_thread_id
+		)
+
+	except APIError as e:
+		await aprint_exc(e, bot, msg)
+
+
+@bot.message_handler(commands=['stt'])
+@dispatched(dispatcher, whitelisted(wlist))
+@prompt_required(type='audio', from_reply=True, bot=bot, config=config)
+async def bot_stt(msg, prompt):
+	"""Transcribe the quoted message's text."""
+
+	if prompt:
+		try:
+			text = await atranscribe(ai, prompt, config)
+			await bot.send_message(
+				msg.chat.id,
+				text,
+				reply_to_message_id=msg.id,
+				message_thread_id=msg.message_thread_id
+			)
+
+		except APIError as e:
+			await aprint_exc(e, bot, msg)
+
+
+@bot.message_handler(commands=['tts'])
+@dispatched(dispatcher, whitelisted(wlist))
+@prompt_required(from_reply=True)
+async def bot_tts(msg, prompt):
+	"""Turn the quoted message's text to speech."""
+	if prompt:
+		try:
+			await bot.send_voice(
+				msg.chat.id,
+				await asynthesize_voice(ai, prompt, config),
+				reply_to_message_id=msg.id,
+				message_thread_id=msg.message_thread_id
+			)
+
+		except APIError as e:
+			await aprint_exc(e, bot, msg)
+
+
+@bot.message_handler(commands=['image', 'img', 'picture', 'pic'])
+@dispatched(dispatcher, whitelisted(wlist))
+@prompt_required()
+async def bot_dalle(msg, prompt):
+	"""Generate an image based on the prompt."""
+	if prompt:
+		try:
+			resp = await ai.gen_imgs(
+				prompt,
+				n=1,
+				response_format='b64_json'
+			)
+			img_data = b64decode(resp.data[0].b64_json)
+
+			await bot.send_photo(
+				msg.chat.id,
+				img_data,
+				caption=prompt,
+				reply_to_message_id=msg.id,
+				message_thread_id=msg.message_thread_id
+			)
+
+		except APIError as e:
+			await aprint_exc(e, bot, msg)
+
+
+# Non-command ops.
+# The events below are for messages either received from a private
+# chat or that are replies to a bot's message.
+# Redirect them to simulate a command message.
+
+
+def is_addressed(msg):
+	"""Return True if a message was sent in a private chat or replies
+	to a bot's message."""
+	return (msg.chat.type == 'private')\
+		or bool(msg.reply_to_message and (msg.reply_to_message.from_user.id == bot.user.id))
+
+
+@bot.message_handler(content_types=['text'])
+@dispatched(dispatcher, is_addressed, whitelisted(wlist))
+async def text_msg_event(msg):
+	if not msg.text.startswith('/'):
+		# Simulate a command message.
+		msg.text = f'/chat {msg.text}'
+		await bot_chat(msg)
+
+
+@bot.message_handler(content_types=['voice'])
+@dispatched(dispatcher, is_addressed, whitelisted(wlist))
+async def msg_event(msg):
+	if msg.voice:
+		# Simulate a command message.
+		msg.text = '/achat'
+		# Reply to itself since /allm needs a quoted audio.
+		msg.reply_to_message = msg
+		await bot_chat(msg)
+
+
+@bot.message_handler(content_types=['photo'])
+@dispatched(dispatcher, is_addressed, whitelisted(wlist))
+async def handle_photo(msg):
+	if not msg.caption.startswith('/'):
+		# Simulate a command message.
+		msg.text = f'/chat {msg.caption}'
+		# Reply to itself since bot_chat() checks for images
+		# in the quoted msg.
+		msg.reply_to_message = msg
+		await bot_chat(msg)
+
+
+# Misc ops.
+
+
+@bot.my_chat_member_handler()
+@dispatched(dispatcher)
+async def handle_my_chat_member(msg):
+	status = msg.new_chat_member.status
+
+	if status == 'member':
+		if not args.no_introduce:
+			# The bot joined a group, simulate a /start command.
+			msg.text = '/start'
+			await bot_start(msg)
+
+	elif status == 'left':
+		# The bot left the group, delete the chat and its messages
+		# from the database.
+		async with Session() as ses:
+			if chat := await aget_chat(ses, msg.chat.id, thread_id=msg.message_thread_id):
+				await ses.delete(chat)
+				await ainvalidate_cached_context(ses, msg.chat.id, thread_id=msg.message_thread_id)
+				await ses.commit()
+
+
+async def main():
+	"""Set up the database and the bot profile, then start polling."""
+
+	async with engine.begin() as conn:
+		await conn.run_sync(upgrade_schema, Base.metadata)
+		await conn.run_sync(Base.metadata.create_all)
+	async with Session() as ses:
+		await ses.run_sync(run_migration, 'blobs', migrate_data_urls)
+		await ses.commit()
+
+	# Open connections before the first updates need them.
+	await aprewarm(bot.get_me, config.get('http.prewarm'))
+	await ai.prewarm()
+
+	await bot.set_my_commands([
+		BotCommand('help', 'Receive the list of commands in a private chat')
+	])
+	await bot.set_my_description((
+		f'{BOT_SHORT_DESCR}\n'
+		'Click the START button or use /start for more details.'
+	))
+
+	try:
+		if shard_worker:
+			# The bot's user is only fetched when polling.
+			bot._user = await bot.get_me()
+			# The supervisor receives the updates.
+			await shard_worker.arun(bot)
+		elif args.webhook_url:
+			# The bot's user is only fetched when polling.
+			bot._user = await bot.get_me()
+			# Only request the update types the handlers use.
+			await bot.set_webhook(
+				url=args.webhook_url,
+				secret_token=webhook_secret,
+				allowed_updates=ALLOWED_UPDATES
+			)
+			await arun_webhook_server(
+				bot,
+				args.webhook_host,
+				args.webhook_port,
+				urlparse(args.webhook_url).path or '/',
+				webhook_secret,
+				UpdateDeduplicator(max_size=config.get('webhook.dedup_size'))
+			)
+		else:
+			# Polling doesn't work while a webhook is set.
+			await bot.remove_webhook()
+			await bot.infinity_polling(allowed_updates=ALLOWED_UPDATES)
+	finally:
+		await bot.close_session()
+		await engine.dispose()
\ No newline at end of file
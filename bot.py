@@ -1,10 +1,10 @@
 from json import JSONDecodeError
 import os
+import secrets
 from base64 import b64decode
+from urllib.parse import urlparse
 
 from sqlalchemy import create_engine
-from sqlalchemy import event
-from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
 
 from telebot import TeleBot
@@ -14,59 +14,128 @@ from telebot.types import BotCommand
 from openai import APIError
 
 
-from models.chat import Base,  Message, MessageRole
+from models.chat import Base,  MessageRole
+from constants.telegram import BOT_SHORT_DESCR, ALLOWED_UPDATES
 
-from utils.versioning import get_version_str
-from utils.prompt import extract_img_urls
-from utils.messages import print_exc, process_text, reply_chat_msg_stream, reply_error, reply_info, reply_chat_msg, reply_voice_msg
-from utils.chat import get_chat, get_or_create_chat, add_telegram_msg, purge_old_chats
+from utils.prompt import extract_img_urls, transcribe
+from utils.messages import build_help_text, build_start_text, print_exc, process_text, reply_chat_msg_stream, reply_chat_msg_stream_edits, reply_error, reply_info, reply_chat_msg, reply_voice_msg, reply_voice_msg_stream, synthesize_voice
+from utils.chat import get_chat, get_or_create_chat, get_cached_context, invalidate_cached_context, add_telegram_msg, purge_old_chats
+from utils.context_cache import context_cache
+from utils.media_executor import media_executor
+# Importing it registers the database engine events.
+from utils.db import run_migration, upgrade_schema
+from utils.blobs import add_blob, migrate_data_urls, resolve_blob_urls
+
+from utils.dispatcher import ChatDispatcher
+from utils.metrics import metrics
+from utils.outbound import install_outbound_limiter, outbound_limiter
+from utils.http import configure_telegram_http, prewarm
+from utils.sharding import ShardWorker, run_supervisor
+from utils.webhook import UpdateDeduplicator, run_webhook_server
 
 from file_managers.config import ConfigurationManager
 from file_managers.lists import TelegramWhitelistManager
+from file_managers.watcher import FileWatcher
 from ai.managers import OpenAIManager
 
-from decorators.telegram import admin_only, split_cmd, wlisted_only, prompt_required
+from decorators.telegram import dispatched, from_admin, split_cmd, whitelisted, prompt_required
 from args import parser
 from utils.telegram import parse_cmd_args
 
 
 
 args = parser.parse_args()
+# Set if this process is a worker run by a supervisor.
+shard_worker = ShardWorker.from_env()
+
+if args.workers and not shard_worker:
+	# Run the bot in worker processes, this one only receives the
+	# updates and routes them.
+	webhook = None
+	if args.webhook_url:
+		webhook = {
+			'url': args.webhook_url,
+			'host': args.webhook_host,
+			'port': args.webhook_port,
+			'path': urlparse(args.webhook_url).path or '/',
+			'secret_token': os.environ.get('TELEGRAM_WEBHOOK_SECRET') or secrets.token_urlsafe(32),
+			'dedup': UpdateDeduplicator(
+				max_size=ConfigurationManager(config_path=args.config).get('webhook.dedup_size')
+			),
+		}
+	run_supervisor(args.workers, os.environ['TELEGRAM_API_KEY'], ALLOWED_UPDATES, webhook)
+	raise SystemExit
+
+if args.runtime == 'asyncio':
+	# The asyncio runtime has its own handlers.
+	import asyncio
+	import async_bot
+	asyncio.run(async_bot.main())
+	raise SystemExit
 
 # Load the db models.
 engine = create_engine(os.environ['DATABASE_URL'], echo=args.verbose)
-
-# SQLite ignores foreign keys. Enable it since referential
-# integrity is needed to avoid leaving orphan messages when deleting
-# chats.
-@event.listens_for(Engine, 'connect')
-def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
-	if 'sqlite' in str(dbapi_connection.__class__):
-		cursor = dbapi_connection.cursor()
-		cursor.execute("PRAGMA foreign_keys=ON")
-		cursor.close()
-
-Base.metadata.create_all(engine)
+with engine.begin() as conn:
+	upgrade_schema(conn, Base.metadata)
+	Base.metadata.create_all(conn)
 Session = sessionmaker(bind=engine)
+with Session() as ses:
+	run_migration(ses, 'blobs', migrate_data_urls)
+	ses.commit()
 
 # Load the config and AI managers.
 config = ConfigurationManager(config_path=args.config)
+# Fork the media workers before any thread is started.
+media_executor.start(config.get('media.workers'))
 wlist = TelegramWhitelistManager(list_path=args.wlist)
 ai = OpenAIManager(api_key=os.environ['OPENAI_API_KEY'], options_path=args.ai_options)
 
+# Load the files again once edited, e.g. by hand or by another
+# process running the bot.
+file_watcher = FileWatcher(config.get('reload.interval_s'))
+file_watcher.watch(config, 'Bot configuration')
+file_watcher.watch(ai.options, 'AI options')
+file_watcher.watch(wlist, 'Whitelist')
+file_watcher.start()
+
+# Replicas behind a load balancer must share the secret token.
+webhook_secret = os.environ.get('TELEGRAM_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
 print('Bot configuration path:', args.config)
 print('Whitelist path:', args.wlist)
 print('AI options path:', args.ai_options)
 
-bot = TeleBot(os.environ['TELEGRAM_API_KEY'], parse_mode=None)
-
-bot_short_descr = "I'm a bot that lets you use various AI models."
+# Handlers are run by the dispatcher's workers, let the polling
+# thread only receive updates and queue them.
+bot = TeleBot(os.environ['TELEGRAM_API_KEY'], parse_mode=None, threaded=False)
+# Send messages within Telegram's rate limits.
+install_outbound_limiter()
+configure_telegram_http(config)
+if shard_worker:
+	# The bot's and the AI's budgets are split between the workers.
+	outbound_limiter.set_share(1 / shard_worker.count)
+	ai.governor.share = 1 / shard_worker.count
+
+dispatcher = ChatDispatcher(
+	workers=config.get('dispatcher.workers'),
+	priority_workers=config.get('dispatcher.priority_workers'),
+	max_queue_per_chat=config.get('dispatcher.max_queue_per_chat')
+)
+dispatcher.start()
+
+context_cache.resize(config.get('context_cache.max_mb') * 2**20)
+# Webhook replicas behind a load balancer may write to the same chats.
+context_cache.validate = bool(args.webhook_url)
+
+# Open connections before the first updates need them.
+prewarm(bot.get_me, config.get('http.prewarm'))
+ai.prewarm()
 
 bot.set_my_commands([
 	BotCommand('help', 'Receive the list of commands in a private chat')
 ])
 bot.set_my_description((
-	f'{bot_short_descr}\n'
+	f'{BOT_SHORT_DESCR}\n'
 	'Click the START button or use /start for more details.'
 ))
 
@@ -75,20 +144,15 @@ bot.set_my_description((
 
 
 @bot.message_handler(commands=['start'])
+@dispatched(dispatcher)
 @split_cmd
 def bot_start(msg, cmd, cmd_args):
 	"""Inform about the capabilities of this bot."""
 	
 	if not cmd_args:
-		help_text = (
-			f'{bot_short_descr}\n'
-			'Click '
-			f'[here](https://t.me/{bot.get_me().username}?start=commands)'
-			' or use /help to get a list of user commands in a private chat.'
-		)
 		bot.send_message(
 			msg.chat.id,
-			help_text,
+			build_start_text(bot.get_me().username),
 			message_thread_id=msg.message_thread_id,
 			parse_mode='Markdown'
 		)
@@ -99,37 +163,11 @@ def bot_start(msg, cmd, cmd_args):
 
 
 @bot.message_handler(commands=['help'])
+@dispatched(dispatcher)
 def send_help(msg):
-	version_str = get_version_str()
-	if version_str:
-		version_str = f'{get_version_str()}\n\n'
-	else:
-		version_str = ''
-
-	cmds = (
-		f'{version_str}'
-
-		'User Commands:\n\n'
-
-		'/sysmsg	-	Change the system message for this chat\n'
-		'/forget	-	Make the bot forget all the messages from this chat.\n'
-		'/chat		-	Chat with the AI\n'
-		'/achat		-	Chat with the AI and receive a voice message\n'
-		'/oldmsg	-	Show the oldest message the bot remembers\n'
-		'/to		-	Translate a message\n'
-		'/stt		-	Transcribe a message\n'
-		'/tts		-	Make a voice message out of a textual one\n'
-		'/img		-	Generate an image\n'
-
-		"\n**NOTE**: You don't need to use /chat or /achat, simply reply with text or voice instead."
-
-		'\n\nYou can find the full list of commands '
-		'[here](https://github.com/franbis/MultiAITeleBot/blob/main/commands.md)'
-		'.'
-	)
 	bot.send_message(
 		msg.from_user.id,
-		cmds,
+		build_help_text(),
 		message_thread_id=msg.message_thread_id,
 		parse_mode='Markdown',
 		disable_web_page_preview=True
@@ -137,7 +175,7 @@ def send_help(msg):
 
 
 @bot.message_handler(commands=['status'])
-@wlisted_only(wlist)
+@dispatched(dispatcher, whitelisted(wlist))
 def bot_status(msg):
 	"""Show the bot's status."""
 	bot.send_message(
@@ -148,18 +186,30 @@ def bot_status(msg):
 
 
 @bot.message_handler(commands=['chatinfo'])
-@admin_only
+@dispatched(dispatcher, from_admin, priority=True)
 def bot_get_chat_info(msg):
 	"""Show the id of the chat the message was sent in."""
 	reply_info(bot, msg, f'Chat ID: {msg.chat.id}')
 
 
+@bot.message_handler(commands=['metrics'])
+@dispatched(dispatcher, from_admin, priority=True)
+def bot_metrics(msg):
+	"""Show the runtime metrics."""
+	bot.send_message(
+		msg.chat.id,
+		f'```\n{metrics.to_text(shard_worker.get_snapshot() if shard_worker else None)}\n```',
+		message_thread_id=msg.message_thread_id,
+		parse_mode='Markdown'
+	)
+
+
 # Config ops.
 
 
 @bot.message_handler(commands=['config', 'conf'])
+@dispatched(dispatcher, from_admin, priority=True)
 @split_cmd
-@admin_only
 def bot_config(msg, cmd, cmd_args):
 	"""
 	Handle a configuration file.
@@ -219,8 +269,8 @@ def bot_config(msg, cmd, cmd_args):
 
 
 @bot.message_handler(commands=['wlist'])
+@dispatched(dispatcher, from_admin, priority=True)
 @split_cmd
-@admin_only
 def bot_wlist(msg, cmd, cmd_args):
 	"""
 	Handle the whitelist.
@@ -269,8 +319,8 @@ def bot_wlist(msg, cmd, cmd_args):
 
 
 @bot.message_handler(commands=['sysmsg'])
+@dispatched(dispatcher, whitelisted(wlist))
 @split_cmd
-@wlisted_only(wlist)
 def bot_set_sys_msg(msg, cmd, cmd_args):
 	"""
 	Handle the chat's system message.
@@ -300,6 +350,7 @@ def bot_set_sys_msg(msg, cmd, cmd_args):
 			default_sys_msg = config.get('chat.default_sys_msg')
 			if chat:
 				chat.sys_msg = default_sys_msg
+				invalidate_cached_context(ses, msg.chat.id, thread_id=msg.message_thread_id)
 				ses.commit()
 			reply_info(bot, msg, f"The system message was reset to default: {default_sys_msg}")
 
@@ -307,13 +358,14 @@ def bot_set_sys_msg(msg, cmd, cmd_args):
 			if parse_cmd_args(bot, msg, cmd_args, ('message', None, None)):
 				chat = get_or_create_chat(ses, msg.chat.id, config, thread_id=msg.message_thread_id)
 				chat.sys_msg = cmd_args
+				invalidate_cached_context(ses, msg.chat.id, thread_id=msg.message_thread_id)
 				ses.commit()
 
 				reply_info(bot, msg, f"The system message was set to: {chat.sys_msg}")
 
 
 @bot.message_handler(commands=['purgechats'])
-@admin_only
+@dispatched(dispatcher, from_admin, priority=True)
 def bot_purge_chats(msg):
 	with Session() as ses:
 		purge_old_chats(ses, config)
@@ -322,7 +374,7 @@ def bot_purge_chats(msg):
 
 
 @bot.message_handler(commands=['cansee'])
-@wlisted_only(wlist)
+@dispatched(dispatcher, whitelisted(wlist))
 def bot_cansee(msg):
 	"""Tell if there are images in the chat's messages as that means the
 	vision model may be used."""
@@ -330,7 +382,10 @@ def bot_cansee(msg):
 	has_visual_content = False
 	with Session() as ses:
 		if chat := get_chat(ses, msg.chat.id, thread_id=msg.message_thread_id):
-			has_visual_content = ai.check_for_visual_content(chat.messages)
+			# Only the messages that may be in the context.
+			has_visual_content = ai.check_for_visual_content(
+				chat.get_recent_messages(config.get('chat.max_msgs'))
+			)
 	
 	if has_visual_content:
 		reply_info(bot, msg, 'Images were referenced in the conversation.')
@@ -339,21 +394,22 @@ def bot_cansee(msg):
 
 
 @bot.message_handler(commands=['forget'])
-@wlisted_only(wlist)
+@dispatched(dispatcher, whitelisted(wlist))
 def bot_forget(msg):
 	"""Erase the bot's memory for this chat."""
 
 	with Session() as ses:
 		if chat := get_chat(ses, msg.chat.id, thread_id=msg.message_thread_id):
 			chat.erase()
+			invalidate_cached_context(ses, msg.chat.id, thread_id=msg.message_thread_id)
 			ses.commit()
 
 	reply_info(bot, msg, f"Past messages from this chat erased from the bot's memory.")
 
 
 @bot.message_handler(commands=['chat', 'llm', 'gpt', 'achat', 'allm', 'agpt'])
+@dispatched(dispatcher, whitelisted(wlist))
 @prompt_required(bot=bot, ai=ai, config=config)
-@wlisted_only(wlist)
 def bot_chat(msg, prompt):
 	"""Chat with the AI, by either a textual or a voice message, and show
 	the response."""
@@ -367,54 +423,81 @@ def bot_chat(msg, prompt):
 			return reply_chat_msg(bot, msg, text)
 		
 	
-	def reply_stream(msg, chunks, max_tokens):
-		return reply_chat_msg_stream(bot, msg, chunks, max_tokens)
+	def reply_stream(msg, chunks):
+		if msg.chat.type == 'private':
+			telegram_resp_msg = reply_chat_msg_stream(bot, msg, chunks)
+			return telegram_resp_msg, telegram_resp_msg.text
+		# Telegram allows drafts in private chats only, edit a message
+		# instead.
+		return reply_chat_msg_stream_edits(bot, msg, chunks)
 		
 
+	# Same settings for the whole reply even if changed meanwhile.
+	cfg = config.snapshot()
+
 	if prompt:
-		text, img_urls = extract_img_urls(bot, msg, prompt)
+		text, img_urls, blobs = extract_img_urls(bot, msg, prompt, ai=ai, config=cfg)
 		content = ai.build_msg_content([text], img_urls)
 
 		with Session() as ses:
+			for blob in blobs:
+				add_blob(ses, blob)
 			# Don't commit until there is absolute certainty that the AI
 			# replied.
 			add_telegram_msg(
 				ses,
 				msg,
-				config,
+				cfg,
 				content=content,
 				role=MessageRole.user
 			)
-			chat = get_or_create_chat(ses, msg.chat.id, config, thread_id=msg.message_thread_id)
-			model, max_tokens = ai.get_preferred_model_settings(chat.messages)
+			# Cached along with the message, no need to query it.
+			ctx = get_cached_context(ses, msg.chat.id, cfg, thread_id=msg.message_thread_id)
+			model, max_tokens = ai.get_preferred_model_settings(ctx.messages)
 
 			try:
 				should_stream =\
-					config.get('chat.streaming')\
-					and not (\
-						msg.text.startswith('/a')\
-						# Telegram allows streaming in private chats only.
-						or msg.chat.type != 'private'\
+					cfg.get('chat.streaming')\
+					and not msg.text.startswith('/a')\
+					and (
+						msg.chat.type == 'private'\
+						or cfg.get('chat.group_streaming')\
 					)
+				# Synthesize the voice reply while it's being generated.
+				should_stream_voice =\
+					cfg.get('chat.voice_streaming')\
+					and msg.text.startswith('/a')
 
 				resp = ai.chat(
-					chat.get_context(),
+					resolve_blob_urls(
+						ses,
+						ctx.get_context(max_tokens=ai.get_context_max_tokens(model))
+					),
 					model=model,
 					max_tokens=max_tokens,
-					stream=should_stream
+					stream=should_stream or should_stream_voice
 				)
 
 				resp_msg_content = ''
 				if should_stream:
-					telegram_resp_msg = reply_stream(
+					telegram_resp_msg, resp_msg_content = reply_stream(
+						msg,
+						map(
+							ai.get_content,
+							ai.get_choice_stream_chunks(resp)
+						)
+					)
+				elif should_stream_voice:
+					telegram_resp_msg, resp_msg_content = reply_voice_msg_stream(
+						bot,
 						msg,
 						map(
 							ai.get_content,
 							ai.get_choice_stream_chunks(resp)
 						),
-						max_tokens
+						ai,
+						cfg
 					)
-					resp_msg_content = telegram_resp_msg.text
 				else:
 					resp_msg_content = ai.get_content(resp)
 					telegram_resp_msg = reply(resp_msg_content)
@@ -424,7 +507,7 @@ def bot_chat(msg, prompt):
 				add_telegram_msg(
 					ses,
 					telegram_resp_msg,
-					config,
+					cfg,
 					process_text(resp_msg_content),
 					MessageRole.assistant
 				)
@@ -436,16 +519,18 @@ def bot_chat(msg, prompt):
 
 
 @bot.message_handler(commands=['oldmsg'])
-@wlisted_only(wlist)
+@dispatched(dispatcher, whitelisted(wlist))
 def bot_oldmsg(msg):
 	"""Show the oldest message in the chat that the bot has access
 	to."""
 
-	# Get the oldest message.
+	# Get the oldest message, older ones are kept until trimmed but
+	# aren't in the context.
 	oldest_msg = None
 	with Session() as ses:
 		if chat := get_chat(ses, msg.chat.id, thread_id=msg.message_thread_id):
-			oldest_msg = chat.messages.order_by(Message.id.asc()).first()
+			recent_msgs = chat.get_recent_messages(config.get('chat.max_msgs')).all()
+			oldest_msg = recent_msgs[-1] if recent_msgs else None
 
 	# Show the oldest message.
 	if oldest_msg:
@@ -467,8 +552,8 @@ def bot_oldmsg(msg):
 
 
 @bot.message_handler(commands=['translate', 'to'])
+@dispatched(dispatcher, whitelisted(wlist))
 @prompt_required(from_reply=True, bot=bot, ai=ai, config=config)
-@wlisted_only(wlist)
 def bot_translate(msg, prompt):
 	"""
 	Translate the quoted message's text to the specified language.
@@ -495,17 +580,17 @@ def bot_translate(msg, prompt):
 
 
 @bot.message_handler(commands=['stt'])
+@dispatched(dispatcher, whitelisted(wlist))
 @prompt_required(type='audio', from_reply=True, bot=bot, config=config)
-@wlisted_only(wlist)
 def bot_stt(msg, prompt):
 	"""Transcribe the quoted message's text."""
 
 	if prompt:
 		try:
-			stt_resp = ai.stt(prompt)
+			text = transcribe(ai, prompt, config)
 			bot.send_message(
 				msg.chat.id,
-				stt_resp.text,
+				text,
 				reply_to_message_id=msg.id,
 				message_thread_id=msg.message_thread_id
 			)
@@ -515,16 +600,16 @@ def bot_stt(msg, prompt):
 
 
 @bot.message_handler(commands=['tts'])
+@dispatched(dispatcher, whitelisted(wlist))
 @prompt_required(from_reply=True)
-@wlisted_only(wlist)
 def bot_tts(msg, prompt):
 	"""Turn the quoted message's text to speech."""
 	if prompt:
 		try:
-			tts_resp = ai.tts(prompt)
+			voice = synthesize_voice(ai, prompt, config)
 			bot.send_voice(
 				msg.chat.id,
-				tts_resp,
+				voice,
 				reply_to_message_id=msg.id,
 				message_thread_id=msg.message_thread_id
 			)
@@ -534,8 +619,8 @@ def bot_tts(msg, prompt):
 
 
 @bot.message_handler(commands=['image', 'img', 'picture', 'pic'])
+@dispatched(dispatcher, whitelisted(wlist))
 @prompt_required()
-@wlisted_only(wlist)
 def bot_dalle(msg, prompt):		
 	"""Generate an image based on the prompt."""
 	if prompt:
@@ -566,48 +651,50 @@ def bot_dalle(msg, prompt):
 # Redirect them to simulate a command message.
 
 
+def is_addressed(msg):
+	"""Return True if a message was sent in a private chat or replies
+	to a bot's message."""
+	return (msg.chat.type == 'private')\
+		or bool(msg.reply_to_message and (msg.reply_to_message.from_user.id == bot.user.id))
+
+
 @bot.message_handler(content_types=['text'])
-@wlisted_only(wlist)
+@dispatched(dispatcher, is_addressed, whitelisted(wlist))
 def text_msg_event(msg):
-	if (msg.chat.type == 'private')\
-		or (msg.reply_to_message and (msg.reply_to_message.from_user.id == bot.user.id)):
-		if not msg.text.startswith('/'):
-			# Simulate a command message.
-			msg.text = f'/chat {msg.text}'
-			bot_chat(msg)
+	if not msg.text.startswith('/'):
+		# Simulate a command message.
+		msg.text = f'/chat {msg.text}'
+		bot_chat(msg)
 
 
 @bot.message_handler(content_types=['voice'])
-@wlisted_only(wlist)
+@dispatched(dispatcher, is_addressed, whitelisted(wlist))
 def msg_event(msg):
-	if (msg.chat.type == 'private')\
-		or (msg.reply_to_message and (msg.reply_to_message.from_user.id == bot.user.id)):
-		if msg.voice:
-			# Simulate a command message.
-			msg.text = '/achat'
-			# Reply to itself since /allm needs a quoted audio.
-			msg.reply_to_message = msg
-			bot_chat(msg)
+	if msg.voice:
+		# Simulate a command message.
+		msg.text = '/achat'
+		# Reply to itself since /allm needs a quoted audio.
+		msg.reply_to_message = msg
+		bot_chat(msg)
 
 
 @bot.message_handler(content_types=['photo'])
-@wlisted_only(wlist)
+@dispatched(dispatcher, is_addressed, whitelisted(wlist))
 def handle_photo(msg):
-	if (msg.chat.type == 'private')\
-		or (msg.reply_to_message and (msg.reply_to_message.from_user.id == bot.user.id)):
-		if not msg.caption.startswith('/'):
-			# Simulate a command message.
-			msg.text = f'/chat {msg.caption}'
-			# Reply to itself since bot_chat() checks for images
-			# in the quoted msg.
-			msg.reply_to_message = msg
-			bot_chat(msg)
+	if not msg.caption.startswith('/'):
+		# Simulate a command message.
+		msg.text = f'/chat {msg.caption}'
+		# Reply to itself since bot_chat() checks for images
+		# in the quoted msg.
+		msg.reply_to_message = msg
+		bot_chat(msg)
 
 
 # Misc ops.
 
 
 @bot.my_chat_member_handler()
+@dispatched(dispatcher)
 def handle_my_chat_member(msg):
 	status = msg.new_chat_member.status
 
@@ -623,7 +710,29 @@ def handle_my_chat_member(msg):
 		with Session() as ses:
 			if chat := get_chat(ses, msg.chat.id, thread_id=msg.message_thread_id):
 				ses.delete(chat)
+				invalidate_cached_context(ses, msg.chat.id, thread_id=msg.message_thread_id)
 				ses.commit()
 		
 
-bot.infinity_polling()
\ No newline at end of file
+if shard_worker:
+	# The supervisor receives the updates.
+	shard_worker.run(bot)
+elif args.webhook_url:
+	# Only request the update types the handlers use.
+	bot.set_webhook(
+		url=args.webhook_url,
+		secret_token=webhook_secret,
+		allowed_updates=ALLOWED_UPDATES
+	)
+	run_webhook_server(
+		bot,
+		args.webhook_host,
+		args.webhook_port,
+		urlparse(args.webhook_url).path or '/',
+		webhook_secret,
+		UpdateDeduplicator(max_size=config.get('webhook.dedup_size'))
+	)
+else:
+	# Polling doesn't work while a webhook is set.
+	bot.remove_webhook()
+	bot.infinity_polling(allowed_updates=ALLOWED_UPDATES)
\ No newline at end of file
@@ -1,3 +1,34 @@
 # Some AI services don't provide the tokens count for some
 # completion object types
-CHARS_PER_TOKEN = 4
\ No newline at end of file
+CHARS_PER_TOKEN = 4
+
+# Encoding used to count tokens locally
+TOKENIZER_ENCODING = 'o200k_base'
+
+# Tokens an image takes in the context per detail level. The cost of
+# high detail images depends on their size, assume a 1024x1024 one.
+IMAGE_TOKENS = {
+	'low': 85,
+	'high': 765,
+	'auto': 765,
+}
+
+# Sizes, in pixels, images are scaled to by the vision models. Low
+# detail images fit in a square, high detail ones fit in a square and
+# then get their shortest side scaled down.
+VISION_LOW_DETAIL_SIZE = 512
+VISION_HIGH_DETAIL_MAX_SIZE = 2048
+VISION_HIGH_DETAIL_SHORT_SIDE = 768
+
+# Audio sent to the speech-to-text models. Speech is transcribed at
+# 16 kHz, higher sample rates only take more bandwidth.
+STT_SAMPLE_RATE = 16000
+STT_BITRATE = '24k'
+
+# Sample rate of the raw PCM audio returned by the Text-to-Speech API
+# (16-bit, mono).
+TTS_PCM_SAMPLE_RATE = 24000
+TTS_BITRATE = '32k'
+
+# Tokens taken by the formatting of each message in the context
+MSG_OVERHEAD_TOKENS = 4
\ No newline at end of file
@@ -1,2 +1,49 @@
 # Max requests/m for `sendMessageDraft`
-MAX_DRAFT_REQS_PER_MIN = 20
\ No newline at end of file
+MAX_DRAFT_REQS_PER_MIN = 20
+
+# Max requests/s for sending or editing messages, in all chats and in
+# a private chat
+MAX_MSG_REQS_PER_SEC = 30
+MAX_CHAT_MSG_REQS_PER_SEC = 1
+
+# Max requests/m for sending or editing messages in a group
+MAX_GROUP_MSG_REQS_PER_MIN = 20
+
+# Max requests sent at once to a chat before its rate limit applies
+MAX_CHAT_MSG_BURST = 3
+
+# Max times to retry a request Telegram rate limited
+MAX_RATE_LIMITED_RETRIES = 3
+
+# Max length of a message's text
+MAX_MSG_LEN = 4096
+
+# Length at which a reply streamed by editing a message continues in a
+# new message at the next line outside code blocks, and max length of
+# the formatted text of its messages, past which it continues anyway
+STREAM_MSG_SOFT_MAX_CHARS = 3000
+STREAM_MSG_MAX_CHARS = MAX_MSG_LEN
+
+# Min new characters worth editing a streamed message for, edits are
+# delayed at most the max interval (in seconds) waiting for them
+STREAM_EDIT_MIN_CHARS = 200
+STREAM_EDIT_MAX_INTERVAL = 10
+
+# Max seconds to wait for when editing a streamed message is rate
+# limited, the reply is only sent once complete past them
+STREAM_EDIT_MAX_RETRY_AFTER = 10
+
+# Text of the message a streamed reply is edited into
+STREAM_PLACEHOLDER = '…'
+
+# Short description of the bot shown in the bot's profile and on /start
+BOT_SHORT_DESCR = "I'm a bot that lets you use various AI models."
+
+# Update types the handlers use, others are not requested to Telegram
+ALLOWED_UPDATES = ['message', 'my_chat_member']
+
+# Size of the chunks files are downloaded in
+DOWNLOAD_CHUNK_BYTES = 64 * 2**10
+
+# Downloaded files larger than this are kept on disk instead of memory
+DOWNLOAD_SPOOL_MAX_BYTES = 2**20
\ No newline at end of file
@@ -2,35 +2,72 @@
 # more control.
 
 import os
+import inspect
 
-from utils.prompt import get_prompt
+from utils.prompt import get_prompt, aget_prompt
+from utils.chat import get_chat_key
 
 
 
+def make_awaitable(wrapper, func):
+	"""Turn a decorator's wrapper into a coroutine function if the
+	decorated function is one, so that async handlers are still
+	recognized as such."""
+
+	if inspect.iscoroutinefunction(func):
+		async def async_wrapper(*args, **kwargs):
+			result = wrapper(*args, **kwargs)
+			# The wrapper may skip calling the decorated function.
+			if inspect.isawaitable(result):
+				result = await result
+			return result
+		return async_wrapper
+
+	return wrapper
+
+
+def from_admin(msg):
+	"""Return True if the message sender is the software
+	administrator."""
+	if msg.from_user.id == int(os.environ['TELEGRAM_ADMIN_ID']):
+		return True
+	print(f'ERROR - Not an admin [{msg.from_user.id} ({msg.from_user.username})].')
+	return False
+
+
+def whitelisted(wlist_man):
+	"""Return a function telling if the sender or the chat of a
+	message is whitelisted."""
+
+	def check(msg):
+		if wlist_man.can_use_bot(msg.chat.id, msg.from_user.id):
+			return True
+		print(f'ERROR - User/Chat not allowed [User: {msg.from_user.id}] [Chat: {msg.chat.id}].')
+		return False
+	return check
+
+
 def admin_only(func):
 	"""Handle a Telegram bot event only if the message sender is the
 	software administrator."""
 
 	def wrapper(msg, *args, **kwargs):
-		if msg.from_user.id == int(os.environ['TELEGRAM_ADMIN_ID']):
+		if from_admin(msg):
 			return func(msg, *args, **kwargs)
-		else:
-			print(f'ERROR - Not an admin [{msg.from_user.id} ({msg.from_user.username})].')
-	return wrapper
+	return make_awaitable(wrapper, func)
 
 
 def wlisted_only(wlist_man):
 	"""Handle a Telegram bot event only if the message sender or the
 	chat is whitelisted."""
 
+	check = whitelisted(wlist_man)
+
 	def decorator(func):
 		def wrapper(msg, *args, **kwargs):
-			if wlist_man.can_use_bot(msg.chat.id)\
-				or wlist_man.can_use_bot(msg.from_user.id):
+			if check(msg):
 				return func(msg, *args, **kwargs)
-			else:
-				print(f'ERROR - User/Chat not allowed [User: {msg.from_user.id}] [Chat: {msg.chat.id}].')
-		return wrapper
+		return make_awaitable(wrapper, func)
 	return decorator
 
 
@@ -48,6 +85,12 @@ def prompt_required(type='text', from_reply=False, bot=None, ai=None, config=Non
 	"""
 
 	def decor(func):
+		if inspect.iscoroutinefunction(func):
+			async def async_wrapper(msg, *args, **kwargs):
+				prompt = await aget_prompt(msg, type=type, from_reply=from_reply, bot=bot, ai=ai, config=config)
+				return await func(msg, prompt, *args, **kwargs)
+			return async_wrapper
+
 		def wrapper(msg, *args, **kwargs):
 			prompt = get_prompt(msg, type=type, from_reply=from_reply, bot=bot, ai=ai, config=config)
 			return func(msg, prompt, *args, **kwargs)
@@ -69,4 +112,50 @@ def split_cmd(func):
 			cmd_args = split_command[1]
 
 		return func(msg, cmd, cmd_args, *args, **kwargs)
-	return wrapper
\ No newline at end of file
+	return make_awaitable(wrapper, func)
+
+
+def dispatched(dispatcher, *checks, priority=False):
+	"""
+	Run a Telegram bot event handler through a chat dispatcher instead
+	of the thread that received the update, so that the messages of a
+	chat are handled one at a time and in order.
+	This decorator must be the outermost one.
+
+	The checks run before the message is queued, so that the messages
+	the handler ignores, e.g. from users that aren't whitelisted, don't
+	take room in the chats' queues. They don't run again when a handler
+	redirects a message it accepted to another handler.
+	
+	Args:
+		dispatcher:		Chat dispatcher.
+		checks:			Functions taking the message and returning
+						False if the handler ignores it, run in the
+						thread receiving the updates so they must be
+						quick.
+		priority:		If True, the handler will skip the chats' queues.
+	"""
+
+	def accepts(msg):
+		return all(check(msg) for check in checks)
+
+	def decor(func):
+		if inspect.iscoroutinefunction(func):
+			async def async_wrapper(msg, *args, **kwargs):
+				key = get_chat_key(msg)
+				if dispatcher.in_chat(key):
+					# Handlers redirecting to other handlers.
+					return await func(msg, *args, **kwargs)
+				if accepts(msg):
+					dispatcher.submit(key, func, msg, *args, priority=priority, **kwargs)
+			return async_wrapper
+
+		def wrapper(msg, *args, **kwargs):
+			key = get_chat_key(msg)
+			if dispatcher.in_chat(key):
+				# Handlers redirecting to other handlers.
+				return func(msg, *args, **kwargs)
+			if accepts(msg):
+				dispatcher.submit(key, func, msg, *args, priority=priority, **kwargs)
+		return wrapper
+	return decor
\ No newline at end of file
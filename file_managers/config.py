@@ -1,6 +1,72 @@
-import json
 import os
+import copy
+import json
+import atexit
+import threading
+
+from file_managers.watcher import get_file_version, write_file
+
+
+
+# Seconds changes are gathered for before being saved at once.
+SAVE_DELAY_S = 0.5
+
+
+class ConfigSnapshot:
+    """
+    An immutable state of a configuration, with the values it resolves
+    cached by key path.
+
+    Args:
+        config:         Configuration dictionary, never modified.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._cache = {}
+
+
+    def get(self, key_path, sep='.'):
+        """
+        Get the value assigned to a nested dictionary present in the
+        configuration. Dictionaries and lists are returned as copies,
+        so that changing them doesn't change the snapshot.
+
+        Args:
+            key_path:       Path to the nested dictionary endpoint.
+            sep:            Key separator in the key path.
+        """
+        try:
+            value = self._cache[key_path, sep]
+        except KeyError:
+            d, k = get_nested_dict(self.config, key_path, sep=sep)
+            # Concurrent readers may resolve it too, either value is fine.
+            value = self._cache[key_path, sep] = d[k]
 
+        if isinstance(value, (dict, list)):
+            # The snapshot is shared by every reader.
+            return copy.deepcopy(value)
+        return value
+
+
+def get_nested_dict(d, key_path, sep='.'):
+    """
+        Return the nested dictionary and key that reference the
+        endpoint of a path in a dictionary.
+
+        Args:
+            d:          Dictionary.
+            key_path:   Path to the nested dictionary endpoint.
+            sep:        Key separator in the key path.
+    """
+    keys = key_path.split(sep)
+    for k in keys[:-1]:
+        d = d[k]
+    k = keys[-1]
+    if k not in d:
+        raise KeyError(k)
+
+    return d, keys[-1]
 
 
 class ConfigurationManager:
@@ -14,6 +80,10 @@ class ConfigurationManager:
     otherwise the default version will be loaded instead.
     Whenever a change occurs the configuration will be saved to
     the non-default version of the file.
+
+    Readers never lock, they get values from an immutable snapshot of
+    the configuration, which changes replace at once. Changes made
+    within a short time are saved together, replacing the file at once.
     """
 
     def __init__(self, config_path):
@@ -27,11 +97,34 @@ class ConfigurationManager:
         # Load the config file. Load the default version if no custom
         # config file is present.
         self.config_path = config_path
-        self.config = []
+        # Version of the file as last loaded or saved.
+        self._version = get_file_version(config_path)
+        config = []
         if os.path.exists(config_path):
-            self.config = self._load_config()
+            config = self._load_config()
+            if os.path.exists(self.default_config_path):
+                # Settings added after the file was saved.
+                self._fill_missing(config, self.default_config)
         else:
-            self.config = self._load_default_config()
+            config = self._load_default_config()
+        self._snapshot = ConfigSnapshot(config)
+
+        self._lock = threading.Lock()
+        self._save_timer = None
+        # Don't lose the pending changes on exit.
+        atexit.register(self.flush)
+
+
+    @property
+    def config(self):
+        return self._snapshot.config
+
+
+    def snapshot(self):
+        """Return the current state of the configuration, which
+        doesn't change, e.g. to read it consistently while handling an
+        update."""
+        return self._snapshot
 
 
     def _load_default_config(self):
@@ -44,29 +137,72 @@ class ConfigurationManager:
             return json.load(file)
 
 
-    def _save_config(self):
-        with open(self.config_path, 'w') as file:
-            json.dump(self.config, file, indent=4, sort_keys=True)
-
+    def _fill_missing(self, d, default_d):
+        """Copy the keys of a default dictionary missing in a
+        dictionary, recursively."""
+        for k, v in default_d.items():
+            if k not in d:
+                d[k] = v
+            elif isinstance(v, dict) and isinstance(d[k], dict):
+                self._fill_missing(d[k], v)
 
-    def _get_nested_dict(self, d, key_path, sep='.'):
-        """
-            Return the nested dictionary and key that reference the
-            endpoint of a path in a dictionary.
 
-            Args:
-                d:          Dictionary.
-                key_path:   Path to the nested dictionary endpoint.
-                sep:        Key separator in the key path.
-        """
-        keys = key_path.split(sep)
-        for k in keys[:-1]:
-            d = d[k]
-        k = keys[-1]
-        if k not in d:
-            raise KeyError(k)
-        
-        return d, keys[-1]
+    def _save_config(self):
+        """Save the configuration shortly, along with the changes made
+        meanwhile."""
+        with self._lock:
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(SAVE_DELAY_S, self.flush)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+
+    def flush(self):
+        """Save the pending changes now."""
+        with self._lock:
+            if self._save_timer is None:
+                return
+            self._save_timer.cancel()
+            self._save_timer = None
+            config = self.config
+            self._version = write_file(
+                self.config_path,
+                lambda file: json.dump(config, file, indent=4, sort_keys=True)
+            )
+
+
+    def reload_if_changed(self):
+        """Load the configuration again if its file was modified since
+        last loaded or saved, return True if it was."""
+        with self._lock:
+            version = get_file_version(self.config_path)
+            if version is None or version == self._version:
+                return False
+            if self._save_timer is not None:
+                # The changes about to be saved win.
+                return False
+
+            # Don't try again until modified, e.g. if it's invalid.
+            self._version = version
+            config = self._load_config()
+            if os.path.exists(self.default_config_path):
+                self._fill_missing(config, self.default_config)
+            self._snapshot = ConfigSnapshot(config)
+            return True
+
+
+    def _update(self, key_path, sep, get_value):
+        """Replace the configuration with a copy where the value at a
+        key path is set to the one returned by a function taking the
+        nested dictionary and key."""
+        # Apply it on top of the changes made by others.
+        self.reload_if_changed()
+        with self._lock:
+            config = copy.deepcopy(self.config)
+            d, k = get_nested_dict(config, key_path, sep=sep)
+            d[k] = get_value(d, k)
+            self._snapshot = ConfigSnapshot(config)
+        self._save_config()
 
 
     def set(self, key_path, value, sep='.', match_type=False):
@@ -81,9 +217,11 @@ class ConfigurationManager:
             match_type:     If True, the value will be casted to the
                             original value's type.
         """
-        d, k = self._get_nested_dict(self.config, key_path, sep=sep)
-        d[k] = type(d[k])(json.loads(value)) if match_type else value
-        self._save_config()
+        self._update(
+            key_path,
+            sep,
+            lambda d, k: type(d[k])(json.loads(value)) if match_type else value
+        )
 
 
     def reset(self, key_path, sep='.'):
@@ -95,10 +233,8 @@ class ConfigurationManager:
             key_path:       Path to the nested dictionary endpoint.
             sep:            Key separator in the key path.
         """
-        d, k = self._get_nested_dict(self.config, key_path, sep=sep)
-        default_d, k = self._get_nested_dict(self.default_config, key_path, sep=sep)
-        d[k] = default_d[k]
-        self._save_config()
+        default_d, default_k = get_nested_dict(self.default_config, key_path, sep=sep)
+        self._update(key_path, sep, lambda d, k: copy.deepcopy(default_d[default_k]))
 
 
     def get(self, key_path, sep='.'):
@@ -110,8 +246,7 @@ class ConfigurationManager:
             key_path:       Path to the nested dictionary endpoint.
             sep:            Key separator in the key path.
         """
-        d, k = self._get_nested_dict(self.config, key_path, sep=sep)
-        return d[k]
+        return self._snapshot.get(key_path, sep=sep)
     
 
     def to_json(self, *args, **kwargs):
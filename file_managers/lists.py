@@ -1,44 +1,89 @@
 import os
+import threading
+
+from file_managers.watcher import get_file_version, write_file
 
 
 
 class ListManager:
     """
     A manager to handle a newline-separated list in a file.
+
+    The ids are kept in a set, and the file is loaded again by
+    reload_if_changed() once modified by someone else.
     """
 
     def __init__(self, list_path):
         self.list_path = list_path
-        self.list = []
+        self.ids = set()
+        self._lock = threading.Lock()
+        # Version of the file as last loaded or saved.
+        self._version = None
         if os.path.exists(list_path):
             self._load_list()
 
 
     def _load_list(self):
+        self._version = get_file_version(self.list_path)
         with open(self.list_path) as file:
-            self.list = [int(id) for id in file.readlines()]
+            ids = {int(id) for id in file if id.strip()}
+        # Readers may check the ids meanwhile, swap them at once.
+        self.ids = ids
 
 
     def _save_list(self):
-        self.list.sort()
-        with open(self.list_path, 'w') as file:
-            file.writelines([f'{id}\n' for id in self.list])
+        self._version = write_file(
+            self.list_path,
+            lambda file: file.writelines([f'{id}\n' for id in sorted(self.ids)])
+        )
+
+
+    def _reload_if_changed(self):
+        version = get_file_version(self.list_path)
+        if version == self._version:
+            return False
+
+        if version is None:
+            # Removed, as if it never existed.
+            self.ids = set()
+            self._version = None
+        else:
+            self._load_list()
+        return True
+
+
+    def reload_if_changed(self):
+        """Load the file again if modified since last loaded or saved,
+        return True if it was."""
+        with self._lock:
+            return self._reload_if_changed()
+
+
+    @property
+    def list(self):
+        with self._lock:
+            return sorted(self.ids)
 
 
     def add(self, id):
-        if id not in self.list:
-            self.list.append(id)
-            self._save_list()
+        with self._lock:
+            # Apply it on top of the changes made by others.
+            self._reload_if_changed()
+            if id not in self.ids:
+                self.ids.add(id)
+                self._save_list()
 
 
     def remove(self, id):
-        if id in self.list:
-            self.list.remove(id)
-            self._save_list()
+        with self._lock:
+            self._reload_if_changed()
+            if id in self.ids:
+                self.ids.remove(id)
+                self._save_list()
 
 
     def has(self, id):
-        return id in self.list
+        return id in self.ids
     
 
 class TelegramWhitelistManager(ListManager):
@@ -47,7 +92,14 @@ class TelegramWhitelistManager(ListManager):
     user or chat ids.
     """
 
-    def can_use_bot(self, id):
+    def __init__(self, list_path):
+        super().__init__(list_path)
+        self.admin_id = int(os.environ['TELEGRAM_ADMIN_ID'])
+
+
+    def can_use_bot(self, *ids):
+        """Return True if any of the ids is the admin's or
+        whitelisted."""
         # There's no risk of id clashing, user ids are positive
         # while chat ones are negative.
-        return id in [int(os.environ['TELEGRAM_ADMIN_ID'])] + self.list
\ No newline at end of file
+        return any(id == self.admin_id or id in self.ids for id in ids)
\ No newline at end of file
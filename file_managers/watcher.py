@@ -0,0 +1,100 @@
+import os
+import signal
+import tempfile
+import threading
+
+
+
+def get_file_version(path):
+    """Return what identifies the current content of a file, which
+    changes once written or replaced, or None if it doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def write_file(path, write):
+    """
+    Write a file by replacing it with a temporary one, so that other
+    processes never read it half-written.
+
+    Args:
+        path:           File path.
+        write:          Callable writing the content to a text file.
+
+    Returns:
+        The version of the written file, see get_file_version().
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'w') as file:
+            write(file)
+            file.flush()
+            # The replaced file keeps it.
+            stat = os.fstat(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+class FileWatcher:
+    """
+    A watcher to load files again once modified, e.g. by hand or by
+    another bot process sharing them, without restarting.
+
+    The files of the watched managers are checked from a background
+    thread every few seconds, or at once on SIGHUP where supported.
+    Managers must have a reload_if_changed() method.
+
+    Args:
+        interval_s:     Seconds between checks.
+    """
+
+    def __init__(self, interval_s):
+        self.interval_s = interval_s
+        self.managers = []
+        self._event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+
+    def watch(self, manager, name):
+        """Watch the file of a manager, its name is used in logs."""
+        self.managers.append((manager, name))
+
+
+    def check(self):
+        """Load the modified files again."""
+        for manager, name in self.managers:
+            try:
+                if manager.reload_if_changed():
+                    print(f'{name} reloaded')
+            except Exception as e:
+                # Likely being written, try again later.
+                print(f'WARNING - {name} could not be reloaded: {e}')
+
+
+    def wake(self):
+        """Check the files at once."""
+        self._event.set()
+
+
+    def start(self):
+        self._thread.start()
+        if hasattr(signal, 'SIGHUP'):
+            # The handler runs on the main thread, leave the work to
+            # the watcher's.
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.wake())
+
+
+    def _run(self):
+        while True:
+            self._event.wait(self.interval_s)
+            self._event.clear()
+            self.check()
\ No newline at end of file
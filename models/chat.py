@@ -1,9 +1,11 @@
 import enum
 
-from sqlalchemy import Enum, Column, BigInteger, ForeignKeyConstraint, String, DateTime, JSON, text
+from sqlalchemy import Enum, Column, BigInteger, Integer, ForeignKey, ForeignKeyConstraint, Index, String, DateTime, JSON, LargeBinary, Table, text
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import relationship
 
+from ai.tokens import count_msg_tokens
+
 
 
 Base = declarative_base()
@@ -33,6 +35,9 @@ class Chat(Base):
     # a string for simplicity.
     sys_msg = Column(String, nullable=True)
     last_msg_at = Column(DateTime(timezone=True), nullable=True)
+    # Number of stored messages, kept to avoid counting them on every
+    # insert. None for chats created before it was introduced.
+    msg_count = Column(Integer, nullable=True)
     
     # Set 'lazy' to 'dynamic' to enable the use of queries.
     messages = relationship(
@@ -48,37 +53,78 @@ class Chat(Base):
         return self.thread_id or None
 
 
-    def get_context(self, max_items=None):
-        """Return a list of messages to pass to the AI as context."""
-        msgs = []
+    def get_recent_messages(self, max_items):
+        """Return a query for the newest messages, which are the ones
+        that may be in the context."""
+        return self.messages.order_by(Message.id.desc()).limit(max_items)
+
 
-        if self.sys_msg:
-            # Push the system message.
-            msgs.append({
-                'role': 'system',
-                'content': self.sys_msg
-            })
+    def get_context(self, max_items=None, max_tokens=None):
+        """
+        Return a list of messages to pass to the AI as context.
 
+        Args:
+            max_items:      Max number of messages.
+            max_tokens:     Token budget for the whole context, the
+                            newest message is always included.
+        """
         # Get the messages from newest to oldest so that a
         # context limit can be applied.
         # NOTE: Telegram gives incremental ids to messages.
         q = self.messages.order_by(Message.id.desc())
         q = q.limit(max_items) if max_items else q
-        # Push assistant and user messages.
-        # Flip the list for ascended order.
-        for msg in q.all()[::-1]:
-            msgs.append({
-                'name': f'@{msg.user_name}',
-                'role': msg.role.name,
-                'content': msg.content
-            })
-
-        return msgs
+        return build_context(self.sys_msg, q.yield_per(50), max_tokens)
 
 
     def erase(self):
         """Delete all the messages."""
         self.messages.delete(synchronize_session=False)
+        self.msg_count = 0
+
+
+
+def build_context(sys_msg, msgs, max_tokens=None):
+    """
+    Return a list of messages to pass to the AI as context.
+
+    Args:
+        sys_msg:        System message.
+        msgs:           Messages, or objects with the same attributes,
+                        from newest to oldest.
+        max_tokens:     Token budget for the whole context, the
+                        newest message is always included.
+    """
+    ctx_msgs = []
+    tokens = 0
+
+    if sys_msg:
+        tokens += count_msg_tokens(sys_msg)
+
+    # Push assistant and user messages, stop when the budget is
+    # exceeded. Stored counts avoid tokenizing the history again.
+    for msg in msgs:
+        msg_tokens = msg.tokens
+        if msg_tokens is None:
+            msg_tokens = count_msg_tokens(msg.content)
+        tokens += msg_tokens
+        if ctx_msgs and max_tokens and tokens > max_tokens:
+            break
+
+        ctx_msgs.append({
+            'name': f'@{msg.user_name}',
+            'role': msg.role.name,
+            'content': msg.content
+        })
+
+    if sys_msg:
+        # Push the system message.
+        ctx_msgs.append({
+            'role': 'system',
+            'content': sys_msg
+        })
+
+    # Flip the list for ascended order.
+    return ctx_msgs[::-1]
 
 
 
@@ -94,6 +140,8 @@ class Message(Base):
     user_name = Column(String, nullable=True)
     role = Column(msg_role_enum, nullable=False)
     content = Column(JSON)
+    # Tokens the message takes in the context, counted when added.
+    tokens = Column(Integer, nullable=True)
 
     chat_id = Column(BigInteger, nullable=False)
     thread_id = Column(BigInteger, nullable=False, server_default=text("0"))
@@ -107,4 +155,37 @@ class Message(Base):
             name='fk_messages_chat_thread',
             ondelete="CASCADE",
         ),
-    )
\ No newline at end of file
+        # Context queries fetch a chat's messages by descending id.
+        Index('ix_messages_chat_thread_id', 'chat_id', 'thread_id', 'id'),
+    )
+
+
+
+class Blob(Base):
+    """Media referenced by messages, stored once however many messages
+    reference it."""
+    __tablename__ = 'blobs'
+
+    # SHA-256 hex digest of the data.
+    sha256 = Column(String(64), primary_key=True)
+    content_type = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+
+# Blobs referenced by each message, used to find the orphan ones.
+message_blobs = Table(
+    'message_blobs',
+    Base.metadata,
+    Column('message_id', BigInteger, ForeignKey('messages.id', ondelete='CASCADE'), primary_key=True),
+    Column('blob_sha256', String(64), ForeignKey('blobs.sha256'), primary_key=True),
+    Index('ix_message_blobs_blob_sha256', 'blob_sha256'),
+)
+
+
+# Data migrations applied to the database, see run_migration().
+migrations = Table(
+    'migrations',
+    Base.metadata,
+    Column('name', String(64), primary_key=True),
+    Column('applied_at', DateTime(timezone=True), nullable=False),
+)
\ No newline at end of file
@@ -0,0 +1,10 @@
+import os
+import sys
+
+
+
+# The tests import the bot's modules from the repository's root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Read by the whitelist and the admin_only decorator.
+os.environ.setdefault('TELEGRAM_ADMIN_ID', '1')
\ No newline at end of file
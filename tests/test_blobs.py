@@ -0,0 +1,133 @@
+import os
+import time
+
+import pytest
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from models.chat import Base, Blob, Message, MessageRole, Chat
+from utils.blobs import add_blob, get_blob_url, link_content_blobs, migrate_data_urls, new_blob, resolve_blob_urls
+from utils.db import run_migration
+from utils.media import build_data_url
+
+
+# Chats sent the same image, e.g. a forwarded one, by the benchmark.
+SHARED_IMAGE_CHATS = 50
+SHARED_IMAGE_SIZE = 100_000
+
+
+
+@pytest.fixture
+def Session(tmp_path):
+	engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+	Base.metadata.create_all(engine)
+	yield sessionmaker(bind=engine)
+	engine.dispose()
+
+
+def count_blobs(ses):
+	return ses.scalar(select(func.count()).select_from(Blob))
+
+
+def test_blob_stored_once(Session):
+	blob = new_blob(b'data', 'image/webp')
+	with Session() as ses:
+		assert add_blob(ses, blob) == get_blob_url(blob.sha256)
+		assert add_blob(ses, new_blob(b'data', 'image/webp')) == get_blob_url(blob.sha256)
+		ses.commit()
+
+	with Session() as ses:
+		add_blob(ses, new_blob(b'data', 'image/webp'))
+		ses.commit()
+		assert count_blobs(ses) == 1
+
+
+def test_blob_stored_by_another_session(Session):
+	first, second = Session(), Session()
+	try:
+		# The second session started before the blob was stored.
+		count_blobs(second)
+		add_blob(first, new_blob(b'data', 'image/webp'))
+		first.commit()
+		add_blob(second, new_blob(b'data', 'image/webp'))
+		second.commit()
+	finally:
+		first.close()
+		second.close()
+
+	with Session() as ses:
+		assert count_blobs(ses) == 1
+
+
+def test_migration_runs_once(Session):
+	runs = []
+	for _ in range(2):
+		with Session() as ses:
+			run_migration(ses, 'test', runs.append)
+			ses.commit()
+	assert len(runs) == 1
+
+
+def test_data_urls_moved_to_blobs(Session):
+	url = build_data_url('image/webp', b'data')
+	with Session() as ses:
+		ses.add(Chat(id=1, thread_id=0))
+		ses.add(Message(id=1, chat_id=1, thread_id=0, role=MessageRole.user, content=[
+			{'type': 'image_url', 'image_url': {'url': url}},
+		]))
+		ses.commit()
+
+	with Session() as ses:
+		migrate_data_urls(ses)
+		ses.commit()
+
+	with Session() as ses:
+		content = ses.get(Message, 1).content
+		assert content[0]['image_url']['url'] == get_blob_url(new_blob(b'data', 'image/webp').sha256)
+		assert count_blobs(ses) == 1
+
+
+def store_shared_image(path, as_blob):
+	"""Store a message with the same image in every chat, as a blob or
+	as a data-URL, return the size of the database and the seconds
+	taken to build the chats' contexts."""
+	engine = create_engine(f'sqlite:///{path}')
+	Base.metadata.create_all(engine)
+	Session = sessionmaker(bind=engine)
+	blob = new_blob(os.urandom(SHARED_IMAGE_SIZE), 'image/webp')
+
+	with Session() as ses:
+		for chat_id in range(SHARED_IMAGE_CHATS):
+			url = add_blob(ses, blob) if as_blob else build_data_url(blob.content_type, blob.data)
+			content = [
+				{'type': 'text', 'text': 'Look'},
+				{'type': 'image_url', 'image_url': {'url': url}},
+			]
+			ses.add(Chat(id=chat_id, thread_id=0))
+			ses.add(Message(id=chat_id, chat_id=chat_id, thread_id=0, role=MessageRole.user, content=content))
+			link_content_blobs(ses, chat_id, content)
+		ses.commit()
+
+	start = time.perf_counter()
+	with Session() as ses:
+		for chat_id in range(SHARED_IMAGE_CHATS):
+			ctx = resolve_blob_urls(ses, ses.get(Chat, (chat_id, 0)).get_context())
+			assert ctx[-1]['content'][1]['image_url']['url'].startswith('data:')
+	elapsed = time.perf_counter() - start
+
+	engine.dispose()
+	return os.path.getsize(path), elapsed
+
+
+def test_shared_image_stored_once(tmp_path):
+	blob_size, blob_s = store_shared_image(tmp_path / 'blobs.db', as_blob=True)
+	inline_size, inline_s = store_shared_image(tmp_path / 'inline.db', as_blob=False)
+	print(
+		f'{SHARED_IMAGE_CHATS} chats: {blob_size / 2**20:.2f} MiB with blobs, '
+		f'{inline_size / 2**20:.2f} MiB with data-URLs, '
+		f'context built in {blob_s * 1000:.1f} ms with blobs, {inline_s * 1000:.1f} ms with data-URLs'
+	)
+
+	# One copy of the image, instead of one base64 copy per chat.
+	assert blob_size < 2 * SHARED_IMAGE_SIZE
+	assert inline_size > SHARED_IMAGE_CHATS * SHARED_IMAGE_SIZE
\ No newline at end of file
@@ -0,0 +1,230 @@
+import os
+import time
+
+import pytest
+from sqlalchemy import create_engine, event, insert, select
+from sqlalchemy.orm import sessionmaker
+
+from models.chat import Base, Chat, Message, MessageRole
+from file_managers.config import ConfigSnapshot
+from utils.chat import add_msg, get_cached_context
+from utils.context_cache import context_cache
+from utils.metrics import metrics
+# Importing it registers the database engine events.
+import utils.db
+
+
+
+CHAT_ID = -100
+
+# Chats stored in the benchmark's database, of which some are written
+# to, each message in a new session like the handlers do.
+BENCH_CHATS = 10_000
+BENCH_ACTIVE_CHATS = 50
+BENCH_MSGS_PER_CHAT = 10
+
+config = ConfigSnapshot({
+	'chat': {
+		'default_sys_msg': 'System',
+		'max_msgs': 3,
+		'trim_interval': 2,
+	},
+})
+
+
+@pytest.fixture
+def Session():
+	engine = create_engine('sqlite://')
+	Base.metadata.create_all(engine)
+	context_cache.clear()
+	yield sessionmaker(bind=engine)
+	context_cache.clear()
+
+
+def add_msgs(Session, ids):
+	for id in ids:
+		with Session() as ses:
+			add_msg(ses, id, 'user', CHAT_ID, config, f'Message {id}', role=MessageRole.user)
+			ses.commit()
+
+
+def get_stored_ids(ses):
+	return ses.scalars(select(Message.id).where(Message.chat_id == CHAT_ID).order_by(Message.id)).all()
+
+
+def test_history_trimmed_in_bulk(Session):
+	# Up to max_msgs + trim_interval messages are kept.
+	add_msgs(Session, range(1, 6))
+	with Session() as ses:
+		assert get_stored_ids(ses) == [1, 2, 3, 4, 5]
+		assert ses.get(Chat, (CHAT_ID, 0)).msg_count == 5
+
+	# Then the older ones are deleted at once.
+	add_msgs(Session, [6])
+	with Session() as ses:
+		assert get_stored_ids(ses) == [4, 5, 6]
+		assert ses.get(Chat, (CHAT_ID, 0)).msg_count == 3
+
+
+def test_recent_messages_match_context(Session):
+	# Messages past max_msgs are kept until trimmed, but /oldmsg and
+	# /cansee only look at the ones that may be in the context.
+	add_msgs(Session, range(1, 6))
+	with Session() as ses:
+		chat = ses.get(Chat, (CHAT_ID, 0))
+		recent_ids = [msg.id for msg in chat.get_recent_messages(config.get('chat.max_msgs'))]
+		ctx = get_cached_context(ses, CHAT_ID, config)
+		assert recent_ids == [5, 4, 3]
+		assert sorted(recent_ids) == [msg.id for msg in ctx.messages]
+
+
+def test_cached_context_holds_newest_messages(Session):
+	add_msgs(Session, range(1, 10))
+	with Session() as ses:
+		ctx = get_cached_context(ses, CHAT_ID, config)
+		assert [msg.id for msg in ctx.messages] == [7, 8, 9]
+		assert ctx.msg_count == ses.get(Chat, (CHAT_ID, 0)).msg_count
+
+
+def test_context_loaded_from_database(Session):
+	add_msgs(Session, range(1, 5))
+	context_cache.clear()
+	with Session() as ses:
+		ctx = get_cached_context(ses, CHAT_ID, config)
+		assert [msg.id for msg in ctx.messages] == [2, 3, 4]
+		assert ctx.msg_count == 4
+
+def add_msgs_elsewhere(Session, ids):
+	"""Add messages like another process would, without this process'
+	cache knowing."""
+	with Session() as ses:
+		for id in ids:
+			ses.add(Message(id=id, user_name='user', chat_id=CHAT_ID, thread_id=0, role=MessageRole.user, content=f'Message {id}'))
+		ses.get(Chat, (CHAT_ID, 0)).msg_count += len(ids)
+		ses.commit()
+
+
+def add_msg_counting(ses, id, chat_id, content):
+	"""Add a message as before the bulk trimming, counting the chat's
+	messages and deleting the oldest one on every insert."""
+	chat = ses.get(Chat, (chat_id, 0))
+	ses.add(Message(id=id, user_name='user', chat_id=chat_id, thread_id=0, role=MessageRole.user, content=content))
+	ses.flush()
+	if chat.messages.count() > config.get('chat.max_msgs'):
+		ses.delete(chat.messages.order_by(Message.id).first())
+
+
+def make_bench_db(path):
+	"""Create a database of BENCH_CHATS chats with full histories,
+	return its session factory."""
+	engine = create_engine(f'sqlite:///{path}')
+	Base.metadata.create_all(engine)
+	max_msgs = config.get('chat.max_msgs')
+	with engine.begin() as conn:
+		conn.execute(insert(Chat), [
+			{'id': chat_id, 'thread_id': 0, 'msg_count': max_msgs}
+			for chat_id in range(BENCH_CHATS)
+		])
+		conn.execute(insert(Message), [
+			{
+				'id': chat_id * max_msgs + i,
+				'user_name': 'user',
+				'chat_id': chat_id,
+				'thread_id': 0,
+				'role': MessageRole.user,
+				'content': f'Message {i}',
+			}
+			for chat_id in range(BENCH_CHATS)
+			for i in range(max_msgs)
+		])
+	return engine, sessionmaker(bind=engine)
+
+
+def write_bench_msgs(engine, Session, add):
+	"""Write to the active chats, return the seconds and the statements
+	per message."""
+	statements = []
+	event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+	first_id = BENCH_CHATS * config.get('chat.max_msgs')
+	count = BENCH_MSGS_PER_CHAT * BENCH_ACTIVE_CHATS
+	start = time.perf_counter()
+	for i in range(count):
+		with Session() as ses:
+			add(ses, first_id + i, i % BENCH_ACTIVE_CHATS, f'Message {i}')
+			ses.commit()
+	return (time.perf_counter() - start) / count, len(statements) / count
+
+
+def test_insert_cost_among_many_chats(tmp_path):
+	engine, Session = make_bench_db(tmp_path / 'counting.db')
+	counting_s, counting_statements = write_bench_msgs(engine, Session, add_msg_counting)
+	engine.dispose()
+	counting_size = os.path.getsize(tmp_path / 'counting.db')
+
+	engine, Session = make_bench_db(tmp_path / 'bulk.db')
+	bulk_s, bulk_statements = write_bench_msgs(
+		engine,
+		Session,
+		lambda ses, id, chat_id, content: add_msg(ses, id, 'user', chat_id, config, content)
+	)
+	# Contexts kept along the inserts, then loaded from the trimmed
+	# histories.
+	context_s = []
+	for _ in range(2):
+		start = time.perf_counter()
+		with Session() as ses:
+			for chat_id in range(BENCH_ACTIVE_CHATS):
+				assert len(get_cached_context(ses, chat_id, config).messages) == config.get('chat.max_msgs')
+		context_s.append((time.perf_counter() - start) / BENCH_ACTIVE_CHATS)
+		context_cache.clear()
+	engine.dispose()
+	bulk_size = os.path.getsize(tmp_path / 'bulk.db')
+
+	print(
+		f'Insert among {BENCH_CHATS} chats: {counting_s * 1000:.2f} ms and {counting_statements:.1f} statements counting, '
+		f'{bulk_s * 1000:.2f} ms and {bulk_statements:.1f} statements trimming in bulk; '
+		f'database: {counting_size / 2**20:.1f} MiB counting, {bulk_size / 2**20:.1f} MiB trimming in bulk; '
+		f'context: {context_s[0] * 1000:.3f} ms cached, {context_s[1] * 1000:.2f} ms loaded'
+	)
+	# Timings vary too much to be compared here.
+	assert bulk_statements < counting_statements
+
+
+def test_trim_keeps_newest_stored_messages(Session):
+	add_msgs(Session, range(1, 5))
+	add_msgs_elsewhere(Session, [5, 6])
+	add_msgs(Session, [7, 8])
+	with Session() as ses:
+		assert get_stored_ids(ses) == [6, 7, 8]
+		assert ses.get(Chat, (CHAT_ID, 0)).msg_count == 3
+
+
+@pytest.fixture
+def validate():
+	context_cache.validate = True
+	yield
+	context_cache.validate = False
+
+
+def get_stale_count():
+	return metrics.snapshot().get('context_cache.stale', 0)
+
+
+def test_stale_context_reloaded(Session, validate):
+	add_msgs(Session, range(1, 3))
+	add_msgs_elsewhere(Session, [3])
+	stale = get_stale_count()
+	with Session() as ses:
+		ctx = get_cached_context(ses, CHAT_ID, config)
+		assert [msg.id for msg in ctx.messages] == [1, 2, 3]
+		assert ctx.msg_count == 3
+	assert get_stale_count() == stale + 1
+
+
+def test_current_context_used(Session, validate):
+	add_msgs(Session, range(1, 3))
+	stale = get_stale_count()
+	with Session() as ses:
+		ctx = get_cached_context(ses, CHAT_ID, config)
+		assert [msg.id for msg in ctx.messages] == [1, 2]
+	assert get_stale_count() == stale
\ No newline at end of file
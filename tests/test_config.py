@@ -0,0 +1,112 @@
+import json
+import time
+import threading
+
+from file_managers.config import ConfigurationManager, get_nested_dict
+import file_managers.config
+
+
+
+DEFAULT_CONFIG = {'chat': {'ai': {'model': 'default', 'max_tokens': 100}}, 'flag': True}
+
+READERS = 4
+READS = 20000
+
+
+def make_manager(tmp_path):
+	with open(tmp_path / 'config.default.json', 'w') as file:
+		json.dump(DEFAULT_CONFIG, file)
+	return ConfigurationManager(str(tmp_path / 'config.json'))
+
+
+def test_snapshot_not_changed_by_set(tmp_path):
+	manager = make_manager(tmp_path)
+	snapshot = manager.snapshot()
+	manager.set('chat.ai.model', 'other')
+	assert manager.get('chat.ai.model') == 'other'
+	assert snapshot.get('chat.ai.model') == 'default'
+	manager.reset('chat.ai.model')
+	assert manager.get('chat.ai.model') == 'default'
+	manager.set('chat.ai.max_tokens', '200', match_type=True)
+	assert manager.get('chat.ai.max_tokens') == 200
+
+
+def test_snapshot_not_changed_by_readers(tmp_path):
+	snapshot = make_manager(tmp_path).snapshot()
+	snapshot.get('chat.ai')['model'] = 'other'
+	snapshot.get('chat')['ai'] = {}
+	assert snapshot.get('chat.ai') == {'model': 'default', 'max_tokens': 100}
+	assert snapshot.get('chat.ai.model') == 'default'
+
+
+def test_changes_saved_together(tmp_path, monkeypatch):
+	monkeypatch.setattr(file_managers.config, 'SAVE_DELAY_S', 60)
+	manager = make_manager(tmp_path)
+	manager.set('chat.ai.model', 'other')
+	manager.set('flag', False)
+	assert not (tmp_path / 'config.json').exists()
+	manager.flush()
+	with open(tmp_path / 'config.json') as file:
+		config = json.load(file)
+	assert config['chat']['ai']['model'] == 'other'
+	assert config['flag'] is False
+	assert not list(tmp_path.glob('*.tmp'))
+
+
+def test_reloaded_once_edited(tmp_path):
+	manager = make_manager(tmp_path)
+	manager.set('flag', False)
+	manager.flush()
+	assert not manager.reload_if_changed()
+
+	with open(tmp_path / 'config.json', 'w') as file:
+		json.dump({'chat': {'ai': {'model': 'edited'}}}, file)
+	assert manager.reload_if_changed()
+	assert manager.get('chat.ai.model') == 'edited'
+	# Settings missing from the file are the default ones.
+	assert manager.get('chat.ai.max_tokens') == 100
+
+
+def read_concurrently(get):
+	"""Call get() from reader threads, return the calls per second."""
+	barrier = threading.Barrier(READERS + 1)
+
+	def read():
+		barrier.wait()
+		for _ in range(READS):
+			get('chat.ai.model')
+
+	threads = [threading.Thread(target=read) for _ in range(READERS)]
+	for thread in threads:
+		thread.start()
+	barrier.wait()
+	start = time.perf_counter()
+	for thread in threads:
+		thread.join()
+	return READERS * READS / (time.perf_counter() - start)
+
+
+def test_get_throughput_under_concurrent_readers(tmp_path):
+	manager = make_manager(tmp_path)
+	stop = threading.Event()
+
+	def write():
+		# Readers never lock, even while the configuration changes.
+		i = 0
+		while not stop.is_set():
+			manager.set('chat.ai.model', ('default', 'other')[i % 2])
+			i += 1
+			time.sleep(0.001)
+
+	writer = threading.Thread(target=write)
+	writer.start()
+	try:
+		cached = read_concurrently(manager.get)
+	finally:
+		stop.set()
+		writer.join()
+	manager.flush()
+
+	uncached = read_concurrently(lambda key_path: get_nested_dict(DEFAULT_CONFIG, key_path))
+	print(f'get(): {cached:.0f}/s, walking the dictionaries: {uncached:.0f}/s')
+	assert cached > 100000
\ No newline at end of file
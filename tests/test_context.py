@@ -0,0 +1,52 @@
+from models.chat import MessageRole, build_context
+from utils.context_cache import CachedMessage
+from ai.tokens import count_msg_tokens
+
+
+
+def make_msgs(*tokens):
+	"""Return messages from newest to oldest taking some tokens each."""
+	return [
+		CachedMessage(i, 'user', MessageRole.user, f'Message {i}', msg_tokens)
+		for i, msg_tokens in enumerate(tokens)
+	]
+
+
+def get_contents(ctx):
+	return [msg['content'] for msg in ctx]
+
+
+def test_context_in_chronological_order():
+	ctx = build_context('System', make_msgs(10, 10, 10))
+	assert get_contents(ctx) == ['System', 'Message 2', 'Message 1', 'Message 0']
+	assert ctx[0]['role'] == 'system'
+	assert ctx[1] == {'name': '@user', 'role': 'user', 'content': 'Message 2'}
+
+
+def test_oldest_messages_trimmed():
+	sys_tokens = count_msg_tokens('System')
+	ctx = build_context('System', make_msgs(10, 10, 10, 10), max_tokens=sys_tokens + 25)
+	assert get_contents(ctx) == ['System', 'Message 1', 'Message 0']
+
+
+def test_newest_message_always_included():
+	ctx = build_context(None, make_msgs(100, 10), max_tokens=50)
+	assert get_contents(ctx) == ['Message 0']
+
+
+def test_trimming_stops_at_first_message_over_budget():
+	# Older messages that would fit aren't added after a gap.
+	ctx = build_context(None, make_msgs(10, 100, 1), max_tokens=50)
+	assert get_contents(ctx) == ['Message 0']
+
+
+def test_missing_token_counts_are_computed():
+	msgs = make_msgs(None, None)
+	tokens = count_msg_tokens('Message 0')
+	ctx = build_context(None, msgs, max_tokens=tokens)
+	assert get_contents(ctx) == ['Message 0']
+	assert get_contents(build_context(None, msgs, max_tokens=2 * tokens + 2)) == ['Message 1', 'Message 0']
+
+
+def test_no_budget_includes_everything():
+	assert len(build_context(None, make_msgs(*[1000] * 20))) == 20
\ No newline at end of file
@@ -0,0 +1,19 @@
+import pytest
+
+from utils.db import get_async_database_url
+
+
+
+@pytest.mark.parametrize('url, expected', [
+	('sqlite:///chats.db', 'sqlite+aiosqlite:///chats.db'),
+	('sqlite+aiosqlite:///chats.db', 'sqlite+aiosqlite:///chats.db'),
+	('postgresql://user@host/db', 'postgresql+asyncpg://user@host/db'),
+	('postgresql+psycopg2://user@host/db', 'postgresql+asyncpg://user@host/db'),
+])
+def test_async_database_url(url, expected):
+	assert get_async_database_url(url).render_as_string() == expected
+
+
+def test_unsupported_database():
+	with pytest.raises(ValueError, match='oracle.*sqlite \\(aiosqlite\\)'):
+		get_async_database_url('oracle://user@host/db')
\ No newline at end of file
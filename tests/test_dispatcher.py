@@ -0,0 +1,118 @@
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from decorators.telegram import dispatched
+from utils.dispatcher import AsyncChatDispatcher, ChatDispatcher
+
+
+
+def make_msg(chat_id):
+	return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_thread_id=None)
+
+
+def wait_for(condition, timeout=5):
+	deadline = time.monotonic() + timeout
+	while not condition():
+		assert time.monotonic() < deadline
+		time.sleep(0.01)
+
+
+def test_chat_tasks_run_in_order():
+	dispatcher = ChatDispatcher(workers=4, priority_workers=0, max_queue_per_chat=100)
+	dispatcher.start()
+	runs = {'a': [], 'b': []}
+
+	def handle(key, i):
+		time.sleep(0.001)
+		runs[key].append(i)
+
+	for i in range(50):
+		for key in runs:
+			assert dispatcher.submit(key, handle, key, i)
+
+	wait_for(lambda: all(len(values) == 50 for values in runs.values()))
+	assert runs == {'a': list(range(50)), 'b': list(range(50))}
+
+
+def test_full_chat_queue_rejects():
+	# Not started, the tasks stay queued.
+	dispatcher = ChatDispatcher(max_queue_per_chat=2)
+	assert dispatcher.submit('a', print)
+	assert dispatcher.submit('a', print)
+	assert not dispatcher.submit('a', print)
+	# Other chats have their own queues.
+	assert dispatcher.submit('b', print)
+
+
+def test_priority_tasks_skip_busy_workers():
+	dispatcher = ChatDispatcher(workers=1, priority_workers=1)
+	dispatcher.start()
+	release = threading.Event()
+	ran = threading.Event()
+
+	dispatcher.submit('a', release.wait)
+	dispatcher.submit('a', print)
+	dispatcher.submit('a', ran.set, priority=True)
+	try:
+		assert ran.wait(5)
+	finally:
+		release.set()
+
+
+def test_async_chat_tasks_run_in_order():
+	runs = []
+
+	async def handle(i):
+		await asyncio.sleep(0)
+		runs.append(i)
+
+	async def main():
+		dispatcher = AsyncChatDispatcher(workers=2, max_queue_per_chat=100)
+		for i in range(20):
+			assert dispatcher.submit('a', handle, i)
+		while len(runs) < 20:
+			await asyncio.sleep(0.01)
+
+	asyncio.run(asyncio.wait_for(main(), 5))
+	assert runs == list(range(20))
+
+
+def test_dispatched_checks_run_before_queueing():
+	submitted = []
+	dispatcher = SimpleNamespace(
+		in_chat=lambda key: False,
+		submit=lambda key, fn, *args, **kwargs: submitted.append(key)
+	)
+
+	@dispatched(dispatcher, lambda msg: msg.chat.id > 0)
+	def handler(msg):
+		pass
+
+	handler(make_msg(-1))
+	assert submitted == []
+	handler(make_msg(1))
+	assert submitted == [(1, 0)]
+
+def test_redirects_dont_check_again():
+	dispatcher = ChatDispatcher(workers=1, priority_workers=0)
+	dispatcher.start()
+	checks = []
+	handled = threading.Event()
+
+	def check(msg):
+		checks.append(msg)
+		return True
+
+	@dispatched(dispatcher, check)
+	def target(msg):
+		handled.set()
+
+	@dispatched(dispatcher, check)
+	def redirecting(msg):
+		target(msg)
+
+	redirecting(make_msg(1))
+	assert handled.wait(5)
+	assert len(checks) == 1
\ No newline at end of file
@@ -0,0 +1,127 @@
+import io
+import time
+import threading
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from PIL import Image
+from telebot import apihelper
+
+import utils.telegram
+from utils.blobs import new_image_blob
+from utils.telegram import download_telegram_file
+
+
+
+def make_large_jpeg():
+	"""Return a JPEG image of noise, which compresses poorly."""
+	img = Image.effect_noise((3000, 2000), 100).convert('RGB')
+	buffer = io.BytesIO()
+	img.save(buffer, format='jpeg', quality=95)
+	return buffer.getvalue()
+
+
+class FileHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	stall_s = 0
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		self.send_response(200)
+		self.send_header('Content-Length', str(len(self.server.content)))
+		self.end_headers()
+		self.wfile.write(self.server.content[:1024])
+		self.wfile.flush()
+		time.sleep(self.server.stall_s)
+		self.wfile.write(self.server.content[1024:])
+
+
+class FileServer(ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, content, stall_s=0):
+		super().__init__(('127.0.0.1', 0), FileHandler)
+		self.content = content
+		self.stall_s = stall_s
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+
+	def handle_error(self, request, client_address):
+		# The client gives up on stalled downloads.
+		pass
+
+
+class FakeFile:
+	file_path = 'photos/file.jpg'
+
+
+class FakeBot:
+	token = 'token'
+
+	def get_file(self, file_id):
+		return FakeFile()
+
+
+@pytest.fixture
+def serve(monkeypatch):
+	servers = []
+
+	def serve(content, stall_s=0):
+		server = FileServer(content, stall_s)
+		servers.append(server)
+		host, port = server.server_address
+		monkeypatch.setattr(apihelper, 'FILE_URL', f'http://{host}:{port}/file/bot{{0}}/{{1}}')
+		return server
+
+	yield serve
+	for server in servers:
+		server.shutdown()
+		server.server_close()
+
+
+def test_downloaded(serve):
+	content = bytes(range(256)) * 10000
+	serve(content)
+	with download_telegram_file(FakeBot(), 'id') as file:
+		assert file.read() == content
+
+
+def test_stalled_download_times_out_and_closes_file(serve, monkeypatch):
+	files = []
+
+	class TrackedFile(utils.telegram.SpooledTemporaryFile):
+		def __init__(self, *args, **kwargs):
+			super().__init__(*args, **kwargs)
+			files.append(self)
+
+	monkeypatch.setattr(utils.telegram, 'SpooledTemporaryFile', TrackedFile)
+	monkeypatch.setattr(apihelper, 'READ_TIMEOUT', 0.2)
+	serve(bytes(10000), stall_s=2)
+	start = time.monotonic()
+	with pytest.raises(requests.exceptions.RequestException):
+		download_telegram_file(FakeBot(), 'id')
+	assert time.monotonic() - start < 1.5
+	assert files and files[0].closed
+
+
+def test_photo_memory_within_file_size(serve):
+	content = make_large_jpeg()
+	serve(content)
+	# Warm up the connections and the image plugins.
+	with download_telegram_file(FakeBot(), 'id') as file:
+		new_image_blob(file)
+
+	tracemalloc.start()
+	try:
+		with download_telegram_file(FakeBot(), 'id') as file:
+			new_image_blob(file)
+		_, peak = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+
+	print(f'Peak memory: {peak / 2**20:.1f} MiB for a {len(content) / 2**20:.1f} MiB photo')
+	# The file is read once, by the media function.
+	assert peak < 2 * len(content)
\ No newline at end of file
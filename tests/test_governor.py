@@ -0,0 +1,107 @@
+import asyncio
+
+import httpx
+import pytest
+from openai import APIConnectionError
+
+from ai.governor import CircuitBreaker, Governor, GovernorError, GovernedStream
+from file_managers.config import ConfigSnapshot
+
+
+
+def make_governor(**options):
+	return Governor(ConfigSnapshot({
+		'governor': {
+			'backoff_s': 0,
+			'breaker_cooldown_s': 0,
+			'breaker_failures': 1,
+			'limits': {'default': {'rpm': 6000}},
+			'max_backoff_s': 0,
+			'max_wait_s': 1,
+			'retries': 0,
+		} | options,
+	}))
+
+
+def connection_error():
+	return APIConnectionError(request=httpx.Request('POST', 'http://api.test'))
+
+
+def fail(exc):
+	def fn(**kwargs):
+		raise exc
+	return fn
+
+
+def test_model_passed_along():
+	governor = make_governor()
+	assert governor.call('model', 1, lambda model: model, model='model') == 'model'
+
+
+def test_breaker_opens_after_failures():
+	governor = make_governor(breaker_cooldown_s=60)
+	with pytest.raises(APIConnectionError):
+		governor.call('model', 1, fail(connection_error()))
+	with pytest.raises(GovernorError):
+		governor.call('model', 1, lambda: 'ok')
+
+
+@pytest.mark.parametrize('exc', [TypeError(), KeyboardInterrupt()])
+def test_trial_released_on_other_errors(exc):
+	governor = make_governor()
+	with pytest.raises(APIConnectionError):
+		governor.call('model', 1, fail(connection_error()))
+
+	# The trial request fails without an answer from the API.
+	with pytest.raises(type(exc)):
+		governor.call('model', 1, fail(exc))
+	assert governor.call('model', 1, lambda: 'ok') == 'ok'
+
+
+def test_trial_released_on_cancel():
+	governor = make_governor()
+	with pytest.raises(APIConnectionError):
+		governor.call('model', 1, fail(connection_error()))
+
+	async def hang():
+		await asyncio.sleep(60)
+
+	async def ok():
+		return 'ok'
+
+	async def main():
+		task = asyncio.create_task(governor.acall('model', 1, hang))
+		await asyncio.sleep(0.01)
+		task.cancel()
+		with pytest.raises(asyncio.CancelledError):
+			await task
+		return await governor.acall('model', 1, ok)
+
+	assert asyncio.run(main()) == 'ok'
+
+
+def test_stream_errors_reach_breaker():
+	breaker = CircuitBreaker(failures=1, cooldown_s=60)
+
+	def chunks():
+		yield 'chunk'
+		raise connection_error()
+
+	with pytest.raises(APIConnectionError):
+		list(GovernedStream(chunks(), breaker))
+	assert not breaker.allow()
+
+
+def test_async_stream_errors_reach_breaker():
+	breaker = CircuitBreaker(failures=1, cooldown_s=60)
+
+	async def chunks():
+		yield 'chunk'
+		raise httpx.ReadError('Connection lost')
+
+	async def read():
+		return [chunk async for chunk in GovernedStream(chunks(), breaker)]
+
+	with pytest.raises(httpx.ReadError):
+		asyncio.run(read())
+	assert not breaker.allow()
\ No newline at end of file
@@ -0,0 +1,96 @@
+import os
+import time
+
+from file_managers.lists import ListManager, TelegramWhitelistManager
+from file_managers.watcher import FileWatcher
+
+
+
+def write(path, text):
+	with open(path, 'w') as file:
+		file.write(text)
+	# Tell the edit apart even within the file system's time precision.
+	stat = os.stat(path)
+	os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_missing_file_is_empty(tmp_path):
+	manager = ListManager(str(tmp_path / 'list.txt'))
+	assert manager.list == []
+	assert not manager.has(1)
+
+
+def test_add_and_remove_saved(tmp_path):
+	path = str(tmp_path / 'list.txt')
+	manager = ListManager(path)
+	for id in (3, 1, 3, -2):
+		manager.add(id)
+	manager.remove(1)
+	manager.remove(42)
+	assert manager.list == [-2, 3]
+	with open(path) as file:
+		assert file.read() == '-2\n3\n'
+	assert ListManager(path).list == [-2, 3]
+
+
+def test_reloaded_once_edited(tmp_path):
+	path = str(tmp_path / 'list.txt')
+	write(path, '1\n\n2\n')
+	manager = ListManager(path)
+	assert manager.list == [1, 2]
+	assert not manager.reload_if_changed()
+
+	write(path, '5\n')
+	assert manager.reload_if_changed()
+	assert manager.list == [5]
+
+	os.remove(path)
+	assert manager.reload_if_changed()
+	assert manager.list == []
+
+
+def test_add_keeps_edits_by_others(tmp_path):
+	path = str(tmp_path / 'list.txt')
+	manager = ListManager(path)
+	manager.add(1)
+	write(path, '1\n2\n')
+	manager.add(3)
+	assert ListManager(path).list == [1, 2, 3]
+
+
+def test_watcher_reloads(tmp_path):
+	path = str(tmp_path / 'list.txt')
+	manager = ListManager(path)
+	watcher = FileWatcher(60)
+	watcher.watch(manager, 'List')
+	write(path, '7\n')
+	watcher.check()
+	assert manager.has(7)
+
+
+def test_whitelist(tmp_path, monkeypatch):
+	monkeypatch.setenv('TELEGRAM_ADMIN_ID', '10')
+	path = str(tmp_path / 'whitelist.txt')
+	write(path, '20\n-30\n')
+	whitelist = TelegramWhitelistManager(path)
+	assert whitelist.can_use_bot(10)
+	assert whitelist.can_use_bot(20)
+	assert whitelist.can_use_bot(-30, 99)
+	assert whitelist.can_use_bot(-99, 20)
+	assert not whitelist.can_use_bot(-99, 99)
+
+	whitelist.remove(20)
+	assert not whitelist.can_use_bot(20)
+
+
+def test_large_whitelist_checked_quickly(tmp_path, monkeypatch):
+	monkeypatch.setenv('TELEGRAM_ADMIN_ID', '1')
+	path = str(tmp_path / 'whitelist.txt')
+	write(path, ''.join(f'{id}\n' for id in range(2, 100002)))
+	whitelist = TelegramWhitelistManager(path)
+
+	start = time.perf_counter()
+	for id in range(-10000, 0):
+		assert not whitelist.can_use_bot(id, -id - 200000)
+	# A scan of the list for every check would take minutes.
+	assert time.perf_counter() - start < 1
\ No newline at end of file
@@ -0,0 +1,326 @@
+"""
+Load tests of the two runtimes and of the worker processes: the bot is
+run against local fake Telegram and OpenAI servers, many chats ask it
+for a translation at once, and the chats replied to per second are
+compared.
+
+Translations aren't stored, so the chats don't wait for each other on
+SQLite's single writer.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+import pytest
+
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Chats writing to the bot at once.
+CHATS = 40
+# Seconds the fake OpenAI server takes to reply.
+COMPLETION_DELAY_S = 1
+# Seconds the bot has to start and reply to every chat.
+TIMEOUT_S = 60
+
+# Same for the bot run in worker processes, which have few dispatcher
+# workers each so that the number of processes is the bottleneck.
+SHARDED_CHATS = 48
+SHARDED_COMPLETION_DELAY_S = 0.25
+SHARDED_DISPATCHER_WORKERS = 2
+
+BOT_USER = {'id': 10, 'is_bot': True, 'first_name': 'Bot', 'username': 'test_bot'}
+
+# Points the Telegram API URL to the fake server at the start of the
+# bot's processes, including the workers the supervisor spawns with its
+# own command line.
+SITECUSTOMIZE = '''
+import os
+from telebot import apihelper, asyncio_helper
+apihelper.API_URL = asyncio_helper.API_URL = os.environ['FAKE_TELEGRAM_URL'] + '/bot{0}/{1}'
+'''
+
+
+class FakeServer(ThreadingHTTPServer):
+	daemon_threads = True
+	# Every chat connects at once.
+	request_queue_size = 128
+
+	def __init__(self, handler_cls):
+		super().__init__(('127.0.0.1', 0), handler_cls)
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+	def handle_error(self, request, client_address):
+		# The bot is killed with connections open.
+		pass
+
+
+	@property
+	def url(self):
+		host, port = self.server_address
+		return f'http://{host}:{port}'
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+
+	def read_params(self):
+		url = urlparse(self.path)
+		params = dict(parse_qsl(url.query))
+		body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+		content_type = self.headers.get('Content-Type', '')
+		if content_type.startswith('application/json'):
+			params.update(json.loads(body))
+		elif content_type.startswith('application/x-www-form-urlencoded'):
+			params.update(parse_qsl(body.decode()))
+		return url.path, params
+
+
+	def send_json(self, value):
+		body = json.dumps(value).encode()
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+class FakeTelegramHandler(JSONHandler):
+
+	def do_GET(self):
+		path, params = self.read_params()
+		method = path.rsplit('/', 1)[-1]
+		self.send_json({'ok': True, 'result': self.server.call(method, params)})
+
+	do_POST = do_GET
+
+
+class FakeTelegram(FakeServer):
+	"""Telegram Bot API serving a batch of messages once, after `ready`
+	getMe requests, and recording when each chat is replied to."""
+
+	def __init__(self, updates, ready=0):
+		super().__init__(FakeTelegramHandler)
+		self.updates = updates
+		self.ready = ready
+		self.delivered_at = None
+		self.replied_at = {}
+		self.all_replied = threading.Event()
+		self._lock = threading.Lock()
+		self._message_id = 100000
+		self._get_me_calls = 0
+
+
+	def call(self, method, params):
+		if method == 'getMe':
+			with self._lock:
+				self._get_me_calls += 1
+			return BOT_USER
+
+		if method == 'getUpdates':
+			offset = int(params.get('offset') or 0)
+			updates = [update for update in self.updates if update['update_id'] >= offset]
+			if updates and self._get_me_calls >= self.ready:
+				if self.delivered_at is None:
+					self.delivered_at = time.monotonic()
+				return updates
+			time.sleep(min(float(params.get('timeout') or 0), 0.5))
+			return []
+
+		if method in ('sendMessage', 'editMessageText'):
+			chat_id = int(params['chat_id'])
+			with self._lock:
+				self._message_id += 1
+				self.replied_at.setdefault(chat_id, time.monotonic())
+				if len(self.replied_at) == len(self.updates):
+					self.all_replied.set()
+				return {
+					'message_id': self._message_id,
+					'date': int(time.time()),
+					'chat': {'id': chat_id, 'type': 'private'},
+					'from': BOT_USER,
+					'text': params.get('text', ''),
+				}
+
+		return True
+
+
+class FakeOpenAIHandler(JSONHandler):
+
+	def do_GET(self):
+		self.read_params()
+		self.send_json({'object': 'list', 'data': []})
+
+
+	def do_POST(self):
+		path, params = self.read_params()
+		time.sleep(self.server.delay)
+		self.send_json({
+			'id': 'chatcmpl-test',
+			'object': 'chat.completion',
+			'created': int(time.time()),
+			'model': params.get('model', ''),
+			'choices': [{
+				'index': 0,
+				'message': {'role': 'assistant', 'content': json.dumps({
+					'src_lang': 'es',
+					'dst_lang': 'en',
+					'original_text': 'Hola',
+					'translated_text': 'Hello',
+				})},
+				'finish_reason': 'stop',
+			}],
+			'usage': {'prompt_tokens': 10, 'completion_tokens': 2, 'total_tokens': 12},
+		})
+
+
+class FakeOpenAI(FakeServer):
+	"""OpenAI API taking `delay` seconds to reply."""
+
+	def __init__(self, delay):
+		super().__init__(FakeOpenAIHandler)
+		self.delay = delay
+
+
+def build_updates(chat_ids):
+	"""Return a /to command replying to a message for each chat."""
+	updates = []
+	for i, chat_id in enumerate(chat_ids):
+		msg = {
+			'message_id': 2 * i + 1,
+			'date': int(time.time()),
+			'chat': {'id': chat_id, 'type': 'private', 'first_name': 'User'},
+			'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+			'text': 'Hola',
+		}
+		updates.append({
+			'update_id': i + 1,
+			'message': msg | {
+				'message_id': 2 * i + 2,
+				'text': '/to English',
+				'entities': [{'type': 'bot_command', 'offset': 0, 'length': 3}],
+				'reply_to_message': msg,
+			},
+		})
+	return updates
+
+
+def write_settings(tmp_path, name, overrides):
+	"""Write the settings file of the bot along with its default
+	version."""
+	shutil.copy(os.path.join(REPO_DIR, f'{name}.default.json'), tmp_path / f'{name}.default.json')
+	(tmp_path / f'{name}.json').write_text(json.dumps(overrides))
+	return str(tmp_path / f'{name}.json')
+
+
+def measure_throughput(tmp_path, runtime='threaded', workers=0, chats=CHATS, dispatcher=None,
+	completion_delay_s=COMPLETION_DELAY_S):
+	"""
+	Run the bot and return the chats it replied to per second, from the
+	moment it received their messages.
+
+	Args:
+		tmp_path:				Directory of the bot's files.
+		runtime:				Runtime of the bot.
+		workers:				Worker processes, 0 runs the bot in a
+								single process.
+		chats:					Chats writing to the bot at once.
+		dispatcher:				Overrides of the dispatcher's settings.
+		completion_delay_s:		Seconds the fake OpenAI server takes to
+								reply.
+	"""
+	chat_ids = range(100, 100 + chats)
+	# Each worker requests getMe once started, the messages are only
+	# delivered once they all run.
+	telegram = FakeTelegram(build_updates(chat_ids), ready=workers)
+	openai = FakeOpenAI(completion_delay_s)
+
+	config = write_settings(tmp_path, 'config', {
+		'dispatcher': dispatcher or {},
+		'http': {'prewarm': 1 if workers else 0},
+		'media': {'workers': 0},
+	})
+	ai_options = write_settings(tmp_path, 'ai_options', {
+		'http': {'http2': False, 'prewarm': 0},
+	})
+	wlist = tmp_path / 'whitelist.txt'
+	wlist.write_text(''.join(f'{chat_id}\n' for chat_id in chat_ids))
+	(tmp_path / 'sitecustomize.py').write_text(SITECUSTOMIZE)
+
+	env = dict(
+		os.environ,
+		PYTHONPATH=os.pathsep.join(filter(None, [str(tmp_path), os.environ.get('PYTHONPATH')])),
+		FAKE_TELEGRAM_URL=telegram.url,
+		TELEGRAM_API_KEY='123:test',
+		TELEGRAM_ADMIN_ID='1',
+		OPENAI_API_KEY='sk-test',
+		OPENAI_BASE_URL=f'{openai.url}/v1',
+		DATABASE_URL=f'sqlite:///{tmp_path / "bot.db"}',
+	)
+	proc = subprocess.Popen(
+		[
+			sys.executable, 'bot.py',
+			'--runtime', runtime,
+			'--workers', str(workers),
+			'--config', config,
+			'--ai_options', ai_options,
+			'--wlist', str(wlist),
+		],
+		cwd=REPO_DIR,
+		env=env,
+		stdout=subprocess.DEVNULL
+	)
+	try:
+		assert telegram.all_replied.wait(TIMEOUT_S), f'{len(telegram.replied_at)} of {chats} chats replied to'
+	finally:
+		# The workers stop once their supervisor is gone.
+		proc.terminate()
+		proc.wait()
+		telegram.shutdown()
+		openai.shutdown()
+
+	elapsed = max(telegram.replied_at.values()) - telegram.delivered_at
+	return chats / elapsed
+
+
+def test_concurrent_chats_throughput(tmp_path_factory):
+	throughputs = {
+		runtime: measure_throughput(tmp_path_factory.mktemp(runtime), runtime)
+		for runtime in ('threaded', 'asyncio')
+	}
+	print(', '.join(f'{runtime}: {value:.1f} chats/s' for runtime, value in throughputs.items()))
+
+	# The threaded runtime is bound by its dispatcher workers, the
+	# asyncio one keeps every completion in flight at once.
+	assert throughputs['asyncio'] > throughputs['threaded']
+
+
+def test_worker_processes_throughput(tmp_path_factory):
+	throughputs = {
+		workers: measure_throughput(
+			tmp_path_factory.mktemp(f'workers{workers}'),
+			workers=workers,
+			chats=SHARDED_CHATS,
+			dispatcher={'workers': SHARDED_DISPATCHER_WORKERS},
+			completion_delay_s=SHARDED_COMPLETION_DELAY_S
+		)
+		for workers in (1, 2, 4)
+	}
+	print(', '.join(f'{workers} workers: {value:.1f} chats/s' for workers, value in throughputs.items()))
+
+	# Each process adds its dispatcher workers, the chats are spread
+	# unevenly so the scaling isn't linear.
+	assert throughputs[1] < throughputs[2] < throughputs[4]
\ No newline at end of file
@@ -0,0 +1,289 @@
+import io
+import math
+import time
+import shutil
+import subprocess
+import wave
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils.media
+import utils.prompt
+from file_managers.config import ConfigSnapshot
+from utils.media import encode_image, get_atempo_filter, get_vision_size, speed_up_audio_ffmpeg, split_audio_bytes, trim_silence
+from utils.prompt import split_audio, transcribe
+
+
+
+# EXIF tag of the orientation.
+ORIENTATION = 0x0112
+
+# Sizes of the synthetic photos the image benchmark encodes.
+PHOTO_SIZES = [(640, 480), (1920, 1080), (3000, 2000)]
+
+
+def make_jpeg(size, orientation=None):
+	img = Image.new('RGB', size, 'red')
+	exif = Image.Exif()
+	exif[0x010F] = 'Camera maker'
+	if orientation:
+		exif[ORIENTATION] = orientation
+	buffer = io.BytesIO()
+	img.save(buffer, format='jpeg', exif=exif)
+	return buffer.getvalue()
+
+
+def decode(data):
+	return Image.open(io.BytesIO(data))
+
+
+@pytest.mark.parametrize('size, detail, expected', [
+	((4000, 3000), 'low', (512, 384)),
+	((4000, 3000), 'auto', (1024, 768)),
+	((4000, 1000), 'high', (2048, 512)),
+	((300, 200), 'low', (300, 200)),
+])
+def test_vision_size(size, detail, expected):
+	assert get_vision_size(size, detail) == expected
+
+
+def test_image_scaled_down_and_stripped():
+	content_type, data = encode_image(make_jpeg((2000, 1500)), detail='low')
+	assert content_type == 'image/webp'
+	with decode(data) as img:
+		assert img.format == 'WEBP'
+		assert img.size == (512, 384)
+		assert not img.getexif()
+
+
+def test_small_image_stripped():
+	_, data = encode_image(make_jpeg((100, 50)), format='jpeg')
+	with decode(data) as img:
+		assert img.size == (100, 50)
+		assert not img.getexif()
+
+
+def test_image_rotated_by_orientation():
+	# Rotated 90 degrees.
+	_, data = encode_image(make_jpeg((200, 100), orientation=6))
+	with decode(data) as img:
+		assert img.size == (100, 200)
+
+
+def test_transparency_kept():
+	buffer = io.BytesIO()
+	Image.new('RGBA', (10, 10), (0, 0, 0, 0)).save(buffer, format='png')
+	_, data = encode_image(buffer.getvalue())
+	with decode(data) as img:
+		assert img.mode == 'RGBA'
+		assert np.asarray(img)[0, 0, 3] == 0
+
+
+def make_photo(size, seed=0):
+	"""Return a JPEG of a noisy gradient, compressing like a photo."""
+	w, h = size
+	y, x = np.mgrid[0:h, 0:w]
+	pixels = np.stack([x * 255 // w, y * 255 // h, (x + y) * 255 // (w + h)], axis=-1)
+	pixels += np.random.default_rng(seed).integers(-20, 20, pixels.shape)
+	buffer = io.BytesIO()
+	Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, format='jpeg', quality=90)
+	return buffer.getvalue()
+
+
+def encode_png(img_bytes):
+	"""Encode an image losslessly at its size, as before the images
+	were prepared for the vision model."""
+	with Image.open(io.BytesIO(img_bytes)) as img:
+		buffer = io.BytesIO()
+		img.save(buffer, format='png')
+		return buffer.getvalue()
+
+
+def test_photo_corpus_encoding():
+	# Bytes and seconds over the corpus.
+	totals = {'encode_image': [0, 0], 'png': [0, 0]}
+	for size in PHOTO_SIZES:
+		photo = make_photo(size)
+		results = []
+		for name, encode in (('encode_image', lambda img: encode_image(img)[1]), ('png', encode_png)):
+			start = time.perf_counter()
+			data = encode(photo)
+			elapsed = time.perf_counter() - start
+			totals[name][0] += len(data)
+			totals[name][1] += elapsed
+			results.append(f'{name}: {len(data) / 2**10:.0f} KiB in {elapsed * 1000:.0f} ms')
+		print(f'{size[0]}x{size[1]} photo of {len(photo) / 2**10:.0f} KiB, ' + ', '.join(results))
+
+	(new_bytes, new_s), (png_bytes, png_s) = totals['encode_image'], totals['png']
+	assert new_bytes < png_bytes / 10
+	assert new_s < png_s
+
+
+def get_atempo_factors(speed):
+	return [float(f.split('=')[1]) for f in get_atempo_filter(speed).split(',')]
+
+
+@pytest.mark.parametrize('speed', [0.2, 0.5, 1, 1.5, 2, 3, 8.5])
+def test_atempo_filter_reaches_speed(speed):
+	factors = get_atempo_factors(speed)
+	assert all(0.5 <= factor <= 2 for factor in factors)
+	assert math.isclose(math.prod(factors), speed, rel_tol=1e-3)
+
+
+def test_ffmpeg_failure_leaves_audio(monkeypatch):
+	def fail(*args, **kwargs):
+		raise subprocess.CalledProcessError(1, 'ffmpeg')
+	monkeypatch.setattr(utils.media, 'run_ffmpeg', fail)
+	assert speed_up_audio_ffmpeg(b'audio') == b'audio'
+
+
+def test_ffmpeg_encoding_failure_after_vad_leaves_audio(monkeypatch):
+	def run_ffmpeg(input_bytes, input_args=[], output_args=[]):
+		if '-af' in output_args:
+			raise subprocess.CalledProcessError(1, 'ffmpeg')
+		# Decoded to PCM for the silence removal.
+		return np.zeros(16000, dtype=np.int16).tobytes()
+	monkeypatch.setattr(utils.media, 'run_ffmpeg', run_ffmpeg)
+	vad = {'frame_ms': 30, 'threshold_db': -40, 'min_silence_ms': 300, 'padding_ms': 100}
+	assert speed_up_audio_ffmpeg(b'OggS audio', vad=vad) == b'OggS audio'
+
+
+@pytest.mark.skipif(not shutil.which('ffmpeg'), reason='ffmpeg is missing')
+def test_ffmpeg_speeds_up_audio():
+	wav = utils.media.run_ffmpeg(
+		np.zeros(16000 * 4, dtype=np.int16).tobytes(),
+		input_args=['-f', 's16le', '-ac', '1', '-ar', '16000'],
+		output_args=['-f', 'wav']
+	)
+	ogg = speed_up_audio_ffmpeg(wav, speed=2)
+	assert ogg.startswith(b'OggS')
+	duration = float(subprocess.run(
+		['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', '-'],
+		input=ogg,
+		capture_output=True,
+		check=True
+	).stdout)
+	assert duration == pytest.approx(2, abs=0.1)
+
+
+def make_speech(*spans_ms, rate=1000):
+	"""Return samples alternating silence and a tone, for spans of
+	milliseconds."""
+	parts = []
+	for i, span_ms in enumerate(spans_ms):
+		n = span_ms * rate // 1000
+		parts.append(np.full(n, 10000 * (i % 2), dtype=np.int16))
+	return np.concatenate(parts)
+
+
+def test_silence_trimmed():
+	samples = make_speech(1000, 500, 1000, 500, 1000, rate=1000)
+	trimmed, removed_s = trim_silence(samples, 1000, frame_ms=10, min_silence_ms=300, padding_ms=100)
+	# The silence is cut down to the padding around the tones.
+	assert removed_s == pytest.approx(3 - 4 * 0.1, abs=0.05)
+	assert len(trimmed) == len(samples) - round(removed_s * 1000)
+
+
+def test_short_pauses_kept():
+	samples = make_speech(0, 500, 200, 500, 0, rate=1000)
+	_, removed_s = trim_silence(samples, 1000, frame_ms=10, min_silence_ms=300, padding_ms=50)
+	assert removed_s == 0
+
+
+def test_steady_audio_left():
+	samples = np.zeros(1000, dtype=np.int16)
+	trimmed, removed_s = trim_silence(samples, 1000)
+	assert removed_s == 0
+	assert len(trimmed) == len(samples)
+
+
+def make_wav(samples, rate=16000):
+	buffer = io.BytesIO()
+	with wave.open(buffer, 'wb') as wav:
+		wav.setnchannels(1)
+		wav.setsampwidth(2)
+		wav.setframerate(rate)
+		wav.writeframes(samples.tobytes())
+	return buffer.getvalue()
+
+
+SEGMENTS_CONFIG = ConfigSnapshot({'prompt': {'audio': {'segments': {'max_s': 2, 'overlap_s': 0, 'search_s': 1}}}})
+
+
+@pytest.mark.skipif(not shutil.which('ffmpeg'), reason='ffmpeg is missing')
+def test_short_audio_not_split():
+	assert split_audio_bytes(make_wav(np.zeros(16000, dtype=np.int16)), max_segment_ms=2000) == ()
+
+
+def test_audio_split_in_media_workers(monkeypatch):
+	calls = []
+	def run(fn, data, *args, **kwargs):
+		calls.append(fn)
+		return (b'first', b'second')
+	monkeypatch.setattr(utils.prompt.media_executor, 'run', run)
+	assert split_audio(('.ogg', b'audio'), SEGMENTS_CONFIG) == [('.ogg', b'first'), ('.ogg', b'second')]
+	assert calls == [split_audio_bytes]
+
+
+def test_unreadable_audio_left_whole():
+	assert split_audio(('.ogg', b'audio'), SEGMENTS_CONFIG) == [('.ogg', b'audio')]
+
+
+@pytest.mark.skipif(not shutil.which('ffmpeg'), reason='ffmpeg is missing')
+def test_long_audio_split():
+	samples = make_speech(1500, 500, 1500, 500, 1500, rate=16000)
+	segments = split_audio_bytes(make_wav(samples), max_segment_ms=2000, overlap_ms=0, search_ms=1000)
+	assert len(segments) == 3
+	assert all(segment.startswith(b'OggS') for segment in segments)
+
+
+# Audio bytes per second of the fake audio, and seconds the fake STT
+# endpoint takes per second of audio.
+FAKE_AUDIO_BYTES_PER_S = 100
+FAKE_STT_S_PER_AUDIO_S = 0.002
+
+
+def split_fake_audio(data, max_segment_ms, overlap_ms, search_ms):
+	"""Split fake audio like split_audio_bytes() splits audio."""
+	size = max_segment_ms * FAKE_AUDIO_BYTES_PER_S // 1000
+	overlap = overlap_ms * FAKE_AUDIO_BYTES_PER_S // 1000
+	if len(data) <= size:
+		return ()
+	return tuple(data[i:i + size] for i in range(0, len(data) - overlap, size - overlap))
+
+
+class FakeSTT:
+	"""AI whose transcriptions take time in proportion to the audio's
+	length."""
+
+	def stt(self, audio):
+		ext, data = audio
+		time.sleep(len(data) / FAKE_AUDIO_BYTES_PER_S * FAKE_STT_S_PER_AUDIO_S)
+		return SimpleNamespace(text='words')
+
+
+def test_segmented_transcription_latency(monkeypatch):
+	monkeypatch.setattr(utils.prompt, 'split_audio_bytes', split_fake_audio)
+	config = ConfigSnapshot({'prompt': {'audio': {'segments': {
+		'max_s': 60,
+		'overlap_s': 1,
+		'search_s': 10,
+		'workers': 4,
+	}}}})
+	# Ten minutes.
+	audio = ('.ogg', bytes(600 * FAKE_AUDIO_BYTES_PER_S))
+	ai = FakeSTT()
+
+	start = time.perf_counter()
+	ai.stt(audio)
+	whole_s = time.perf_counter() - start
+	start = time.perf_counter()
+	transcribe(ai, audio, config)
+	segmented_s = time.perf_counter() - start
+	print(f'Ten minutes transcribed in {whole_s:.2f} s whole, {segmented_s:.2f} s in segments')
+
+	# Eleven segments, transcribed by four workers.
+	assert segmented_s < whole_s / 2
\ No newline at end of file
@@ -0,0 +1,91 @@
+import os
+import time
+import threading
+import statistics
+
+import pytest
+
+from utils.media_executor import MIN_SHARED_BYTES, MediaExecutor
+from utils.metrics import metrics
+
+
+
+PARENT_PID = os.getpid()
+
+# Size of the media files of the batch.
+LARGE_BYTES = 8 * 2**20
+
+
+def reverse(data, suffix=b''):
+	return bytes(reversed(data)) + suffix, len(data)
+
+
+def die(data):
+	if os.getpid() != PARENT_PID:
+		os._exit(1)
+	return b'inline'
+
+
+def burn(data, rounds):
+	"""Hold the GIL for a while, like decoding media does."""
+	total = 0
+	for _ in range(rounds):
+		for byte in data[:200000]:
+			total += byte
+	return data[:16]
+
+
+@pytest.fixture
+def executor():
+	executor = MediaExecutor()
+	executor.start(1)
+	yield executor
+	if executor._pool:
+		executor._pool.shutdown()
+
+
+def test_large_bytes_shared(executor):
+	data = os.urandom(MIN_SHARED_BYTES * 2)
+	result, size = executor.run(reverse, data, suffix=b'!')
+	assert result == data[::-1] + b'!'
+	assert size == len(data)
+
+
+def test_dead_worker_disables_pool(executor):
+	assert executor.run(die, b'data') == b'inline'
+	assert executor._pool is None
+	assert metrics.snapshot()['media.pool_broken'] >= 1
+	# Media is processed in the calling thread from now on.
+	assert executor.run(reverse, b'abc') == (b'cba', 3)
+
+
+def measure_reply_latency(busy):
+	"""Return the median delay of replies, which wait for the network
+	then take a little CPU, while busy() is true."""
+	delays = []
+	while busy() or len(delays) < 5:
+		start = time.perf_counter()
+		time.sleep(0.01)
+		sum(range(2000))
+		delays.append(time.perf_counter() - start - 0.01)
+	return statistics.median(delays)
+
+
+def test_reply_latency_flat_while_processing_media(executor):
+	idle = measure_reply_latency(lambda: False)
+
+	data = bytes(LARGE_BYTES)
+	threads = [
+		threading.Thread(target=executor.run, args=(burn, data, 50))
+		for _ in range(4)
+	]
+	for thread in threads:
+		thread.start()
+	loaded = measure_reply_latency(lambda: any(thread.is_alive() for thread in threads))
+	for thread in threads:
+		thread.join()
+
+	print(f'Reply latency: {idle * 1000:.2f} ms idle, {loaded * 1000:.2f} ms processing media')
+	# Processing the media in the handling process delays the replies
+	# by tens of milliseconds, waiting for the GIL.
+	assert loaded < max(5 * idle, 0.005)
\ No newline at end of file
@@ -0,0 +1,325 @@
+import io
+import time
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import utils.messages
+from file_managers.config import ConfigSnapshot
+from constants.telegram import MAX_MSG_LEN, STREAM_MSG_SOFT_MAX_CHARS
+from utils.messages import (
+	EditedReply,
+	MarkdownStream,
+	SentenceSplitter,
+	process_text,
+	reply_chat_msg_stream_edits,
+	reply_voice_msg,
+	reply_voice_msg_stream,
+	send_reply_edits,
+	split_tts_text
+)
+
+
+
+def split_stream(chunks, min_chars=1):
+	splitter = SentenceSplitter(min_chars)
+	sentences = []
+	for chunk in chunks:
+		sentences += splitter.feed(chunk)
+	return sentences + splitter.flush()
+
+
+@pytest.mark.parametrize('chunks', [
+	['Hel', 'lo there', '. How', ' are you', '?', ' Fine!'],
+	list('Hello there. How are you? Fine!'),
+])
+def test_sentences_split_across_chunks(chunks):
+	assert split_stream(chunks) == ['Hello there.', 'How are you?', 'Fine!']
+
+
+def test_sentences_of_a_chunk_returned_together():
+	assert split_stream(['Hello there. How are you? Fine!']) == ['Hello there. How are you?', 'Fine!']
+
+
+def test_sentence_returned_once_complete():
+	splitter = SentenceSplitter()
+	assert splitter.feed('It costs 3.5 euros') == []
+	assert splitter.feed('. Then') == ['It costs 3.5 euros.']
+	assert splitter.feed('\n') == ['Then']
+	assert splitter.flush() == []
+
+
+def test_short_sentences_joined():
+	assert split_stream(['Hi. Ok. This is longer. Yes.'], min_chars=10) == ['Hi. Ok. This is longer.', 'Yes.']
+
+
+def test_tts_text_split_at_boundaries():
+	text = 'First sentence. Second sentence.\n\nNew paragraph here.'
+	assert split_tts_text(text, 40) == ['First sentence. Second sentence.', 'New paragraph here.']
+	assert split_tts_text(text, 20) == ['First sentence.', 'Second sentence.', 'New paragraph here.']
+
+
+def test_long_sentence_split_at_words():
+	chunks = split_tts_text('one two three four five six', 10)
+	assert chunks == ['one two', 'three four', 'five six']
+	assert all(len(chunk) <= 10 for chunk in chunks)
+
+
+class FakeAI:
+
+	def __init__(self):
+		self.texts = []
+		self.synthesized = threading.Event()
+
+	def tts(self, text, response_format=None):
+		self.texts.append(text)
+		self.synthesized.set()
+		return io.BytesIO(text.encode())
+
+
+class FakeBot:
+
+	def send_voice(self, chat_id, voice, **kwargs):
+		return voice
+
+
+class FakeMsg:
+	id = 1
+	message_thread_id = None
+
+	class chat:
+		id = 1
+
+
+TTS_CONFIG = ConfigSnapshot({'tts': {'min_chars': 1, 'workers': 2}})
+
+
+def test_sentences_synthesized_while_streaming(monkeypatch):
+	monkeypatch.setattr(utils.messages, 'encode_voice', lambda pcm: b'voice:' + pcm)
+	ai = FakeAI()
+
+	def chunks():
+		yield 'First one. Sec'
+		# The first sentence is synthesized before the stream goes on.
+		assert ai.synthesized.wait(5)
+		yield 'ond one.'
+
+	voice, text = reply_voice_msg_stream(FakeBot(), FakeMsg(), chunks(), ai, TTS_CONFIG)
+	assert text == 'First one. Second one.'
+	assert voice == b'voice:First one.Second one.'
+	assert ai.texts == ['First one.', 'Second one.']
+
+
+# Seconds the completion stand-in takes per sentence, and the TTS one
+# per request and per character.
+COMPLETION_SENTENCE_S = 0.05
+TTS_REQUEST_S = 0.05
+TTS_CHAR_S = 0.001
+
+REPLY_SENTENCES = [f'This is the sentence number {i} of a rather long voice reply.' for i in range(10)]
+
+
+class SlowTTS:
+	"""TTS taking time in proportion to the text's length."""
+
+	def tts(self, text, response_format=None):
+		time.sleep(TTS_REQUEST_S + len(text) * TTS_CHAR_S)
+		return io.BytesIO(text.encode())
+
+
+class TimedBot:
+	"""Bot recording when the voice reply is sent."""
+
+	def __init__(self):
+		self.sent_at = None
+
+	def send_voice(self, chat_id, voice, **kwargs):
+		self.sent_at = time.perf_counter()
+		return voice
+
+
+def generate_reply():
+	for sentence in REPLY_SENTENCES:
+		time.sleep(COMPLETION_SENTENCE_S)
+		yield sentence + ' '
+
+
+def test_streamed_voice_reply_latency(monkeypatch):
+	monkeypatch.setattr(utils.messages, 'encode_voice', lambda pcm: pcm)
+	config = ConfigSnapshot({'tts': {'min_chars': 1, 'workers': 4}})
+
+	# The whole reply is synthesized once generated.
+	bot = TimedBot()
+	start = time.perf_counter()
+	reply_voice_msg(bot, FakeMsg(), ''.join(generate_reply()), SlowTTS())
+	whole_s = bot.sent_at - start
+
+	bot = TimedBot()
+	start = time.perf_counter()
+	reply_voice_msg_stream(bot, FakeMsg(), generate_reply(), SlowTTS(), config)
+	streamed_s = bot.sent_at - start
+	print(f'Voice sent after {whole_s:.2f} s synthesizing the whole reply, {streamed_s:.2f} s streaming it')
+
+	# Only the last sentence is left to synthesize once generated.
+	assert streamed_s < whole_s * 0.75
+
+
+MARKDOWN_TEXTS = [
+	'',
+	'Plain text.',
+	'# Title\n\nSome **bold** and _italic_ text.\n\n- One\n- Two\n\n  Still in the list.\n\nEnd.',
+	'Code:\n\n```python\nx = 1\n\ny = [2]\n```\n\nAfter the code, a [link](https://example.com).',
+	'1. First\n\n2. Second\n\n> Quote\n\nTable:\n\n| a | b |\n|---|---|\n| 1 | 2 |\n',
+	'Special characters: 1+1=2 (yes) {ok} #tag!\n\n\n\nMore.',
+	'Here:\n\n~~~\ndef f():\n    pass\n\nx = 1\n~~~\n\nDone.',
+	'Nested:\n\n````markdown\n```\n\ncode\n```\n\n````\n\nDone.',
+	'Tildes:\n\n~~~~\na\n\n~~~\n\nb\n~~~~~\n\n```\n\n~~~\n```\n\nEnd.',
+	'Unclosed:\n\n  ```js\nlet x;\n\nlet y;',
+]
+
+
+def stream_markdown(text, size):
+	"""Return what a MarkdownStream formats after each chunk of a text."""
+	stream = MarkdownStream()
+	outputs = []
+	for i in range(0, len(text), size):
+		stream.append(text[i:i + size])
+		outputs.append((text[:i + size], stream.format()))
+	return outputs or [('', stream.format())]
+
+
+@pytest.mark.parametrize('text', MARKDOWN_TEXTS)
+@pytest.mark.parametrize('size', [1, 3, 7, 1000])
+def test_stream_formatted_like_whole_text(text, size):
+	for partial, formatted in stream_markdown(text, size):
+		assert formatted == process_text(partial)
+
+
+def test_stream_formats_only_the_tail(monkeypatch):
+	formatted_chars = []
+	markdownify = utils.messages.markdownify
+	def count(text):
+		formatted_chars.append(len(text))
+		return markdownify(text)
+	monkeypatch.setattr(utils.messages, 'markdownify', count)
+
+	paragraph = 'A paragraph of a long reply, with **some** formatting.\n\n'
+	stream_markdown(paragraph * 200, 20)
+	# Every update formats at most the last paragraphs, however long
+	# the reply is.
+	assert max(formatted_chars) <= 2 * len(paragraph)
+
+
+class EditBot:
+	"""Telegram bot posting and editing messages in memory."""
+
+	def __init__(self):
+		self.msgs = []
+		self.edits = 0
+		self.rate_limited = threading.Event()
+		self.limited = False
+
+	def reply_to(self, msg, text, **kwargs):
+		assert len(text) <= MAX_MSG_LEN
+		tg_msg = SimpleNamespace(id=len(self.msgs), chat=msg.chat, text=text)
+		self.msgs.append(tg_msg)
+		return tg_msg
+
+	def edit_message_text(self, text, chat_id, msg_id, **kwargs):
+		assert len(text) <= MAX_MSG_LEN
+		if self.limited:
+			self.rate_limited.set()
+			raise TooManyRequests()
+		self.edits += 1
+		self.msgs[msg_id].text = text
+
+
+class TooManyRequests(Exception):
+	error_code = 429
+	result_json = {'parameters': {'retry_after': 60}}
+
+
+def make_reply(bot):
+	msg = SimpleNamespace(id=1, chat=SimpleNamespace(id=1), message_thread_id=None)
+	return EditedReply(msg, bot.reply_to(msg, '…'))
+
+
+def stream_reply(text, size=50, sends=20):
+	"""Stream a text into an edited reply, sending it now and then,
+	return the texts of its messages."""
+	bot = EditBot()
+	reply = make_reply(bot)
+	send_every = max(1, len(text) // size // sends)
+	for n, i in enumerate(range(0, len(text), size)):
+		reply.append(text[i:i + size])
+		if n % send_every == 0:
+			send_reply_edits(bot, reply)
+	send_reply_edits(bot, reply)
+	assert reply.get_text() == text
+	return [tg_msg.text for tg_msg in bot.msgs]
+
+
+def test_short_reply_edited_in_place():
+	assert stream_reply('Hello **there**.') == [process_text('Hello **there**.')]
+
+
+def test_reply_split_at_lines():
+	lines = [f'Line {i} of the reply.' for i in range(300)]
+	texts = stream_reply('\n'.join(lines))
+	assert len(texts) > 1
+	# Every message ends at a line.
+	assert sum(text.strip().count('\n') + 1 for text in texts) == 300
+
+
+def test_escaped_reply_split_below_max_length():
+	# Escaping makes the formatted text longer than the raw one.
+	texts = stream_reply('abcd. ' * 2000)
+	assert len(texts) >= 3
+	assert all(len(text) <= MAX_MSG_LEN for text in texts)
+	assert ''.join(texts).replace('\\', '').count('abcd.') == 2000
+
+
+def test_code_block_closed_and_opened_again():
+	code = '\n'.join(f'x_{i} = {i}  # {"." * 40}' for i in range(200))
+	text = f'Code:\n\n```python\n{code}\n```\n\nDone.'
+	texts = stream_reply(text)
+	assert len(texts) > 1
+	for part in texts:
+		assert part.count('```') % 2 == 0
+
+
+def test_soft_cut_outside_code_blocks():
+	text = 'a\n' * (STREAM_MSG_SOFT_MAX_CHARS // 2 - 5) + '```\ncode\n\nmore\n```\nend\n' + 'b\n' * 10
+	texts = stream_reply(text, size=7)
+	# Cut at the end of the code block past the soft max length.
+	assert len(texts) == 2
+	assert texts[1] == process_text('end\n' + 'b\n' * 10)
+
+
+def test_long_line_cut():
+	texts = stream_reply('x' * 10000, size=500)
+	assert len(texts) == 3
+	assert all(len(text) <= MAX_MSG_LEN for text in texts)
+	assert ''.join(texts).count('x') == 10000
+
+
+def test_reply_sent_whole_when_edits_rate_limited():
+	bot = EditBot()
+	bot.limited = True
+	msg = SimpleNamespace(id=1, chat=SimpleNamespace(id=-4242), message_thread_id=None)
+	text = 'First part of the reply.\n\nSecond part.'
+
+	def chunks():
+		yield text[:10]
+		# The edits stop once Telegram asks to wait too long.
+		assert bot.rate_limited.wait(5)
+		time.sleep(0.05)
+		bot.limited = False
+		yield text[10:]
+
+	tg_msg, reply_text = reply_chat_msg_stream_edits(bot, msg, chunks())
+	assert reply_text == text
+	assert tg_msg.text == process_text(text)
+	# Only the complete reply is sent.
+	assert bot.edits == 1
\ No newline at end of file
@@ -0,0 +1,179 @@
+import io
+import time
+import asyncio
+import threading
+
+import pytest
+from telebot import apihelper, asyncio_helper
+from telebot.types import InputFile
+
+from constants.telegram import MAX_CHAT_MSG_BURST
+
+from utils.outbound import PRIORITY_DRAFT, PRIORITY_REPLY, OutboundLimiter, install_outbound_limiter, outbound_options
+from utils.rate_limit import TokenBucket
+
+
+
+class CountingBucket(TokenBucket):
+	"""Token bucket counting how often it's checked."""
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.checks = 0
+
+	def get_wait_time(self, tokens=1):
+		self.checks += 1
+		return super().get_wait_time(tokens)
+
+
+def make_limiter(rate=1000, capacity=1):
+	limiter = OutboundLimiter()
+	limiter.bucket = CountingBucket(rate, capacity)
+	return limiter
+
+
+def start_acquire(limiter, chat_id, sent, name, priority=PRIORITY_REPLY):
+	def acquire():
+		with outbound_options(priority):
+			limiter.acquire(chat_id)
+		sent.append(name)
+	thread = threading.Thread(target=acquire)
+	thread.start()
+	return thread
+
+
+def wait_queued(limiter, count):
+	deadline = time.monotonic() + 5
+	while limiter._count < count:
+		assert time.monotonic() < deadline
+		time.sleep(0.001)
+
+
+def test_sent_by_priority_then_order():
+	limiter = make_limiter(rate=20)
+	sent = []
+	# Take the budget so the next requests queue up.
+	limiter.acquire(None)
+	threads = [start_acquire(limiter, None, sent, 'draft', PRIORITY_DRAFT)]
+	wait_queued(limiter, 1)
+	for i in range(3):
+		threads.append(start_acquire(limiter, i + 1, sent, f'reply {i}'))
+		wait_queued(limiter, i + 2)
+	for thread in threads:
+		thread.join(5)
+	assert sent == ['reply 0', 'reply 1', 'reply 2', 'draft']
+
+
+def test_chat_budget_not_blocking_other_chats():
+	limiter = make_limiter()
+	limiter.chat_buckets.get(1).consume(MAX_CHAT_MSG_BURST)
+	sent = []
+	blocked = start_acquire(limiter, 1, sent, 'blocked')
+	wait_queued(limiter, 1)
+	start_acquire(limiter, 2, sent, 'other').join(5)
+	assert sent == ['other']
+	# The chat's budget is back after a second.
+	blocked.join(5)
+	assert sent == ['other', 'blocked']
+
+
+def test_group_budget():
+	limiter = make_limiter()
+	assert limiter.get_chat_bucket(-100) is limiter.group_buckets.get(-100)
+	assert limiter.get_chat_bucket('@channel') is limiter.group_buckets.get('@channel')
+	assert limiter.get_chat_bucket(100) is limiter.chat_buckets.get(100)
+
+
+def test_waiters_not_polling():
+	limiter = make_limiter(rate=5)
+	limiter.acquire(None)
+	sent = []
+	threads = [start_acquire(limiter, None, sent, i) for i in range(50)]
+	wait_queued(limiter, 50)
+	checks = limiter.bucket.checks
+	time.sleep(0.15)
+	# Only the leader wakes up, when the budget is back.
+	assert limiter.bucket.checks - checks <= 3
+	limiter.bucket = TokenBucket(1e6, 100)
+	with limiter._lock:
+		limiter._dispatch()
+	for thread in threads:
+		thread.join(5)
+	assert sorted(sent) == list(range(50))
+
+
+def test_async_waiters():
+	limiter = make_limiter(rate=200)
+
+	async def main():
+		sent = []
+
+		async def acquire(i):
+			await limiter.aacquire(i % 5)
+			sent.append(i)
+
+		await asyncio.gather(*(acquire(i) for i in range(10)))
+		return sent
+
+	assert sorted(asyncio.run(main())) == list(range(10))
+	assert limiter._count == 0
+
+
+def test_cancelled_waiter_removed():
+	limiter = make_limiter(rate=0.001)
+	limiter.acquire(None)
+
+	async def main():
+		task = asyncio.create_task(limiter.aacquire(None))
+		await asyncio.sleep(0.05)
+		assert limiter._count == 1
+		task.cancel()
+		with pytest.raises(asyncio.CancelledError):
+			await task
+
+	asyncio.run(main())
+	assert limiter._count == 0
+	assert not limiter._queues
+
+
+def rate_limited_once(uploads, helper):
+	"""Return a request function reading the files it's given, which
+	fails the first time as if Telegram rate limited it."""
+	def request(token, method_name, method='get', params=None, files=None):
+		uploads.append({
+			key: (value[-1] if isinstance(value, tuple) else value.file).read()
+			for key, value in files.items()
+		})
+		if len(uploads) == 1:
+			raise helper.ApiTelegramException(method_name, None, {
+				'error_code': 429,
+				'description': 'Too Many Requests',
+				'parameters': {'retry_after': 0},
+			})
+		return True
+	return request
+
+
+@pytest.mark.parametrize('runtime', ['threaded', 'asyncio'])
+def test_files_uploaded_whole_when_retried(monkeypatch, runtime):
+	uploads = []
+	request = rate_limited_once(uploads, apihelper)
+	arequest = rate_limited_once(uploads, asyncio_helper)
+
+	async def process_request(token, url, method='get', params=None, files=None, **kwargs):
+		return arequest(token, url, method, params, files)
+
+	monkeypatch.setattr(apihelper, '_make_request', request)
+	monkeypatch.setattr(asyncio_helper, '_process_request', process_request)
+	install_outbound_limiter()
+
+	files = {
+		'voice': InputFile(io.BytesIO(b'voice')),
+		'thumbnail': ('thumbnail.jpg', io.BytesIO(b'thumbnail')),
+	}
+	params = {'chat_id': 1}
+	if runtime == 'asyncio':
+		asyncio.run(asyncio_helper._process_request('123:test', 'sendVoice', 'post', params, files))
+	else:
+		apihelper._make_request('123:test', 'sendVoice', 'post', params, files)
+	assert uploads == [{'voice': b'voice', 'thumbnail': b'thumbnail'}] * 2
\ No newline at end of file
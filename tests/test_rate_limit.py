@@ -0,0 +1,163 @@
+import time
+import threading
+
+import pytest
+
+import utils.rate_limit
+from utils.rate_limit import TokenBucket, TokenBucketRegistry
+from utils.streaming import DraftScheduler
+
+
+
+class FakeClock:
+
+	def __init__(self):
+		self.now = 0.0
+
+	def monotonic(self):
+		return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	clock = FakeClock()
+	monkeypatch.setattr(utils.rate_limit, 'time', clock)
+	return clock
+
+
+def test_burst_then_rate(clock):
+	bucket = TokenBucket(rate=2, capacity=3)
+	assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+	assert bucket.get_wait_time() == pytest.approx(0.5)
+	clock.now += 0.5
+	assert bucket.try_acquire()
+	assert not bucket.try_acquire()
+
+
+def test_refill_capped(clock):
+	bucket = TokenBucket(rate=1, capacity=2)
+	bucket.consume(2)
+	clock.now += 100
+	assert [bucket.try_acquire() for _ in range(3)] == [True, True, False]
+
+
+def test_consume_past_zero_and_give_back(clock):
+	bucket = TokenBucket(rate=1, capacity=1)
+	bucket.consume(3)
+	assert bucket.get_wait_time() == pytest.approx(3)
+	bucket.consume(-2)
+	assert bucket.get_wait_time() == pytest.approx(1)
+
+
+def test_penalize(clock):
+	bucket = TokenBucket(rate=1, capacity=5)
+	bucket.penalize(10)
+	assert bucket.get_wait_time() == pytest.approx(11)
+	clock.now += 11
+	assert bucket.try_acquire()
+
+
+def test_concurrent_acquires_never_exceed_capacity():
+	bucket = TokenBucket(rate=1e-6, capacity=100)
+	acquired = []
+
+	def acquire():
+		acquired.append(sum(bucket.try_acquire() for _ in range(50)))
+
+	threads = [threading.Thread(target=acquire) for _ in range(8)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert sum(acquired) == 100
+
+
+def test_registry_bucket_per_key():
+	registry = TokenBucketRegistry(rate=1, capacity=2)
+	assert registry.get('a') is registry.get('a')
+	assert registry.get('a') is not registry.get('b')
+	assert registry.get('a').capacity == 2
+
+
+def test_registry_forgets_least_recently_used():
+	registry = TokenBucketRegistry(rate=1, max_size=2)
+	a, b = registry.get('a'), registry.get('b')
+	registry.get('a')
+	registry.get('c')
+	assert registry.get('a') is a
+	assert registry.get('b') is not b
+
+
+class TooManyRequests(Exception):
+	error_code = 429
+	result_json = {'parameters': {'retry_after': 1}}
+
+
+def test_drafts_coalesced_while_sending():
+	sent = []
+	sending = threading.Event()
+	release = threading.Event()
+
+	def send(text):
+		sent.append(text)
+		sending.set()
+		release.wait(5)
+
+	scheduler = DraftScheduler(send, TokenBucket(rate=1000, capacity=10))
+	scheduler.update('a')
+	assert sending.wait(5)
+	# Updating never waits for the draft being sent.
+	start = time.monotonic()
+	for text in ('ab', 'abc', 'abcd'):
+		scheduler.update(text)
+	assert time.monotonic() - start < 0.1
+	release.set()
+	while sent[-1] != 'abcd':
+		time.sleep(0.01)
+	scheduler.close()
+	assert sent == ['a', 'abcd']
+	assert scheduler.draft_count == 2
+
+
+def test_drafts_limited_by_bucket():
+	sent = []
+	bucket = TokenBucket(rate=0.001, capacity=1)
+	scheduler = DraftScheduler(sent.append, bucket)
+	for i in range(5):
+		scheduler.update(str(i))
+		time.sleep(0.02)
+	scheduler.close()
+	assert sent == ['0']
+
+
+def test_draft_resent_after_rate_limit():
+	sent = []
+
+	def send(text):
+		sent.append(text)
+		if len(sent) == 1:
+			raise TooManyRequests()
+
+	bucket = TokenBucket(rate=1000, capacity=1)
+	scheduler = DraftScheduler(send, bucket, max_retry_after=5)
+	scheduler.update('a')
+	deadline = time.monotonic() + 5
+	while len(sent) < 2 and time.monotonic() < deadline:
+		time.sleep(0.01)
+	scheduler.close()
+	assert sent == ['a', 'a']
+
+
+def test_drafts_stopped_when_rate_limited_too_long():
+	sent = []
+
+	def send(text):
+		sent.append(text)
+		raise TooManyRequests()
+
+	scheduler = DraftScheduler(send, TokenBucket(rate=1000, capacity=1), max_retry_after=0.5)
+	scheduler.update('a')
+	scheduler._thread.join(5)
+	assert not scheduler._thread.is_alive()
+	scheduler.close()
+	assert sent == ['a']
\ No newline at end of file
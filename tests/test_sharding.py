@@ -0,0 +1,80 @@
+import os
+import sys
+import subprocess
+from collections import Counter
+
+import pytest
+
+from utils.sharding import Supervisor, get_shard_index, get_update_chat_key
+
+
+
+def make_update(chat_id, thread_id=None, kind='message'):
+	msg = {'message_id': 1, 'chat': {'id': chat_id, 'type': 'private'}}
+	if thread_id:
+		msg['message_thread_id'] = thread_id
+	if kind == 'callback_query':
+		return {'update_id': 1, kind: {'id': '1', 'message': msg}}
+	return {'update_id': 1, kind: msg}
+
+
+def test_update_chat_key():
+	assert get_update_chat_key(make_update(5)) == (5, 0)
+	assert get_update_chat_key(make_update(-5, 7)) == (-5, 7)
+	assert get_update_chat_key(make_update(5, kind='edited_message')) == (5, 0)
+	assert get_update_chat_key(make_update(5, 7, kind='callback_query')) == (5, 7)
+	assert get_update_chat_key({'update_id': 1, 'poll': {'id': '1'}}) is None
+
+
+def test_shards_spread_evenly():
+	counts = Counter(get_shard_index((chat_id, 0), 4) for chat_id in range(10000))
+	assert set(counts) == {0, 1, 2, 3}
+	assert min(counts.values()) > 2000
+
+
+def test_shard_same_in_every_process():
+	keys = [(chat_id, thread_id) for chat_id in (-100123, 1, 42, 10**12) for thread_id in (0, 7)]
+	code = f'from utils.sharding import get_shard_index; print([get_shard_index(k, 7) for k in {keys!r}])'
+	outputs = set()
+	for seed in ('0', '1', 'random'):
+		env = dict(os.environ, PYTHONHASHSEED=seed)
+		outputs.add(subprocess.run(
+			[sys.executable, '-c', code],
+			cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+			env=env,
+			capture_output=True,
+			text=True,
+			check=True
+		).stdout)
+	assert outputs == {f'{[get_shard_index(k, 7) for k in keys]}\n'}
+
+
+class FakeWorker:
+
+	def __init__(self):
+		self.updates = []
+
+	def send(self, msg):
+		self.updates.append(msg[1]['update_id'])
+
+
+@pytest.fixture
+def supervisor():
+	supervisor = Supervisor(3)
+	supervisor.workers = [FakeWorker() for _ in range(3)]
+	yield supervisor
+	supervisor.listener.close()
+
+
+def test_chat_updates_routed_in_order_to_one_worker(supervisor):
+	for update_id in range(30):
+		update = make_update(update_id % 5)
+		update['update_id'] = update_id
+		supervisor.route(update)
+
+	for chat_id in range(5):
+		expected = list(range(chat_id, 30, 5))
+		index = get_shard_index((chat_id, 0), 3)
+		for other, worker in enumerate(supervisor.workers):
+			updates = [u for u in worker.updates if u % 5 == chat_id]
+			assert updates == (expected if other == index else [])
\ No newline at end of file
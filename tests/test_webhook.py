@@ -0,0 +1,177 @@
+import json
+import time
+import socket
+import asyncio
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from utils.webhook import SECRET_TOKEN_HEADER, UpdateDeduplicator, arun_webhook_server, is_valid_secret_token, parse_update_json, run_webhook_server
+
+
+
+def test_duplicates_are_seen():
+	dedup = UpdateDeduplicator()
+	assert not dedup.seen(1)
+	assert not dedup.seen(2)
+	assert dedup.seen(1)
+	assert dedup.seen(2)
+
+
+def test_oldest_ids_are_forgotten():
+	dedup = UpdateDeduplicator(max_size=2)
+	for update_id in (1, 2, 3):
+		dedup.seen(update_id)
+	assert not dedup.seen(1)
+	assert dedup.seen(3)
+
+
+def test_seen_ids_are_kept_longer():
+	dedup = UpdateDeduplicator(max_size=2)
+	dedup.seen(1)
+	dedup.seen(2)
+	# Seen again, so 2 is the oldest one.
+	dedup.seen(1)
+	dedup.seen(3)
+	assert dedup.seen(1)
+	assert not dedup.seen(2)
+
+
+def test_retried_update_is_dropped():
+	dedup = UpdateDeduplicator()
+	body = json.dumps({'update_id': 5, 'message': {}}).encode()
+	assert parse_update_json(body, dedup)['update_id'] == 5
+	assert parse_update_json(body, dedup) is None
+
+
+def test_secret_token():
+	assert is_valid_secret_token('secret', 'secret')
+	assert not is_valid_secret_token('other', 'secret')
+	assert not is_valid_secret_token(None, 'secret')
+
+
+SECRET = 'secret'
+PATH = '/webhook'
+
+
+def make_update(update_id):
+	"""Return an update as Telegram posts it."""
+	return {
+		'update_id': update_id,
+		'message': {
+			'message_id': update_id,
+			'from': {'id': 10, 'is_bot': False, 'first_name': 'User'},
+			'chat': {'id': 10, 'type': 'private', 'first_name': 'User'},
+			'date': 1700000000,
+			'text': f'Message {update_id}',
+		},
+	}
+
+
+def get_free_port():
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		return sock.getsockname()[1]
+
+
+def post(port, body, path=PATH, secret=SECRET):
+	"""POST a body to the webhook and return the response status."""
+	request = urllib.request.Request(f'http://127.0.0.1:{port}{path}', data=body, method='POST')
+	if secret:
+		request.add_header(SECRET_TOKEN_HEADER, secret)
+	try:
+		with urllib.request.urlopen(request, timeout=5) as resp:
+			return resp.status
+	except urllib.error.HTTPError as e:
+		return e.code
+
+
+def wait_listening(port):
+	deadline = time.monotonic() + 5
+	while True:
+		try:
+			socket.create_connection(('127.0.0.1', port), timeout=1).close()
+			return
+		except OSError:
+			assert time.monotonic() < deadline
+			time.sleep(0.01)
+
+
+class FakeBot:
+
+	def __init__(self):
+		self.update_ids = []
+
+	def process_new_updates(self, updates):
+		self.update_ids += [update.update_id for update in updates]
+
+
+class AsyncFakeBot(FakeBot):
+
+	async def process_new_updates(self, updates):
+		super().process_new_updates(updates)
+
+
+@pytest.fixture
+def threaded_server():
+	bot = FakeBot()
+	port = get_free_port()
+	threading.Thread(
+		target=run_webhook_server,
+		args=(bot, '127.0.0.1', port, PATH, SECRET, UpdateDeduplicator()),
+		daemon=True
+	).start()
+	wait_listening(port)
+	return bot, port
+
+
+@pytest.fixture
+def async_server():
+	bot = AsyncFakeBot()
+	port = get_free_port()
+	loop = asyncio.new_event_loop()
+	task = loop.create_task(arun_webhook_server(bot, '127.0.0.1', port, PATH, SECRET, UpdateDeduplicator()))
+	thread = threading.Thread(target=loop.run_forever, daemon=True)
+	thread.start()
+	wait_listening(port)
+	yield bot, port
+	loop.call_soon_threadsafe(task.cancel)
+	time.sleep(0.1)
+	loop.call_soon_threadsafe(loop.stop)
+	thread.join(5)
+
+
+@pytest.fixture(params=['threaded', 'async'])
+def server(request):
+	return request.getfixturevalue(f'{request.param}_server')
+
+
+def test_updates_handled_once(server):
+	bot, port = server
+	for update_id in (1, 2, 1, 3, 2):
+		assert post(port, json.dumps(make_update(update_id)).encode()) == 200
+	assert bot.update_ids == [1, 2, 3]
+
+
+def test_wrong_secret_rejected(server):
+	bot, port = server
+	assert post(port, json.dumps(make_update(1)).encode(), secret='wrong') == 403
+	assert post(port, json.dumps(make_update(1)).encode(), secret=None) == 403
+	assert bot.update_ids == []
+
+
+def test_wrong_path_not_found(server):
+	bot, port = server
+	assert post(port, json.dumps(make_update(1)).encode(), path='/other') == 404
+	assert bot.update_ids == []
+
+
+@pytest.mark.parametrize('body', [b'not json', b'{}', b'{"message": {}}'])
+def test_malformed_body_rejected(server, body):
+	bot, port = server
+	assert post(port, body) == 400
+	# The update isn't recorded as seen.
+	assert post(port, json.dumps(make_update(1)).encode()) == 200
+	assert bot.update_ids == [1]
\ No newline at end of file
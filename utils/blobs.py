@@ -0,0 +1,195 @@
+import time
+import hashlib
+from base64 import b64decode
+
+from sqlalchemy import String, cast, delete, exists, insert, select
+from sqlalchemy.exc import IntegrityError
+
+from models.chat import Blob, Message, message_blobs
+from utils.db import insert_or_ignore
+from utils.media import build_data_url, encode_image
+from utils.media_executor import media_executor
+from utils.metrics import metrics
+
+
+
+# Scheme of the URLs referencing blobs in messages' content.
+BLOB_URL_PREFIX = 'blob:'
+
+
+def get_blob_url(sha256):
+	"""Return the URL referencing a blob."""
+	return f'{BLOB_URL_PREFIX}{sha256}'
+
+
+def parse_blob_url(url):
+	"""Return the digest of the blob referenced by a URL, or None if
+	the URL doesn't reference a blob."""
+	if url.startswith(BLOB_URL_PREFIX):
+		return url[len(BLOB_URL_PREFIX):]
+
+
+def new_blob(data, content_type):
+	"""Create a blob, keyed by the digest of its data."""
+	return Blob(
+		sha256=hashlib.sha256(data).hexdigest(),
+		content_type=content_type,
+		data=data
+	)
+
+
+def new_image_blob(img, *args, **kwargs):
+	"""Create a blob for an image, as bytes or a binary file, prepared
+	for the vision model, see encode_image() for the arguments."""
+	content_type, data = media_executor.run(encode_image, img, *args, **kwargs)
+	return new_blob(data, content_type)
+
+
+def iter_content_img_urls(content):
+	"""Yield the image URL items of a message's content."""
+	if isinstance(content, list):
+		for item in content:
+			if item['type'] == 'image_url':
+				yield item['image_url']
+
+
+def add_blob(ses, blob):
+	"""
+	Add a blob to a database session unless it's stored already and
+	return the URL referencing it.
+
+	Args:
+		ses:			Database session.
+		blob:			Blob.
+	"""
+
+	# Another session may store the same blob meanwhile, let the
+	# database tell if it's stored already.
+	if (stmt := insert_or_ignore(ses, Blob)) is not None:
+		stored = ses.execute(stmt.values(
+			sha256=blob.sha256,
+			content_type=blob.content_type,
+			data=blob.data
+		)).rowcount > 0
+	else:
+		try:
+			with ses.begin_nested():
+				ses.add(blob)
+			stored = True
+		except IntegrityError:
+			stored = False
+
+	if stored:
+		metrics.inc('blobs.stored')
+		metrics.inc('blobs.stored_bytes', len(blob.data))
+	else:
+		metrics.inc('blobs.deduplicated')
+
+	return get_blob_url(blob.sha256)
+
+
+def link_content_blobs(ses, msg_id, content):
+	"""
+	Record the blobs referenced by a message's content.
+
+	Args:
+		ses:			Database session.
+		msg_id:			Message's id.
+		content:		Message's content.
+	"""
+
+	sha256s = {
+		parse_blob_url(img_url['url'])
+		for img_url in iter_content_img_urls(content)
+	} - {None}
+	if sha256s:
+		# The message must be stored first.
+		ses.flush()
+		ses.execute(
+			insert(message_blobs),
+			[{'message_id': msg_id, 'blob_sha256': sha256} for sha256 in sha256s]
+		)
+
+
+def resolve_blob_urls(ses, msgs):
+	"""
+	Return a copy of a list of context messages where URLs referencing
+	blobs are replaced by data-URLs.
+
+	Args:
+		ses:			Database session.
+		msgs:			Context messages.
+	"""
+
+	sha256s = {
+		sha256
+		for msg in msgs
+		for img_url in iter_content_img_urls(msg['content'])
+		if (sha256 := parse_blob_url(img_url['url']))
+	}
+	if not sha256s:
+		return msgs
+
+	start = time.monotonic()
+	stmt = select(Blob.sha256, Blob.content_type, Blob.data).where(Blob.sha256.in_(sha256s))
+	data_urls = {
+		sha256: build_data_url(content_type, data)
+		for sha256, content_type, data in ses.execute(stmt)
+	}
+
+	def resolve_item(item):
+		if item['type'] != 'image_url':
+			return item
+		url = item['image_url']['url']
+		url = data_urls.get(parse_blob_url(url), url)
+		return {**item, 'image_url': {**item['image_url'], 'url': url}}
+
+	# Don't modify the messages as their content may be cached.
+	resolved_msgs = []
+	for msg in msgs:
+		if isinstance(msg['content'], list):
+			msg = {**msg, 'content': [resolve_item(item) for item in msg['content']]}
+		resolved_msgs.append(msg)
+
+	metrics.observe('blobs.resolve_s', time.monotonic() - start)
+	return resolved_msgs
+
+
+def delete_orphan_blobs(ses):
+	"""
+	Delete the blobs no message references.
+
+	Args:
+		ses:			Database session.
+	"""
+	referenced = exists().where(message_blobs.c.blob_sha256 == Blob.sha256)
+	ses.execute(delete(Blob).where(~referenced))
+
+
+def migrate_data_urls(ses):
+	"""
+	Move the images stored as data-URLs in messages' content to blobs.
+	It scans the messages, run it once through run_migration().
+
+	Args:
+		ses:			Database session.
+	"""
+
+	# Narrow the scan down to messages that may embed data-URLs.
+	stmt = select(Message).where(cast(Message.content, String).like('%data:%'))
+	for msg in ses.scalars(stmt).all():
+		if not isinstance(msg.content, list):
+			continue
+
+		content = []
+		for item in msg.content:
+			if item['type'] == 'image_url' and item['image_url']['url'].startswith('data:'):
+				header, data = item['image_url']['url'].split(',', 1)
+				content_type = header[len('data:'):].split(';')[0]
+				url = add_blob(ses, new_blob(b64decode(data), content_type))
+				item = {**item, 'image_url': {**item['image_url'], 'url': url}}
+			content.append(item)
+
+		if content != msg.content:
+			msg.content = content
+			link_content_blobs(ses, msg.id, content)
\ No newline at end of file
@@ -2,9 +2,13 @@ from datetime import datetime, timedelta, timezone
 import functools
 import inspect
 
-from sqlalchemy import delete
+from sqlalchemy import delete, func, select, update
 
+from ai.tokens import count_msg_tokens
 from models.chat import MessageRole, Chat, Message
+from utils.blobs import delete_orphan_blobs, link_content_blobs
+from utils.context_cache import CachedContext, CachedMessage, context_cache, get_pending_contexts
+from utils.metrics import metrics
 
 
 
@@ -27,6 +31,18 @@ def use_non_none_thread_id(fn):
     return wrapper
 
 
+def get_chat_key(msg):
+    """
+    Return the primary key of the chat a Telegram message or update
+    belongs to.
+
+    Args:
+        msg:            Telegram message or update with a chat.
+    """
+    # Updates other than messages have no thread.
+    return msg.chat.id, getattr(msg, 'message_thread_id', None) or 0
+
+
 @use_non_none_thread_id
 def get_chat(ses, id, thread_id=None):
     """
@@ -56,6 +72,7 @@ def get_or_create_chat(ses, id, config, thread_id=None, *args, **kwargs):
             id=id,
             thread_id=thread_id,
             sys_msg=config.get('chat.default_sys_msg'),
+            msg_count=0,
             *args,
             **kwargs
         )
@@ -64,10 +81,95 @@ def get_or_create_chat(ses, id, config, thread_id=None, *args, **kwargs):
     return chat
 
 
+def is_context_current(ses, id, thread_id, ctx):
+    """Return True if a cached context matches the chat's stored
+    system message, message count and newest message, i.e. no other
+    process changed the chat since it was cached."""
+    newest_id = select(func.max(Message.id))\
+        .where(Message.chat_id == id, Message.thread_id == thread_id)\
+        .scalar_subquery()
+    stmt = select(Chat.sys_msg, Chat.msg_count, newest_id)\
+        .where(Chat.id == id, Chat.thread_id == thread_id)
+    row = ses.execute(stmt).first()
+    return row is not None and tuple(row) == (
+        ctx.sys_msg,
+        ctx.msg_count,
+        ctx.messages[-1].id if ctx.messages else None
+    )
+
+
+@use_non_none_thread_id
+def get_cached_context(ses, id, config, thread_id=None):
+    """
+    Return the cached context of a chat as seen by a database session,
+    create the chat if nonexistent. Changes to the returned context
+    are stored in the cache when the session commits.
+
+    Args:
+        ses:            Database session.
+        id:             Chat's id.
+        config:         Bot configuration manager.
+    """
+
+    key = (id, thread_id)
+    pending = get_pending_contexts(ses)
+    if key in pending:
+        # Changed in this session, or invalidated if None.
+        ctx = pending[key]
+    else:
+        ctx = context_cache.get(key)
+        if ctx and context_cache.validate and not is_context_current(ses, id, thread_id, ctx):
+            metrics.inc('context_cache.stale')
+            ctx = None
+
+    if not ctx:
+        chat = get_or_create_chat(ses, id, config, thread_id=thread_id)
+        if chat.msg_count is None:
+            # Chat created before messages were counted.
+            chat.msg_count = chat.messages.count()
+
+        ctx = CachedContext(
+            chat.sys_msg,
+            chat.msg_count,
+            [
+                CachedMessage.from_message(msg)
+                for msg in chat.get_recent_messages(config.get('chat.max_msgs'))
+            ][::-1]
+        )
+
+    pending[key] = ctx
+    return ctx
+
+
+@use_non_none_thread_id
+def invalidate_cached_context(ses, id, thread_id=None):
+    """
+    Invalidate the cached context of a chat when a database session
+    commits.
+
+    Args:
+        ses:            Database session.
+        id:             Chat's id.
+    """
+    get_pending_contexts(ses)[(id, thread_id)] = None
+
+
+def update_chat(ses, id, thread_id, **values):
+    """Update a chat's fields without loading it, return False if
+    the chat doesn't exist."""
+    stmt = update(Chat)\
+        .where(Chat.id == id, Chat.thread_id == thread_id)\
+        .values(**values)
+    return ses.execute(stmt).rowcount > 0
+
+
 @use_non_none_thread_id
 def add_msg(ses, id, user_name, chat_id, config, content, thread_id=None, role=MessageRole.user):
     """
     Create and add a message to a chat.
+
+    The chat's cached context is updated along, so that only writes
+    are issued once it is cached.
     
     Args:
         ses:            Database session.
@@ -78,20 +180,55 @@ def add_msg(ses, id, user_name, chat_id, config, content, thread_id=None, role=M
         role:           Message type.
     """
 
-    chat = get_or_create_chat(ses, chat_id, config, thread_id=thread_id)
-    chat.last_msg_at = datetime.now(timezone.utc)
+    ctx = get_cached_context(ses, chat_id, config, thread_id=thread_id)
+    chat_values = {
+        'last_msg_at': datetime.now(timezone.utc),
+        'msg_count': Chat.msg_count + 1,
+    }
+    if not update_chat(ses, chat_id, thread_id, **chat_values):
+        # The chat was deleted after its context was cached.
+        context_cache.invalidate((chat_id, thread_id))
+        del get_pending_contexts(ses)[(chat_id, thread_id)]
+        ctx = get_cached_context(ses, chat_id, config, thread_id=thread_id)
+        update_chat(ses, chat_id, thread_id, **chat_values)
 
     msg = Message(
         id=id,
         user_name=user_name,
-        chat=chat,
+        chat_id=chat_id,
+        thread_id=thread_id,
         role=role,
-        content=content
+        content=content,
+        tokens=count_msg_tokens(content)
     )
     ses.add(msg)
+    link_content_blobs(ses, id, content)
+
+    max_msgs = config.get('chat.max_msgs')
+    ctx.append(CachedMessage.from_message(msg), max_msgs)
+    ctx.msg_count += 1
 
-    if chat.messages.count() > config.get('chat.max_msgs'):
-        ses.delete(chat.messages.first())
+    # Let the messages exceed the limit by 'chat.trim_interval' and
+    # then delete the older ones all at once instead of deleting one
+    # per insert. The context must be limited to 'chat.max_msgs'
+    # accordingly.
+    if ctx.msg_count > max_msgs + config.get('chat.trim_interval'):
+        # Keep the newest stored messages rather than the cached ones,
+        # which may miss the ones added by other processes.
+        in_chat = (Message.chat_id == chat_id, Message.thread_id == thread_id)
+        stmt = select(Message.id)\
+            .where(*in_chat)\
+            .order_by(Message.id.desc())\
+            .offset(max_msgs - 1)\
+            .limit(1)
+        if (oldest_id := ses.execute(stmt).scalar()) is not None:
+            ses.execute(delete(Message).where(*in_chat, Message.id < oldest_id))
+            ctx.msg_count = max_msgs
+        else:
+            # Fewer messages are stored than counted.
+            stmt = select(func.count()).select_from(Message).where(*in_chat)
+            ctx.msg_count = ses.execute(stmt).scalar()
+        update_chat(ses, chat_id, thread_id, msg_count=ctx.msg_count)
 
 
 def add_telegram_msg(ses, msg, config, content, role=MessageRole.user):
@@ -121,7 +258,7 @@ def add_telegram_msg(ses, msg, config, content, role=MessageRole.user):
 def purge_old_chats(ses, config):
     """
     Delete chats older than the days set at 'chat.purge_days' in
-    the bot configuration.
+    the bot configuration, and the media no longer referenced.
 
     Args:
         ses:        Database session.
@@ -130,4 +267,95 @@ def purge_old_chats(ses, config):
 
     cutoff = datetime.now(timezone.utc) - timedelta(days=config.get('chat.purge_days'))
     stmt = delete(Chat).where(Chat.last_msg_at < cutoff)
-    ses.execute(stmt)
\ No newline at end of file
+    ses.execute(stmt)
+    delete_orphan_blobs(ses)
+    # Purging is rare, forget all the contexts rather than finding
+    # the purged ones.
+    context_cache.clear()
+
+
+# Async counterparts for the asyncio runtime. The ORM helpers above
+# rely on dynamic relationships which can't be loaded asynchronously,
+# so run them on the sync session wrapped by the async one.
+
+
+async def aget_chat(ses, id, thread_id=None):
+    """
+    Async counterpart of get_chat().
+
+    Args:
+        ses:            Async database session.
+        id:             Chat's id.
+    """
+    return await ses.run_sync(get_chat, id, thread_id=thread_id)
+
+
+async def aget_or_create_chat(ses, id, config, thread_id=None, *args, **kwargs):
+    """
+    Async counterpart of get_or_create_chat().
+
+    Args:
+        ses:            Async database session.
+        id:             Chat's id.
+        config:         Bot configuration manager.
+    """
+    return await ses.run_sync(get_or_create_chat, id, config, thread_id, *args, **kwargs)
+
+
+async def aget_cached_context(ses, id, config, thread_id=None):
+    """
+    Async counterpart of get_cached_context().
+
+    Args:
+        ses:            Async database session.
+        id:             Chat's id.
+        config:         Bot configuration manager.
+    """
+    return await ses.run_sync(get_cached_context, id, config, thread_id=thread_id)
+
+
+async def ainvalidate_cached_context(ses, id, thread_id=None):
+    """
+    Async counterpart of invalidate_cached_context().
+
+    Args:
+        ses:            Async database session.
+        id:             Chat's id.
+    """
+    return await ses.run_sync(invalidate_cached_context, id, thread_id=thread_id)
+
+
+async def aadd_telegram_msg(ses, msg, config, content, role=MessageRole.user):
+    """
+    Async counterpart of add_telegram_msg().
+
+    Args:
+        ses:            Async database session.
+        msg:            Telegram message.
+        config:         Bot configuration manager.
+        content:        Message's content.
+        role:           Message type.
+    """
+    return await ses.run_sync(add_telegram_msg, msg, config, content, role=role)
+
+
+async def aget_context(ses, chat, *args, **kwargs):
+    """
+    Async counterpart of Chat.get_context().
+
+    Args:
+        ses:            Async database session.
+        chat:           Chat.
+    """
+    return await ses.run_sync(lambda _: chat.get_context(*args, **kwargs))
+
+
+async def apurge_old_chats(ses, config):
+    """
+    Async counterpart of purge_old_chats().
+
+    Args:
+        ses:        Async database session.
+        config:     Bot configuration manager.
+    """
+    return await ses.run_sync(purge_old_chats, config)
\ No newline at end of file
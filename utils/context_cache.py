@@ -0,0 +1,209 @@
+import json
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models.chat import build_context
+from utils.metrics import metrics
+
+
+
+# Rough memory, in bytes, taken by a cached object besides its
+# content.
+OBJECT_OVERHEAD = 200
+
+# Key of a database session's info where contexts changed in the
+# session's transaction are kept until it's committed.
+PENDING_INFO_KEY = 'pending_contexts'
+
+
+class CachedMessage:
+	"""Detached copy of a stored message with the attributes needed to
+	build a context."""
+
+	__slots__ = ('id', 'user_name', 'role', 'content', 'tokens', 'size')
+
+	def __init__(self, id, user_name, role, content, tokens):
+		self.id = id
+		self.user_name = user_name
+		self.role = role
+		self.content = content
+		self.tokens = tokens
+		self.size = OBJECT_OVERHEAD + len(json.dumps(content))
+
+
+	@classmethod
+	def from_message(cls, msg):
+		return cls(msg.id, msg.user_name, msg.role, msg.content, msg.tokens)
+
+
+class CachedContext:
+	"""
+	The newest messages of a chat, which are the ones that may be in
+	the context, along with the chat's fields needed to build the
+	context.
+
+	Args:
+		sys_msg:		Chat's system message.
+		msg_count:		Number of stored messages of the chat.
+		messages:		Messages from oldest to newest.
+	"""
+
+	def __init__(self, sys_msg, msg_count, messages):
+		self.sys_msg = sys_msg
+		self.msg_count = msg_count
+		self.messages = messages
+
+
+	def copy(self):
+		return CachedContext(self.sys_msg, self.msg_count, list(self.messages))
+
+
+	def get_size(self):
+		"""Return the estimated memory taken, in bytes."""
+		size = OBJECT_OVERHEAD + len(self.sys_msg or '')
+		return size + sum(msg.size for msg in self.messages)
+
+
+	def append(self, msg, keep):
+		"""Append a message and forget the older ones that would exceed
+		a number of messages."""
+		self.messages.append(msg)
+		del self.messages[:-keep]
+
+
+	def get_context(self, max_tokens=None):
+		"""Return a list of messages to pass to the AI as context."""
+		return build_context(self.sys_msg, reversed(self.messages), max_tokens)
+
+
+class ContextCache:
+	"""
+	Thread-safe LRU cache of chat contexts keyed by chat key, capped
+	by the estimated memory taken by the entries.
+
+	Entries are written through: contexts changed in a database
+	session are stored when the session commits and discarded if it
+	rolls back, see get_pending_contexts().
+
+	The cache assumes this process is the only one writing to the
+	chats it caches. Otherwise, e.g. with replicas behind a load
+	balancer, validate must be set so that the cached contexts are
+	checked against the database when used.
+
+	Args:
+		max_bytes:		Max estimated memory taken by the entries.
+	"""
+
+	def __init__(self, max_bytes=64 * 2**20):
+		self.max_bytes = max_bytes
+		self._lock = threading.Lock()
+		# chat key -> (context, size)
+		self._entries = OrderedDict()
+		self._size = 0
+		self._hits = 0
+		self._misses = 0
+		# Set if other processes may write to the same chats.
+		self.validate = False
+
+		metrics.register_gauge('context_cache.bytes', lambda: self._size)
+		metrics.register_gauge('context_cache.chats', lambda: len(self._entries))
+		metrics.register_gauge('context_cache.hit_rate', self.get_hit_rate)
+
+
+	def get_hit_rate(self):
+		lookups = self._hits + self._misses
+		return self._hits / lookups if lookups else 0.0
+
+
+	def get(self, key):
+		"""Return a copy of a chat's context, or None if not cached."""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				self._misses += 1
+				metrics.inc('context_cache.misses')
+				return None
+
+			self._hits += 1
+			self._entries.move_to_end(key)
+
+		metrics.inc('context_cache.hits')
+		return entry[0].copy()
+
+
+	def put(self, key, ctx):
+		"""Store a chat's context and evict the least recently used
+		ones exceeding the memory cap."""
+		size = ctx.get_size()
+		with self._lock:
+			self._pop(key)
+			if size > self.max_bytes:
+				return
+
+			self._entries[key] = (ctx, size)
+			self._size += size
+			self._evict()
+
+
+	def invalidate(self, key):
+		"""Forget a chat's context."""
+		with self._lock:
+			self._pop(key)
+
+
+	def clear(self):
+		"""Forget all the contexts."""
+		with self._lock:
+			self._entries.clear()
+			self._size = 0
+
+
+	def resize(self, max_bytes):
+		"""Change the memory cap."""
+		with self._lock:
+			self.max_bytes = max_bytes
+			self._evict()
+
+
+	def _pop(self, key):
+		if entry := self._entries.pop(key, None):
+			self._size -= entry[1]
+
+
+	def _evict(self):
+		while self._size > self.max_bytes:
+			_, (_, size) = self._entries.popitem(last=False)
+			self._size -= size
+			metrics.inc('context_cache.evictions')
+
+
+# Process-wide cache.
+context_cache = ContextCache()
+
+
+def get_pending_contexts(ses):
+	"""
+	Return the contexts changed in a database session's transaction,
+	by chat key. A None context means it must be invalidated.
+
+	Args:
+		ses:			Database session.
+	"""
+	return ses.info.setdefault(PENDING_INFO_KEY, {})
+
+
+@event.listens_for(Session, 'after_commit')
+def store_pending_contexts(ses):
+	for key, ctx in ses.info.pop(PENDING_INFO_KEY, {}).items():
+		if ctx is None:
+			context_cache.invalidate(key)
+		else:
+			context_cache.put(key, ctx)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_pending_contexts(ses, previous_transaction):
+	ses.info.pop(PENDING_INFO_KEY, None)
\ No newline at end of file
@@ -0,0 +1,111 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import event, insert, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
+
+from models.chat import migrations
+
+
+
+# Async drivers to use for each database backend when running on
+# the asyncio runtime.
+ASYNC_DRIVERS = {
+	'sqlite': 'aiosqlite',
+	'postgresql': 'asyncpg',
+	'mysql': 'aiomysql',
+}
+
+
+# SQLite ignores foreign keys. Enable it since referential
+# integrity is needed to avoid leaving orphan messages when deleting
+# chats.
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+	if 'sqlite' in str(dbapi_connection.__class__):
+		cursor = dbapi_connection.cursor()
+		cursor.execute("PRAGMA foreign_keys=ON")
+		cursor.close()
+
+
+def get_async_database_url(url):
+	"""Return a database URL that uses an async driver, e.g.
+	'sqlite:///chats.db' becomes 'sqlite+aiosqlite:///chats.db'. Raise
+	ValueError if there's no async driver for the database."""
+	url = make_url(url)
+	backend = url.get_backend_name()
+	if backend not in ASYNC_DRIVERS:
+		supported = ', '.join(f'{name} ({driver})' for name, driver in ASYNC_DRIVERS.items())
+		raise ValueError(f'No async driver for the "{url.drivername}" database URL scheme, supported databases: {supported}')
+	if url.get_driver_name() == ASYNC_DRIVERS[backend]:
+		return url
+
+	return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+
+def upgrade_schema(conn, metadata):
+	"""
+	Add the columns and indexes missing from existing tables, which
+	create_all() only creates along with new tables. Added columns
+	must be nullable.
+
+	Args:
+		conn:			Database connection.
+		metadata:		Metadata of the tables.
+	"""
+
+	inspector = inspect(conn)
+	existing_tables = set(inspector.get_table_names())
+	for table in metadata.sorted_tables:
+		if table.name not in existing_tables:
+			continue
+
+		columns = {c['name'] for c in inspector.get_columns(table.name)}
+		for column in table.columns:
+			if column.name not in columns:
+				column_type = column.type.compile(dialect=conn.dialect)
+				conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+
+		indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+		for index in table.indexes:
+			if index.name not in indexes:
+				index.create(conn)
+
+
+def insert_or_ignore(ses, table):
+	"""
+	Return an INSERT statement skipping the rows whose key is taken,
+	or None if the session's database doesn't support it.
+
+	Args:
+		ses:			Database session.
+		table:			Table or mapped class.
+	"""
+	dialect = ses.get_bind().dialect.name
+	if dialect == 'sqlite':
+		return sqlite.insert(table).on_conflict_do_nothing()
+	if dialect == 'postgresql':
+		return postgresql.insert(table).on_conflict_do_nothing()
+	if dialect in ('mysql', 'mariadb'):
+		return insert(table).prefix_with('IGNORE')
+
+
+def run_migration(ses, name, migrate):
+	"""
+	Run a data migration unless it was applied to the database
+	already, and record it. The session must be committed.
+
+	Args:
+		ses:			Database session.
+		name:			Migration's unique name.
+		migrate:		Function migrating the data, taking the
+						session.
+	"""
+
+	stmt = select(migrations.c.name).where(migrations.c.name == name)
+	if ses.scalar(stmt) is not None:
+		return False
+
+	migrate(ses)
+	ses.execute(insert(migrations).values(name=name, applied_at=datetime.now(timezone.utc)))
+	return True
\ No newline at end of file
@@ -0,0 +1,283 @@
+import time
+import asyncio
+import threading
+import traceback
+import contextvars
+from collections import deque
+
+from utils.metrics import metrics
+
+
+
+class _Task:
+	"""A handler call waiting to be run by a dispatcher."""
+
+	def __init__(self, key, fn, args, kwargs, priority=False):
+		self.key = key
+		self.fn = fn
+		self.args = args
+		self.kwargs = kwargs
+		self.priority = priority
+		self.queued_at = time.monotonic()
+
+
+class BaseChatDispatcher:
+	"""
+	Base class for dispatchers that run handler calls one at a time
+	per chat, in the order they were submitted, while different chats
+	run in parallel.
+
+	Tasks submitted with priority are placed in a separate lane which
+	doesn't wait for the chat's pending tasks nor for the pool to have
+	a free worker, this lane is meant for admin commands which should
+	stay responsive under load.
+
+	Queue depth and wait times are published to the metrics registry
+	under the dispatcher's name.
+	"""
+
+	def __init__(self, max_queue_per_chat=10, name='dispatcher'):
+		self.max_queue_per_chat = max_queue_per_chat
+		self.name = name
+
+		# chat key -> pending tasks. A chat has an entry as long as it
+		# has either pending or running tasks.
+		self._chat_queues = {}
+		self._queued = 0
+		self._priority_queued = 0
+		# The key of the chat the current task belongs to.
+		self._current_key = contextvars.ContextVar(f'{name}_current_key', default=None)
+
+		metrics.register_gauge(f'{name}.queued', lambda: self._queued)
+		metrics.register_gauge(f'{name}.priority_queued', lambda: self._priority_queued)
+		metrics.register_gauge(f'{name}.active_chats', lambda: len(self._chat_queues))
+
+
+	def in_chat(self, key):
+		"""Return True if the caller is running a task for a chat, in
+		which case tasks for that chat must be run inline or they would
+		wait for the caller itself."""
+		return self._current_key.get() == key
+
+
+	def _reject(self, task):
+		metrics.inc(f'{self.name}.rejected')
+		print(f'ERROR - Too many pending messages, message dropped [Chat: {task.key}].')
+
+
+	def _record_start(self, task):
+		lane = 'priority' if task.priority else 'chat'
+		metrics.observe(f'{self.name}.{lane}_wait_s', time.monotonic() - task.queued_at)
+
+
+class ChatDispatcher(BaseChatDispatcher):
+	"""
+	Dispatcher backed by a pool of worker threads.
+
+	Args:
+		workers:				Number of threads running chat tasks.
+		priority_workers:		Number of threads reserved to
+								priority tasks.
+		max_queue_per_chat:		Max pending tasks per chat, further
+								tasks are dropped.
+		name:					Metrics name prefix.
+	"""
+
+	def __init__(self, workers=4, priority_workers=1, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+
+		self.workers = workers
+		self.priority_workers = priority_workers
+
+		self._cond = threading.Condition()
+		self._ready_chats = deque()
+		self._priority_tasks = deque()
+		self._threads = []
+
+
+	def start(self):
+		"""Start the worker threads."""
+		for i in range(self.workers + self.priority_workers):
+			thread = threading.Thread(
+				target=self._work,
+				args=(i >= self.workers,),
+				name=f'{self.name}-{i}',
+				daemon=True
+			)
+			thread.start()
+			self._threads.append(thread)
+
+
+	def submit(self, key, fn, *args, priority=False, **kwargs):
+		"""
+		Queue a call to a function for a chat. Return False if the
+		call was dropped because the chat's queue is full.
+
+		Args:
+			key:		Chat key.
+			fn:			Function to call.
+			priority:	If True, the call will go through the priority
+						lane.
+		"""
+
+		task = _Task(key, fn, args, kwargs, priority=priority)
+
+		with self._cond:
+			if priority:
+				self._priority_tasks.append(task)
+				self._priority_queued += 1
+
+			else:
+				queue = self._chat_queues.get(key)
+				if queue is None:
+					# The chat is idle, schedule it.
+					queue = self._chat_queues[key] = deque()
+					self._ready_chats.append(key)
+				elif len(queue) >= self.max_queue_per_chat:
+					self._reject(task)
+					return False
+
+				queue.append(task)
+				self._queued += 1
+
+			self._cond.notify()
+
+		return True
+
+
+	def _next_task(self, priority_only):
+		"""Wait for a task and pop it."""
+		with self._cond:
+			while True:
+				if self._priority_tasks:
+					self._priority_queued -= 1
+					return self._priority_tasks.popleft()
+
+				if self._ready_chats and not priority_only:
+					self._queued -= 1
+					return self._chat_queues[self._ready_chats.popleft()].popleft()
+
+				self._cond.wait()
+
+
+	def _finish_chat_task(self, task):
+		"""Reschedule the task's chat if it has pending tasks, forget
+		it otherwise."""
+		with self._cond:
+			if self._chat_queues[task.key]:
+				# Go to the back of the line to be fair to other chats.
+				self._ready_chats.append(task.key)
+				self._cond.notify()
+			else:
+				del self._chat_queues[task.key]
+
+
+	def _work(self, priority_only):
+		while True:
+			task = self._next_task(priority_only)
+			self._record_start(task)
+
+			token = self._current_key.set(task.key)
+			try:
+				task.fn(*task.args, **task.kwargs)
+			except Exception:
+				traceback.print_exc()
+			finally:
+				self._current_key.reset(token)
+
+			if not task.priority:
+				self._finish_chat_task(task)
+
+
+class AsyncChatDispatcher(BaseChatDispatcher):
+	"""
+	Dispatcher for the asyncio runtime. Each chat with pending tasks
+	gets a coroutine draining its queue, the pool size limits how many
+	chat tasks run at the same time.
+
+	Args:
+		workers:				Max chat tasks running at the same time.
+		max_queue_per_chat:		Max pending tasks per chat, further
+								tasks are dropped.
+		name:					Metrics name prefix.
+	"""
+
+	def __init__(self, workers=100, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+
+		self.workers = workers
+		self._semaphore = asyncio.Semaphore(workers)
+		# Keep references to the running tasks or they may be garbage
+		# collected.
+		self._tasks = set()
+
+
+	def start(self):
+		"""Nothing to start, coroutines are created on demand."""
+		pass
+
+
+	def submit(self, key, fn, *args, priority=False, **kwargs):
+		"""
+		Queue a call to a coroutine function for a chat. Return False
+		if the call was dropped because the chat's queue is full.
+
+		Args:
+			key:		Chat key.
+			fn:			Coroutine function to call.
+			priority:	If True, the call will go through the priority
+						lane.
+		"""
+
+		task = _Task(key, fn, args, kwargs, priority=priority)
+
+		if priority:
+			self._priority_queued += 1
+			self._spawn(self._run_priority(task))
+
+		else:
+			queue = self._chat_queues.get(key)
+			if queue is None:
+				queue = self._chat_queues[key] = deque([task])
+				self._spawn(self._drain(key))
+			elif len(queue) >= self.max_queue_per_chat:
+				self._reject(task)
+				return False
+			else:
+				queue.append(task)
+			self._queued += 1
+
+		return True
+
+
+	def _spawn(self, coro):
+		task = asyncio.get_running_loop().create_task(coro)
+		self._tasks.add(task)
+		task.add_done_callback(self._tasks.discard)
+
+
+	async def _execute(self, task):
+		self._record_start(task)
+		self._current_key.set(task.key)
+		try:
+			await task.fn(*task.args, **task.kwargs)
+		except Exception:
+			traceback.print_exc()
+
+
+	async def _run_priority(self, task):
+		self._priority_queued -= 1
+		await self._execute(task)
+
+
+	async def _drain(self, key):
+		queue = self._chat_queues[key]
+		while queue:
+			async with self._semaphore:
+				task = queue.popleft()
+				self._queued -= 1
+				await self._execute(task)
+
+		# No await since the queue was found empty, so no task could
+		# have been queued in the meantime.
+		del self._chat_queues[key]
\ No newline at end of file
@@ -0,0 +1,246 @@
+import asyncio
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPSConnection
+
+from telebot import apihelper, asyncio_helper
+
+from utils.metrics import metrics
+
+
+
+class ConnectionStats:
+	"""
+	Thread-safe counts of the requests and connections of an HTTP
+	client, shown as gauges.
+
+	Args:
+		name:			Client's name, used in the gauges' names.
+	"""
+
+	def __init__(self, name):
+		self._lock = threading.Lock()
+		self.requests = 0
+		self.connections = 0
+		self.tls_handshakes = 0
+
+		metrics.register_gauge(f'http.{name}.requests', lambda: self.requests)
+		metrics.register_gauge(f'http.{name}.connections', lambda: self.connections)
+		metrics.register_gauge(f'http.{name}.tls_handshakes', lambda: self.tls_handshakes)
+		metrics.register_gauge(f'http.{name}.reuse_rate', self.get_reuse_rate)
+
+
+	def get_reuse_rate(self):
+		"""Return the share of requests sent over an open connection."""
+		if not self.requests:
+			return 0.0
+		return max(0.0, 1 - self.connections / self.requests)
+
+
+	def on_request(self):
+		with self._lock:
+			self.requests += 1
+
+
+	def on_connection(self):
+		with self._lock:
+			self.connections += 1
+
+
+	def on_tls_handshake(self):
+		with self._lock:
+			self.tls_handshakes += 1
+
+
+telegram_stats = ConnectionStats('telegram')
+openai_stats = ConnectionStats('openai')
+
+
+def prewarm(fn, count):
+	"""Call a function concurrently to open connections before they're
+	needed, failures are only reported."""
+	if not count:
+		return
+	with ThreadPoolExecutor(count) as executor:
+		futures = [executor.submit(fn) for _ in range(count)]
+	if errors := [f.exception() for f in futures if f.exception()]:
+		print(f'WARNING - Connections could not be pre-warmed: {errors[0]}')
+
+
+async def aprewarm(fn, count):
+	"""Async counterpart of prewarm(), calls a coroutine function."""
+	results = await asyncio.gather(*(fn() for _ in range(count)), return_exceptions=True)
+	if errors := [r for r in results if isinstance(r, Exception)]:
+		print(f'WARNING - Connections could not be pre-warmed: {errors[0]}')
+
+
+# Telegram.
+
+
+class CountingHTTPSConnection(HTTPSConnection):
+
+	def connect(self):
+		telegram_stats.on_connection()
+		super().connect()
+		telegram_stats.on_tls_handshake()
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+	ConnectionCls = CountingHTTPSConnection
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+	"""HTTP adapter counting the requests and connections."""
+
+	def init_poolmanager(self, *args, **kwargs):
+		super().init_poolmanager(*args, **kwargs)
+		self.poolmanager.pool_classes_by_scheme = {
+			'http': HTTPConnectionPool,
+			'https': CountingHTTPSConnectionPool,
+		}
+
+
+	def send(self, *args, **kwargs):
+		telegram_stats.on_request()
+		return super().send(*args, **kwargs)
+
+
+def configure_telegram_http(config):
+	"""
+	Make the Telegram client of the threaded runtime share a pool of
+	keep-alive connections between threads.
+
+	Args:
+		config:			Bot configuration manager.
+	"""
+	adapter = PooledHTTPAdapter(
+		pool_connections=1,
+		pool_maxsize=config.get('http.pool_size')
+	)
+	session = requests.Session()
+	session.mount('https://', adapter)
+	apihelper.session = session
+	apihelper.CONNECT_TIMEOUT = config.get('http.connect_timeout_s')
+	apihelper.READ_TIMEOUT = config.get('http.read_timeout_s')
+
+
+class PooledSessionManager(asyncio_helper.SessionManager):
+	"""Session manager of the asyncio Telegram client with a configured
+	connection pool, counting the requests and connections."""
+
+	def __init__(self, pool_size, keepalive_s):
+		super().__init__()
+		self.pool_size = pool_size
+		self.keepalive_s = keepalive_s
+
+
+	async def create_session(self):
+		# Only the asyncio runtime depends on aiohttp.
+		import aiohttp
+
+		trace_config = aiohttp.TraceConfig()
+
+		async def on_request_start(session, context, params):
+			telegram_stats.on_request()
+
+		async def on_connection_create_end(session, context, params):
+			# Every connection is made to the HTTPS API.
+			telegram_stats.on_connection()
+			telegram_stats.on_tls_handshake()
+
+		trace_config.on_request_start.append(on_request_start)
+		trace_config.on_connection_create_end.append(on_connection_create_end)
+
+		self.session = aiohttp.ClientSession(
+			connector=aiohttp.TCPConnector(
+				limit=self.pool_size,
+				keepalive_timeout=self.keepalive_s,
+				ssl=self.ssl_context
+			),
+			trace_configs=[trace_config]
+		)
+		return self.session
+
+
+def configure_async_telegram_http(config):
+	"""Async counterpart of configure_telegram_http()."""
+	asyncio_helper.session_manager = PooledSessionManager(
+		config.get('http.pool_size'),
+		config.get('http.keepalive_s')
+	)
+	asyncio_helper.REQUEST_TIMEOUT = config.get('http.read_timeout_s')
+
+
+# OpenAI.
+
+
+def get_httpx_options(options):
+	"""
+	Return the options of an httpx client from the 'http' section of
+	the AI options. HTTP/2 is only used if the h2 package is installed.
+
+	Args:
+		options:		AI options configuration manager.
+	"""
+	http2 = options.get('http.http2')
+	if http2 and not importlib.util.find_spec('h2'):
+		print('WARNING - HTTP/2 requires the h2 package, using HTTP/1.1')
+		http2 = False
+
+	return {
+		'http2': http2,
+		'limits': httpx.Limits(
+			max_connections=options.get('http.max_connections'),
+			max_keepalive_connections=options.get('http.max_keepalive'),
+			keepalive_expiry=options.get('http.keepalive_s')
+		),
+		'timeout': httpx.Timeout(
+			connect=options.get('http.connect_timeout_s'),
+			read=options.get('http.read_timeout_s'),
+			write=options.get('http.write_timeout_s'),
+			pool=options.get('http.pool_timeout_s')
+		),
+	}
+
+
+def trace_httpx(event_name, info):
+	if event_name == 'connection.connect_tcp.complete':
+		openai_stats.on_connection()
+	elif event_name == 'connection.start_tls.complete':
+		openai_stats.on_tls_handshake()
+
+
+async def atrace_httpx(event_name, info):
+	trace_httpx(event_name, info)
+
+
+def create_openai_http_client(options, client_cls):
+	"""
+	Create the HTTP client of an OpenAI client, counting the requests
+	and connections.
+
+	Args:
+		options:		AI options configuration manager.
+		client_cls:		Either openai.DefaultHttpxClient or
+						openai.DefaultAsyncHttpxClient.
+	"""
+
+	def on_request(request):
+		openai_stats.on_request()
+		request.extensions['trace'] = trace_httpx
+
+	async def aon_request(request):
+		openai_stats.on_request()
+		request.extensions['trace'] = atrace_httpx
+
+	is_async = issubclass(client_cls, httpx.AsyncClient)
+	return client_cls(
+		event_hooks={'request': [aon_request if is_async else on_request]},
+		**get_httpx_options(options)
+	)
\ No newline at end of file
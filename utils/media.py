@@ -1,24 +1,180 @@
 import io
+import subprocess
 from base64 import b64encode
 
 import filetype
+import numpy as np
 
-from PIL import Image
+from PIL import Image, ImageOps, features
 
 from pydub import AudioSegment
 
+from constants.ai import VISION_LOW_DETAIL_SIZE, VISION_HIGH_DETAIL_MAX_SIZE, VISION_HIGH_DETAIL_SHORT_SIDE, STT_SAMPLE_RATE, STT_BITRATE, TTS_PCM_SAMPLE_RATE, TTS_BITRATE
+from utils.metrics import metrics
+
 
 
 def strip_exif_data(img):
 	"""Strip EXIF data from a PIL Image and return it."""
-	data = list(img.getdata())
+	# Pasting copies the pixels natively, leaving the metadata behind.
 	img_wo_exif = Image.new(img.mode, img.size)
-	img_wo_exif.putdata(data)
+	img_wo_exif.paste(img)
 	return img_wo_exif
+
+
+def get_vision_size(size, detail='auto'):
+	"""
+	Return the size an image is scaled to by the vision model for
+	a detail level, which is the size worth sending. Images are never
+	upscaled.
+
+	Args:
+		size:		Image's width and height.
+		detail:		Vision detail level.
+	"""
+
+	width, height = size
+	if detail == 'low':
+		scale = VISION_LOW_DETAIL_SIZE / max(width, height)
+	else:
+		# Fit in a square, then scale the shortest side down.
+		scale = min(
+			VISION_HIGH_DETAIL_MAX_SIZE / max(width, height),
+			VISION_HIGH_DETAIL_SHORT_SIDE / min(width, height)
+		)
+
+	if scale >= 1:
+		return size
+	return max(1, round(width * scale)), max(1, round(height * scale))
 	
 
-def speed_up_audio(audio_bytes, speed=2.0, chunk_size=50, crossfade=25):
-	"""Speed-up an audio wave and return it."""
+def trim_silence(samples, sample_rate, frame_ms=30, threshold_db=-40, min_silence_ms=300, padding_ms=100):
+	"""
+	Remove the silence at the ends of an audio wave and shorten the
+	pauses within it, detected by the energy of its frames. Return a
+	tuple with the remaining samples and the seconds removed.
+
+	Args:
+		samples:			Samples, either an array of shape (n,) or
+							(n, channels).
+		sample_rate:		Samples per second.
+		frame_ms:			Duration of the frames.
+		threshold_db:		Energy, relative to the loudest frame,
+							below which a frame is silent.
+		min_silence_ms:		Pauses shorter than this are kept.
+		padding_ms:			Silence kept around speech.
+	"""
+
+	frame_len = max(1, sample_rate * frame_ms // 1000)
+	n_frames = len(samples) // frame_len
+	if not n_frames:
+		return samples, 0.0
+
+	# Mean energy of each frame, in dB.
+	frames = samples[:n_frames * frame_len].reshape(n_frames, -1).astype(np.float32)
+	energy_db = 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-10)
+	voiced = energy_db > energy_db.max() + threshold_db
+	if not voiced.any():
+		return samples, 0.0
+
+	# Keep some silence around speech so that words aren't cut.
+	padding = padding_ms // frame_ms
+	keep = np.convolve(voiced, np.ones(2 * padding + 1), mode='same') > 0
+
+	# Find the silent spans and keep the short pauses within speech.
+	edges = np.flatnonzero(np.diff(np.concatenate(([1], keep.astype(np.int8), [1]))))
+	min_silence = min_silence_ms // frame_ms
+	for start, end in zip(edges[::2], edges[1::2]):
+		if 0 < start and end < n_frames and end - start < min_silence:
+			keep[start:end] = True
+
+	# Samples past the last whole frame go along with it.
+	sample_mask = np.repeat(keep, frame_len)
+	sample_mask = np.concatenate((sample_mask, np.full(len(samples) - len(sample_mask), keep[-1])))
+	trimmed = samples[sample_mask]
+
+	removed_s = (len(samples) - len(trimmed)) / sample_rate
+	metrics.observe('media.vad_removed_s', removed_s)
+	return trimmed, removed_s
+
+
+def trim_audio_segment_silence(audio, **kwargs):
+	"""Remove silence from a pydub AudioSegment, see trim_silence()
+	for the arguments."""
+	samples = np.array(audio.get_array_of_samples()).reshape(-1, audio.channels)
+	trimmed, _ = trim_silence(samples, audio.frame_rate, **kwargs)
+	return AudioSegment(
+		trimmed.tobytes(),
+		frame_rate=audio.frame_rate,
+		sample_width=audio.sample_width,
+		channels=audio.channels
+	)
+
+
+def split_audio_at_silences(audio, max_segment_ms, overlap_ms=1000, search_ms=10000, frame_ms=30):
+	"""
+	Split a pydub AudioSegment into segments no longer than a duration
+	plus the overlap, cutting at the quietest frame near the end of
+	each segment. Return the list of segments, in order.
+
+	Args:
+		audio:				AudioSegment.
+		max_segment_ms:		Max duration of the segments, without the
+							overlap.
+		overlap_ms:			Duration shared by consecutive segments on
+							each side of the cuts, so that words cut
+							by mistake are fully in either segment.
+		search_ms:			Duration, at the end of each segment, in
+							which to look for the quietest frame.
+		frame_ms:			Duration of the frames.
+	"""
+
+	if len(audio) <= max_segment_ms:
+		return [audio]
+
+	# Mean energy of each frame, channels mixed.
+	samples = np.array(audio.get_array_of_samples()).reshape(-1, audio.channels)
+	frame_len = max(1, audio.frame_rate * frame_ms // 1000)
+	n_frames = len(samples) // frame_len
+	frames = samples[:n_frames * frame_len].reshape(n_frames, -1).astype(np.float32)
+	energy = np.mean(frames ** 2, axis=1)
+
+	max_frames = max_segment_ms // frame_ms
+	search_frames = min(search_ms // frame_ms, max_frames - 1)
+	cuts = [0]
+	while n_frames - cuts[-1] > max_frames:
+		end = cuts[-1] + max_frames
+		cuts.append(end - search_frames + int(np.argmin(energy[end - search_frames:end])))
+	cuts.append(n_frames)
+
+	segments = []
+	for start, end in zip(cuts, cuts[1:]):
+		start_ms = max(0, start * frame_ms - overlap_ms)
+		# The last segment takes the samples past the last whole frame.
+		end_ms = end * frame_ms + overlap_ms if end < n_frames else len(audio)
+		segments.append(audio[start_ms:end_ms])
+	return segments
+
+
+def split_audio_bytes(audio_bytes, max_segment_ms, overlap_ms=1000, search_ms=10000):
+	"""Split an audio wave at silences, see split_audio_at_silences(),
+	and return the segments encoded to OGG, or an empty tuple if it's
+	short enough to be left whole."""
+	audio = AudioSegment.from_file(io.BytesIO(audio_bytes))
+	if len(audio) <= max_segment_ms:
+		return ()
+
+	segments = []
+	for segment in split_audio_at_silences(audio, max_segment_ms, overlap_ms, search_ms):
+		segment_io = io.BytesIO()
+		segment.export(segment_io, format='ogg')
+		segments.append(segment_io.getvalue())
+	return tuple(segments)
+
+
+def speed_up_audio(audio_bytes, speed=2.0, chunk_size=50, crossfade=25, vad=None):
+	"""Speed-up an audio wave and return it. If the 'vad' options are
+	given, silence is removed first, see trim_silence()."""
 	audio_io = io.BytesIO(audio_bytes)
 
 	# Guess the audio wave format.
@@ -26,6 +182,8 @@ def speed_up_audio(audio_bytes, speed=2.0, chunk_size=50, crossfade=25):
 	audio_fmt = audio_type.extension if audio_type else None
 	if audio_fmt:
 		audio = AudioSegment.from_file(audio_io, format=audio_fmt)
+		if vad is not None:
+			audio = trim_audio_segment_silence(audio, **vad)
 		
 		sped_up_audio = audio.speedup(
 			playback_speed=speed,
@@ -44,29 +202,146 @@ def speed_up_audio(audio_bytes, speed=2.0, chunk_size=50, crossfade=25):
 	return new_audio_bytes_io.getvalue()
 
 
-def create_image_url(img_bytes):
-	"""Build the data-URL for an image."""
+def run_ffmpeg(input_bytes, input_args=[], output_args=[]):
+	"""Pipe bytes through ffmpeg and return its output. Raise OSError if
+	ffmpeg is missing and CalledProcessError if it fails."""
+	proc = subprocess.run(
+		[
+			'ffmpeg', '-hide_banner', '-loglevel', 'error',
+			*input_args, '-i', 'pipe:0',
+			*output_args, 'pipe:1'
+		],
+		input=input_bytes,
+		capture_output=True,
+		check=True
+	)
+	return proc.stdout
+
+
+def get_atempo_filter(speed):
+	"""Return the ffmpeg filter changing the tempo of audio by a factor.
+	Older ffmpeg versions limit 'atempo' to factors from 0.5 to 2, so
+	filters are chained to reach any factor."""
+	factors = []
+	while speed > 2:
+		factors.append(2)
+		speed /= 2
+	while speed < 0.5:
+		factors.append(0.5)
+		speed /= 0.5
+	factors.append(speed)
+	return ','.join(f'atempo={factor:g}' for factor in factors)
+
+
+def speed_up_audio_ffmpeg(audio_bytes, speed=2.0, vad=None):
+	"""Speed-up an audio wave, downmix it to mono, resample it to the
+	rate speech is transcribed at and encode it to Opus, in a single
+	streaming ffmpeg pass, and return it. If the 'vad' options are
+	given, silence is removed first, see trim_silence(), which takes
+	another pass to decode the wave."""
+	pcm_args = ['-f', 's16le', '-ac', '1', '-ar', str(STT_SAMPLE_RATE)]
+	try:
+		input_bytes = audio_bytes
+		input_args = []
+		if vad is not None:
+			pcm = run_ffmpeg(audio_bytes, output_args=pcm_args)
+			samples, _ = trim_silence(np.frombuffer(pcm, dtype=np.int16), STT_SAMPLE_RATE, **vad)
+			input_bytes = samples.tobytes()
+			input_args = pcm_args
+
+		return run_ffmpeg(
+			input_bytes,
+			input_args=input_args,
+			output_args=[
+				'-af', get_atempo_filter(speed),
+				'-ac', '1',
+				'-ar', str(STT_SAMPLE_RATE),
+				'-c:a', 'libopus',
+				'-b:a', STT_BITRATE,
+				'-application', 'voip',
+				# Simulate a voice message recorded using Telegram (OGG).
+				'-f', 'ogg'
+			]
+		)
+	except (OSError, subprocess.CalledProcessError) as e:
+		# Leave the wave as-is, as for unknown formats.
+		print(f'ERROR - Audio could not be processed with ffmpeg: {e}')
+		return audio_bytes
+
+
+def encode_voice(pcm, sample_rate=TTS_PCM_SAMPLE_RATE):
+	"""Encode raw 16-bit mono PCM audio into a Telegram voice message
+	(Opus in OGG). Raise OSError if ffmpeg is missing and
+	CalledProcessError if it fails."""
+	return run_ffmpeg(
+		pcm,
+		input_args=['-f', 's16le', '-ac', '1', '-ar', str(sample_rate)],
+		output_args=['-c:a', 'libopus', '-b:a', TTS_BITRATE, '-f', 'ogg']
+	)
+
+
+def encode_image(img_bytes, detail='auto', format='webp', quality=80):
+	"""
+	Prepare an image for the vision model and return a tuple with its
+	content type and bytes. The image is stripped of its EXIF data,
+	scaled down to the size the model would scale it to and encoded
+	lossily.
+
+	Args:
+		img_bytes:		Image's bytes.
+		detail:			Vision detail level.
+		format:			Either 'webp' or 'jpeg', JPEG is used if WebP
+						isn't supported by Pillow.
+		quality:		Encoding quality, from 0 to 100.
+	"""
+
+	if format == 'webp' and not features.check('webp'):
+		format = 'jpeg'
 	
 	# img_bytes could be used directly to construct the data-URL but it's
 	# a good idea to first strip the exif data for security reasons.
-	img = Image.open(io.BytesIO(img_bytes))
-	new_img_bytesio = io.BytesIO()
-	
-	img_wo_exif = strip_exif_data(img)
-	
-	# Save as PNG to preserve details.
-	img_wo_exif.save(new_img_bytesio, format='PNG')
-	img_bytes = new_img_bytesio.getvalue()
+	# Every step returns a new image, the previous ones are closed.
+	with Image.open(io.BytesIO(img_bytes)) as opened_img:
+		# Only decode the pixels needed for the target size, JPEG
+		# images can be decoded at a fraction of their size.
+		opened_img.draft('RGB', get_vision_size(opened_img.size, detail))
+		# Rotate as the stripped EXIF orientation would have.
+		with ImageOps.exif_transpose(opened_img) as rotated_img:
+			img = rotated_img.convert(
+				'RGBA' if format == 'webp' and rotated_img.has_transparency_data else 'RGB'
+			)
+
+	size = get_vision_size(img.size, detail)
+	if size != img.size:
+		# Resizing creates a new image, which leaves the metadata
+		# behind along with the pixels not needed.
+		img_wo_exif = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+		img_wo_exif.info = {}
+	else:
+		img_wo_exif = strip_exif_data(img)
 	
-	# It's probable that the content-type is always the same generic one.
-	#content_type = requests.get(url).headers['Content-Type']
-	# It may be that Telegram compresses pictures as JPEG.
-	#content_type = 'image/jpeg'
-	content_type = 'image/png'
+	new_img_bytesio = io.BytesIO()
+	img_wo_exif.save(new_img_bytesio, format=format, quality=quality)
+	new_img_bytes = new_img_bytesio.getvalue()
+	content_type = f'image/{format}'
 	
 	img.close()
 	img_wo_exif.close()
+
+	metrics.inc('media.image_bytes_in', len(img_bytes))
+	metrics.inc('media.image_bytes_out', len(new_img_bytes))
+	metrics.inc('media.image_bytes_saved', len(img_bytes) - len(new_img_bytes))
 	
+	return content_type, new_img_bytes
+
+
+def build_data_url(content_type, data):
+	"""Build a data-URL."""
 	# NOTE: Do not add the "charset" parameter to the data-URL or ChatGPT
 	#		won't be able to process the image.
-	return f'data:{content_type};base64,{b64encode(img_bytes).decode()}'
\ No newline at end of file
+	return f'data:{content_type};base64,{b64encode(data).decode()}'
+
+
+def create_image_url(img_bytes):
+	"""Build the data-URL for an image."""
+	return build_data_url(*encode_image(img_bytes))
\ No newline at end of file
@@ -0,0 +1,203 @@
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+from utils.metrics import metrics
+
+
+
+# Smaller buffers are pickled along with the call, sharing them costs
+# more than copying them.
+MIN_SHARED_BYTES = 256 * 2**10
+
+# Size of the chunks files are copied into shared memory in.
+COPY_CHUNK_BYTES = 2**20
+
+
+class SharedBytes:
+	"""Reference to bytes in a shared memory block, which is picklable
+	and doesn't carry the bytes."""
+
+	def __init__(self, name, size):
+		self.name = name
+		self.size = size
+
+
+def get_size(data):
+	"""Return the size of bytes or of a binary file."""
+	if isinstance(data, (bytes, bytearray, memoryview)):
+		return len(data)
+	size = data.seek(0, os.SEEK_END)
+	data.seek(0)
+	return size
+
+
+def read_bytes(data):
+	"""Return the content of bytes or of a binary file."""
+	if isinstance(data, (bytes, bytearray, memoryview)):
+		return data
+	data.seek(0)
+	return data.read()
+
+
+def share_bytes(data):
+	"""Copy bytes, or a binary file in chunks, into a new shared memory
+	block and return the block along with the reference to pass to
+	another process."""
+	size = get_size(data)
+	shm = SharedMemory(create=True, size=max(1, size))
+	if isinstance(data, (bytes, bytearray, memoryview)):
+		shm.buf[:size] = data
+	else:
+		pos = 0
+		while pos < size:
+			# Views must be released before closing the block.
+			with shm.buf[pos:pos + COPY_CHUNK_BYTES] as chunk:
+				if not (read := data.readinto(chunk)):
+					break
+				pos += read
+	return shm, SharedBytes(shm.name, size)
+
+
+def read_shared_bytes(shared, unlink=False):
+	"""Return the bytes referenced by a SharedBytes, freeing the block
+	if unlink is True."""
+	shm = SharedMemory(name=shared.name)
+	try:
+		return bytes(shm.buf[:shared.size])
+	finally:
+		shm.close()
+		if unlink:
+			shm.unlink()
+
+
+def _share_result(result):
+	"""Share the large bytes of a function's result, which is either
+	bytes or a tuple, the blocks are freed by the caller."""
+	if isinstance(result, tuple):
+		return tuple(_share_result(value) for value in result)
+	if isinstance(result, bytes) and len(result) >= MIN_SHARED_BYTES:
+		shm, shared = share_bytes(result)
+		shm.close()
+		return shared
+	return result
+
+
+def _load_result(result):
+	if isinstance(result, tuple):
+		return tuple(_load_result(value) for value in result)
+	if isinstance(result, SharedBytes):
+		return read_shared_bytes(result, unlink=True)
+	return result
+
+
+def _run(fn, data, args, kwargs):
+	"""Call a media function in a worker process, return its result and
+	the metrics it recorded."""
+	if isinstance(data, SharedBytes):
+		data = read_shared_bytes(data)
+	# Metrics recorded by the function go back to the caller.
+	metrics.pop_state()
+	result = _share_result(fn(data, *args, **kwargs))
+	return result, metrics.pop_state()
+
+
+def _warm_up():
+	pass
+
+
+class MediaExecutor:
+	"""
+	Runs CPU-bound media functions in a pool of processes, so that
+	they don't hold the GIL of the process handling the updates. Large
+	bytes are passed through shared memory instead of being pickled.
+
+	Workers are forked with the modules of the bot imported, so they're
+	ready for the first call. Until started, without workers, or once a
+	worker died, functions are called in the calling thread.
+	"""
+
+	def __init__(self):
+		self.workers = 0
+		self._pool = None
+		self._lock = threading.Lock()
+
+
+	def start(self, workers):
+		"""
+		Start the worker processes. It must be called before any thread
+		is started, as forking copies the state of locks held by other
+		threads, which is why they're never started again.
+
+		Args:
+			workers:		Number of processes, 0 to call the functions
+							in the calling thread.
+		"""
+		self.workers = workers
+		if not workers:
+			return
+		# Processes share the tracker of shared memory blocks if it's
+		# running before they're forked.
+		resource_tracker.ensure_running()
+		self._pool = ProcessPoolExecutor(
+			workers,
+			mp_context=multiprocessing.get_context('fork')
+		)
+		# Fork every worker now.
+		self._pool.submit(_warm_up).result()
+
+
+	def run(self, fn, data, *args, **kwargs):
+		"""
+		Call a media function in a worker process and return its result.
+
+		Args:
+			fn:			Function taking bytes as first argument and
+						returning either bytes or a tuple, which must be
+						defined at module level.
+			data:		Bytes or binary file, which is copied straight
+						to the worker.
+			args:		Further positional arguments.
+			kwargs:		Keyword arguments.
+		"""
+
+		pool = self._pool
+		if pool is None:
+			return fn(read_bytes(data), *args, **kwargs)
+
+		start = time.monotonic()
+		shm = None
+		if get_size(data) >= MIN_SHARED_BYTES:
+			shm, data_ref = share_bytes(data)
+		else:
+			data_ref = read_bytes(data)
+
+		try:
+			result, state = pool.submit(_run, fn, data_ref, args, kwargs).result()
+		except BrokenProcessPool:
+			# A worker died, e.g. out of memory. Forking new ones now
+			# would copy the locks held by the running threads.
+			with self._lock:
+				if self._pool is pool:
+					self._pool = None
+					print('ERROR - A media worker died, processing media in the calling threads from now on.')
+					metrics.inc('media.pool_broken')
+			pool.shutdown(wait=False)
+			return fn(read_bytes(data), *args, **kwargs)
+		finally:
+			if shm:
+				shm.close()
+				shm.unlink()
+
+		metrics.add_state(state)
+		metrics.observe('media.pool_s', time.monotonic() - start)
+		return _load_result(result)
+
+
+# Process-wide executor.
+media_executor = MediaExecutor()
\ No newline at end of file
@@ -1,15 +1,41 @@
+import re
 import time
-import math
+import asyncio
+import subprocess
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import telegramify_markdown
 
-from telebot import apihelper
-from telebot.apihelper import ApiTelegramException
+from telebot import apihelper, asyncio_helper
 
-from constants.telegram import MAX_DRAFT_REQS_PER_MIN
-from constants.ai import CHARS_PER_TOKEN
+from constants.telegram import (
+	BOT_SHORT_DESCR,
+	STREAM_EDIT_MAX_INTERVAL,
+	STREAM_EDIT_MAX_RETRY_AFTER,
+	STREAM_EDIT_MIN_CHARS,
+	STREAM_MSG_MAX_CHARS,
+	STREAM_MSG_SOFT_MAX_CHARS,
+	STREAM_PLACEHOLDER
+)
 
+from utils.media import encode_voice
+from utils.metrics import metrics
+from utils.outbound import PRIORITY_DRAFT, PRIORITY_INFO, outbound_limiter, outbound_options
+from utils.streaming import DraftScheduler, AsyncDraftScheduler, draft_buckets
+from utils.versioning import get_version_str
+
+
+
+# telegramify_markdown changes the global state of its parser while it
+# renders, the dispatcher's workers must take turns.
+_markdownify_lock = threading.Lock()
+
+
+def markdownify(text):
+	with _markdownify_lock:
+		return telegramify_markdown.markdownify(text)
 
 
 def process_text(text):
@@ -21,11 +47,335 @@ def process_text(text):
 	text = text or '[EMPTY]'
 
 	# Markdown must be properly formatted.
-	text = telegramify_markdown.markdownify(text)
+	text = markdownify(text)
 
 	return text
 
 
+# Code fence as in CommonMark: up to 3 spaces, then 3 or more backticks
+# or tildes, and the info string.
+FENCE_REGEX = re.compile(r' {0,3}(`{3,}|~{3,})(.*)')
+
+
+def get_next_fence(fence, line):
+	"""Return the fence of the code block a Markdown text is in after a
+	line, given the one it was in before, None outside code blocks."""
+	match = FENCE_REGEX.match(line)
+	if fence:
+		# A block is closed by a fence of the same character, at least
+		# as long, with nothing after it.
+		if (
+			match
+			and match.group(1)[0] == fence[0]
+			and len(match.group(1)) >= len(fence)
+			and not match.group(2).strip()
+		):
+			return None
+		return fence
+	if match and not (match.group(1)[0] == '`' and '`' in match.group(2)):
+		return match.group(1)
+	return None
+
+
+class MarkdownStream:
+	"""
+	Text of a streamed reply that's formatted like process_text()
+	incrementally.
+
+	The text is split into a stable prefix, which ends at the last blank
+	line outside code blocks and can't change as the text grows, and a
+	tail. The prefix is formatted once and cached, only the tail is
+	formatted on every call to format().
+
+	Chunks may be appended while the text is being formatted in
+	another thread.
+	"""
+
+	def __init__(self):
+		self._chunks = []
+		# Text of the chunks joined so far.
+		self._text = ''
+		self._joined_count = 0
+		# Formatted stable prefix, and length of its source.
+		self._prefix = ''
+		self._prefix_len = 0
+		# Where the text is scanned from for the next stable prefix.
+		self._scan_pos = 0
+		# Fence of the code block the scan is in, e.g. '```', or None.
+		self._fence = None
+		self._after_blank = False
+
+
+	def append(self, chunk):
+		self._chunks.append(chunk)
+
+
+	def get_text(self):
+		"""Return the text of the chunks appended so far."""
+		count = len(self._chunks)
+		if count > self._joined_count:
+			self._text += ''.join(self._chunks[self._joined_count:count])
+			self._joined_count = count
+		return self._text
+
+
+	def format(self):
+		"""Return the text formatted for Telegram."""
+		text = self.get_text()
+
+		prefix_len = self._find_prefix_len(text)
+		if prefix_len > self._prefix_len:
+			self._prefix += markdownify(text[self._prefix_len:prefix_len])
+			self._prefix_len = prefix_len
+
+		tail = text[self._prefix_len:]
+		text = self._prefix + (markdownify(tail) if tail else '')
+		return text or process_text(text)
+
+
+	def _find_prefix_len(self, text):
+		"""Scan the new complete lines and return the length of the
+		stable prefix."""
+		prefix_len = self._prefix_len
+		while (end := text.find('\n', self._scan_pos)) != -1:
+			line = text[self._scan_pos:end]
+			in_code = self._fence is not None
+			self._fence = get_next_fence(self._fence, line)
+			if not in_code and line.strip():
+				# Split before a block, unless it's indented as it
+				# may continue the previous one.
+				if self._after_blank and not line[0].isspace():
+					prefix_len = self._scan_pos
+				self._after_blank = False
+			elif not in_code:
+				self._after_blank = True
+			self._scan_pos = end + 1
+		return prefix_len
+
+
+class EditedReply:
+	"""
+	Reply streamed by editing a message as its text grows. Past a
+	length, the text continues in a new message from the next line
+	outside code blocks, or anyway once the formatted text would be too
+	long, see STREAM_MSG_SOFT_MAX_CHARS. Code blocks cut are closed and
+	opened again in the next message.
+
+	Chunks may be appended while the messages are being sent in another
+	thread, which splits the text into messages.
+
+	Args:
+		msg:			Message replied to.
+		placeholder:	Message posted to be edited into the reply.
+	"""
+
+	def __init__(self, msg, placeholder):
+		self.msg = msg
+		self.length = 0
+		self._chunks = []
+		# Text of the chunks joined so far.
+		self._text = ''
+		self._joined_count = 0
+		# Formatted texts of the complete messages.
+		self._part_texts = []
+		# Where the open message starts in the text, the fence of the
+		# code block it opens again, and its text.
+		self._part_start = 0
+		self._part_fence = None
+		self._part = MarkdownStream()
+		self._part_len = 0
+		self._start = time.monotonic()
+		# Messages posted and texts sent, by part.
+		self._tg_msgs = [placeholder]
+		self._sent_texts = [None]
+
+
+	def append(self, chunk):
+		self.length += len(chunk)
+		self._chunks.append(chunk)
+
+
+	def get_text(self):
+		"""Return the text of the chunks appended so far."""
+		count = len(self._chunks)
+		if count > self._joined_count:
+			self._text += ''.join(self._chunks[self._joined_count:count])
+			self._joined_count = count
+		return self._text
+
+
+	def get_last_msg(self):
+		return self._tg_msgs[-1]
+
+
+	def get_edit_interval(self):
+		"""Return the min seconds between edits, the time the text
+		takes to grow STREAM_EDIT_MIN_CHARS at its observed rate."""
+		rate = self.length / (time.monotonic() - self._start)
+		if not rate:
+			return STREAM_EDIT_MAX_INTERVAL
+		return min(STREAM_EDIT_MIN_CHARS / rate, STREAM_EDIT_MAX_INTERVAL)
+
+
+	def _open_part(self, start, fence):
+		self._part_start = start
+		self._part_fence = fence
+		self._part = MarkdownStream()
+		self._part_len = 0
+		if fence:
+			self._part.append(fence + '\n')
+
+
+	def _format_part(self, text, fence):
+		"""Format the start of the open message's text, closing the
+		code block it ends in if any."""
+		if self._part_fence:
+			text = self._part_fence + '\n' + text
+		if fence:
+			text += ('' if text.endswith('\n') else '\n') + fence
+		return process_text(text)
+
+
+	def _find_cut(self, text, formatted):
+		"""
+		Return where to cut the text of the open message, if it must
+		be.
+
+		Returns:
+			(pos, fence):	Position and fence of the code block cut, or
+							None if the text is left whole.
+		"""
+		fits = lambda pos, fence: len(self._format_part(text[:pos], fence)) <= STREAM_MSG_MAX_CHARS
+
+		# Ends of the lines, and the fence of the code block each is
+		# in.
+		cuts = []
+		fence = self._part_fence
+		pos = 0
+		soft = True
+		while (end := text.find('\n', pos)) != -1:
+			fence = get_next_fence(fence, text[pos:end])
+			pos = end + 1
+			cuts.append((pos, fence))
+			if soft and pos >= STREAM_MSG_SOFT_MAX_CHARS and fence is None:
+				if fits(pos, fence):
+					return pos, fence
+				# Longer texts won't fit either.
+				soft = False
+
+		if len(formatted) <= STREAM_MSG_MAX_CHARS:
+			return None
+
+		# The last line fitting, found by bisection as the formatted
+		# length grows with the text.
+		lo, hi = 0, len(cuts)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if fits(*cuts[mid]):
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo:
+			return cuts[lo - 1]
+
+		# The first line is too long, cut it.
+		fence = self._part_fence
+		lo, hi = 1, len(text)
+		while lo < hi:
+			mid = (lo + hi + 1) // 2
+			if fits(mid, fence):
+				lo = mid
+			else:
+				hi = mid - 1
+		return lo, fence
+
+
+	def _update_parts(self):
+		"""Format the open message with the new text, cutting it into
+		complete messages while too long."""
+		text = self.get_text()
+		while True:
+			part_text = text[self._part_start:]
+			if len(part_text) > self._part_len:
+				self._part.append(part_text[self._part_len:])
+				self._part_len = len(part_text)
+			formatted = self._part.format()
+
+			if not (cut := self._find_cut(part_text, formatted)):
+				return formatted
+			pos, fence = cut
+			self._part_texts.append(self._format_part(part_text[:pos], fence))
+			self._open_part(self._part_start + pos, fence)
+
+
+	def iter_pending(self):
+		"""
+		Yield the parts which text changed since sent.
+
+		Yields:
+			(index, text, tg_msg):	Part's index and formatted text, and
+									its message, None if not posted yet.
+									Call set_sent() once sent.
+		"""
+		open_text = self._update_parts()
+		texts = self._part_texts[:]
+		if self._part_len or not texts:
+			texts.append(open_text)
+
+		for i, text in enumerate(texts):
+			if i == len(self._tg_msgs):
+				yield i, text, None
+			elif text != self._sent_texts[i]:
+				yield i, text, self._tg_msgs[i]
+
+
+	def set_sent(self, index, text, tg_msg):
+		if index == len(self._tg_msgs):
+			self._tg_msgs.append(tg_msg)
+			self._sent_texts.append(text)
+		else:
+			self._sent_texts[index] = text
+
+
+def build_start_text(bot_username):
+	return (
+		f'{BOT_SHORT_DESCR}\n'
+		'Click '
+		f'[here](https://t.me/{bot_username}?start=commands)'
+		' or use /help to get a list of user commands in a private chat.'
+	)
+
+
+def build_help_text():
+	version_str = get_version_str()
+	if version_str:
+		version_str = f'{version_str}\n\n'
+	else:
+		version_str = ''
+
+	return (
+		f'{version_str}'
+
+		'User Commands:\n\n'
+
+		'/sysmsg	-	Change the system message for this chat\n'
+		'/forget	-	Make the bot forget all the messages from this chat.\n'
+		'/chat		-	Chat with the AI\n'
+		'/achat		-	Chat with the AI and receive a voice message\n'
+		'/oldmsg	-	Show the oldest message the bot remembers\n'
+		'/to		-	Translate a message\n'
+		'/stt		-	Transcribe a message\n'
+		'/tts		-	Make a voice message out of a textual one\n'
+		'/img		-	Generate an image\n'
+
+		"\n**NOTE**: You don't need to use /chat or /achat, simply reply with text or voice instead."
+
+		'\n\nYou can find the full list of commands '
+		'[here](https://github.com/franbis/MultiAITeleBot/blob/main/commands.md)'
+		'.'
+	)
+
+
 def build_info_text(text):
 	return f'[INFO]\n{text}'
 	
@@ -35,30 +385,38 @@ def build_error_text(text):
 
 
 def reply_info(bot, msg, text):
-	bot.send_message(
-		msg.chat.id,
-		build_info_text(text),
-		message_thread_id=msg.message_thread_id,
-		reply_to_message_id=msg.id
-	)
+	with outbound_options(priority=PRIORITY_INFO):
+		bot.send_message(
+			msg.chat.id,
+			build_info_text(text),
+			message_thread_id=msg.message_thread_id,
+			reply_to_message_id=msg.id
+		)
 	
 	
 def reply_error(bot, msg, text):
-	bot.send_message(
-		msg.chat.id,
-		build_error_text(text),
-		message_thread_id=msg.message_thread_id,
-		reply_to_message_id=msg.id
-	)
+	with outbound_options(priority=PRIORITY_INFO):
+		bot.send_message(
+			msg.chat.id,
+			build_error_text(text),
+			message_thread_id=msg.message_thread_id,
+			reply_to_message_id=msg.id
+		)
+
+
+def build_exc_text(exc):
+	# Errors raised before reaching the API have no body.
+	body = exc.body if isinstance(exc.body, dict) else {}
+	err_msg = body.get('message') or exc.message
+	if exc.type == 'image_generation_user_error':
+		# OpenAI returns this error to avoid exposing the moderation reason.
+		err_msg = 'The server rejected the prompt'
+	return err_msg
 
 
 def print_exc(exc, bot, msg):
 	traceback.print_exc()
-	err_msg = exc.body['message']
-	if exc.body['type'] == 'image_generation_user_error':
-		# OpenAI returns this error to avoid exposing the moderation reason.
-		err_msg = 'The server rejected the prompt'
-	reply_error(bot, msg, err_msg)
+	reply_error(bot, msg, build_exc_text(exc))
 
 
 def reply_chat_msg(bot, msg, text):
@@ -80,69 +438,485 @@ def reply_voice_msg(bot, msg, text, ai):
 	)
 
 
+class SentenceSplitter:
+	"""
+	Cut the text of a stream of text chunks into sentences as soon as
+	they are complete.
+
+	Args:
+		min_chars:		Sentences shorter than this are joined with
+						the following ones.
+	"""
+
+	# A sentence ends at a punctuation mark followed by a space, which
+	# tells it apart from e.g. a decimal point, or at a line break.
+	SENTENCE_END_REGEX = re.compile(r'(?<=[.!?…])\s+|\n+')
+
+	def __init__(self, min_chars=1):
+		self.min_chars = min_chars
+		self._buffer = ''
+
+
+	def feed(self, chunk):
+		"""Add a chunk and return the sentences it completed."""
+		if not chunk:
+			return []
+
+		self._buffer += chunk
+		last_end = None
+		for match in self.SENTENCE_END_REGEX.finditer(self._buffer):
+			if len(self._buffer[:match.start()].strip()) >= self.min_chars:
+				last_end = match
+
+		if not last_end:
+			return []
+		sentences = [self._buffer[:last_end.start()].strip()]
+		self._buffer = self._buffer[last_end.end():]
+		return sentences
+
+
+	def flush(self):
+		"""Return the text left once the stream is over."""
+		text, self._buffer = self._buffer.strip(), ''
+		return [text] if text else []
+
+
+def split_tts_text(text, max_chars):
+	"""Split a text into chunks no longer than a number of characters,
+	at paragraph, sentence or, as a last resort, word boundaries."""
+
+	# (separator, piece) tuples.
+	pieces = []
+	for paragraph in re.split(r'\n\s*\n', text):
+		sep = '\n'
+		for piece in re.split(r'(?<=[.!?…])\s+', paragraph.strip()):
+			while len(piece) > max_chars:
+				cut = piece.rfind(' ', 0, max_chars + 1)
+				cut = cut if cut > 0 else max_chars
+				pieces.append((sep, piece[:cut]))
+				piece = piece[cut:].lstrip()
+				sep = ' '
+			pieces.append((sep, piece))
+			sep = ' '
+
+	chunks = []
+	for sep, piece in pieces:
+		if not piece:
+			continue
+		if chunks and len(chunks[-1]) + len(sep) + len(piece) <= max_chars:
+			chunks[-1] += sep + piece
+		else:
+			chunks.append(piece)
+	return chunks
+
+
+def synthesize_pcm(ai, text):
+	"""Synthesize speech as raw PCM audio, which can be joined with
+	other PCM audio."""
+	return ai.tts(text, response_format='pcm').read()
+
+
+def synthesize_voice(ai, text, config):
+	"""
+	Synthesize a voice message. Long texts are split into chunks
+	synthesized concurrently and joined in order, then encoded once.
+
+	Args:
+		ai:				AI instance.
+		text:			Text to synthesize.
+		config:			Bot's configuration manager.
+	"""
+
+	chunks = split_tts_text(text, config.get('tts.max_chars'))
+	if len(chunks) <= 1:
+		return ai.tts(text)
+
+	metrics.inc('tts.chunks', len(chunks))
+	with ThreadPoolExecutor(max_workers=config.get('tts.workers')) as pool:
+		# Results are returned in the chunks' order.
+		pcm = b''.join(pool.map(
+			lambda chunk: synthesize_pcm(ai, chunk),
+			chunks
+		))
+
+	try:
+		return encode_voice(pcm)
+	except (OSError, subprocess.CalledProcessError) as e:
+		print(f'ERROR - Speech could not be encoded, synthesizing it whole: {e}')
+		return ai.tts(text)
+
+
+def reply_voice_msg_stream(bot, msg, chunks, ai, config):
+	"""
+	Reply with a voice message to a stream of text chunks, having
+	each sentence synthesized as soon as it's complete, while the
+	rest of the text is still being generated. Return a tuple with the
+	Telegram message and the text.
+
+	Args:
+		bot:			Telegram bot instance.
+		msg:			Telegram message to reply to.
+		chunks:			Text chunks.
+		ai:				AI instance.
+		config:			Bot's configuration manager.
+	"""
+
+	start = time.monotonic()
+	splitter = SentenceSplitter(config.get('tts.min_chars'))
+	text_parts = []
+
+	def synthesize(sentence):
+		# Raw audio can be joined, encode it once at the end.
+		return synthesize_pcm(ai, sentence)
+
+	with ThreadPoolExecutor(max_workers=config.get('tts.workers')) as pool:
+		futures = []
+		for chunk in chunks:
+			if chunk:
+				text_parts.append(chunk)
+			for sentence in splitter.feed(chunk):
+				futures.append(pool.submit(synthesize, sentence))
+		for sentence in splitter.flush():
+			futures.append(pool.submit(synthesize, sentence))
+
+		# Results are joined in the sentences' order.
+		pcm = b''.join(future.result() for future in futures)
+
+	text = ''.join(text_parts)
+	try:
+		voice = encode_voice(pcm)
+	except (OSError, subprocess.CalledProcessError) as e:
+		print(f'ERROR - Speech could not be encoded, synthesizing it whole: {e}')
+		voice = ai.tts(text)
+
+	metrics.inc('tts.sentences', len(futures))
+	metrics.observe('tts.voice_reply_s', time.monotonic() - start)
+	return bot.send_voice(
+		msg.chat.id,
+		voice,
+		message_thread_id=msg.message_thread_id,
+		reply_to_message_id=msg.id
+	), text
+
+
 def edit_chat_msg(bot, msg, text):
 	text = process_text(text)
 	return bot.edit_message_text(text, msg.chat.id, msg.id, parse_mode='MarkdownV2')
 
 
+def build_draft_params(msg, text):
+	return {
+		'chat_id': msg.chat.id,
+		'message_thread_id': msg.message_thread_id,
+		'draft_id': msg.id,
+		'text': text,
+		'parse_mode': 'MarkdownV2',
+		# Drafts do not support replies.
+		# 'reply_parameters': {
+		# 	'message_id': msg.id,
+		# 	'chat_id': msg.chat.id
+		# }
+	}
+
+
 def send_message_draft(bot, msg, text):
-	return apihelper._make_request(
-		bot.token,
-		'sendMessageDraft',
-		method='post',
-		params={
-			'chat_id': msg.chat.id,
-			'message_thread_id': msg.message_thread_id,
-			'draft_id': msg.id,
-			'text': text,
-			'parse_mode': 'MarkdownV2',
-			# Drafts do not support replies.
-			# 'reply_parameters': {
-			# 	'message_id': msg.id,
-			# 	'chat_id': msg.chat.id
-			# }
-		}
+	# Drafts are paced by their scheduler.
+	with outbound_options(priority=PRIORITY_DRAFT, paced=True):
+		return apihelper._make_request(
+			bot.token,
+			'sendMessageDraft',
+			method='post',
+			params=build_draft_params(msg, text)
+		)
+
+
+def reply_chat_msg_stream(bot, msg, chunks):
+	stream = MarkdownStream()
+	scheduler = DraftScheduler(
+		lambda stream: send_message_draft(bot, msg, stream.format()),
+		draft_buckets.get(msg.chat.id)
 	)
+	try:
+		for chunk in chunks:
+			if chunk:
+				stream.append(chunk)
+				scheduler.update(stream)
+	finally:
+		scheduler.close()
 
+	return bot.reply_to(
+		msg,
+		stream.format(),
+		message_thread_id=msg.message_thread_id,
+		parse_mode='MarkdownV2'
+	)
+
+
+def send_reply_edits(bot, reply):
+	"""Send the changes of a reply streamed by editing messages."""
+	for i, text, tg_msg in reply.iter_pending():
+		if tg_msg is None:
+			tg_msg = bot.reply_to(
+				reply.msg,
+				text,
+				message_thread_id=reply.msg.message_thread_id,
+				parse_mode='MarkdownV2'
+			)
+		else:
+			bot.edit_message_text(text, tg_msg.chat.id, tg_msg.id, parse_mode='MarkdownV2')
+		reply.set_sent(i, text, tg_msg)
+
+
+def reply_chat_msg_stream_edits(bot, msg, chunks):
+	"""
+	Stream a reply by editing a message, for chats where drafts are
+	not supported. Edits are paced by the group's request budget and
+	stop if Telegram rate limits them for long, the complete reply is
+	sent anyway.
+
+	Args:
+		bot:			Telegram bot instance.
+		msg:			Message to reply to.
+		chunks:			Iterable of text chunks.
+
+	Returns:
+		(tg_msg, text):	Last message of the reply, and its raw text.
+	"""
+
+	reply = EditedReply(msg, bot.reply_to(
+		msg,
+		process_text(STREAM_PLACEHOLDER),
+		message_thread_id=msg.message_thread_id,
+		parse_mode='MarkdownV2'
+	))
+
+	def send_edits(reply):
+		# Edits are paced by the scheduler.
+		with outbound_options(priority=PRIORITY_DRAFT, paced=True):
+			send_reply_edits(bot, reply)
+
+	scheduler = DraftScheduler(
+		send_edits,
+		outbound_limiter.get_chat_bucket(msg.chat.id),
+		min_interval=reply.get_edit_interval,
+		max_retry_after=STREAM_EDIT_MAX_RETRY_AFTER
+	)
+	try:
+		for chunk in chunks:
+			if chunk:
+				reply.append(chunk)
+				scheduler.update(reply)
+	finally:
+		scheduler.close()
 
-def reply_chat_msg_stream(bot, msg, chunks, max_tokens):
-	full_text = ''
+	send_reply_edits(bot, reply)
 
-	def update_draft():
-		send_message_draft(bot, msg, process_text(full_text))
+	return reply.get_last_msg(), reply.get_text()
 
-	# Send the first chunk immediately to avoid having the user wait
-	full_text += next(chunks)
-	update_draft()
 
-	avg_tokens_per_chunk = max(1, len(full_text) // CHARS_PER_TOKEN)
-	# Predict the total chunks
-	total_chunks_pred = max_tokens / avg_tokens_per_chunk
-	max_chunks_per_req = math.ceil(total_chunks_pred / MAX_DRAFT_REQS_PER_MIN)
+# Async counterparts for the asyncio runtime.
 
-	processed_chunks = 1
-	for chunk in chunks:
-		if not chunk:
-			continue
 
-		processed_chunks += 1
+async def areply_info(bot, msg, text):
+	with outbound_options(priority=PRIORITY_INFO):
+		await bot.send_message(
+			msg.chat.id,
+			build_info_text(text),
+			message_thread_id=msg.message_thread_id,
+			reply_to_message_id=msg.id
+		)
 
-		full_text += chunk
-		if processed_chunks >= max_chunks_per_req:
-			try:
-				update_draft()
-			except ApiTelegramException as e:
-				if e.error_code == 429:
-					# `Too many requests`
-					time.sleep(e.result_json['parameters']['retry_after'])
-				else:
-					raise e
 
-			processed_chunks = 0
+async def areply_error(bot, msg, text):
+	with outbound_options(priority=PRIORITY_INFO):
+		await bot.send_message(
+			msg.chat.id,
+			build_error_text(text),
+			message_thread_id=msg.message_thread_id,
+			reply_to_message_id=msg.id
+		)
 
-	return bot.reply_to(
+
+async def aprint_exc(exc, bot, msg):
+	traceback.print_exc()
+	await areply_error(bot, msg, build_exc_text(exc))
+
+
+async def areply_chat_msg(bot, msg, text):
+	text = process_text(text)
+	return await bot.reply_to(
+		msg,
+		text,
+		message_thread_id=msg.message_thread_id,
+		parse_mode='MarkdownV2'
+	)
+
+
+async def areply_voice_msg(bot, msg, text, ai):
+	return await bot.send_voice(
+		msg.chat.id,
+		await ai.tts(text),
+		message_thread_id=msg.message_thread_id,
+		reply_to_message_id=msg.id
+	)
+
+
+async def asynthesize_pcm(ai, text):
+	"""Async counterpart of synthesize_pcm()."""
+	return await ai.tts(text, response_format='pcm')
+
+
+async def asynthesize_voice(ai, text, config):
+	"""Async counterpart of synthesize_voice()."""
+
+	chunks = split_tts_text(text, config.get('tts.max_chars'))
+	if len(chunks) <= 1:
+		return await ai.tts(text)
+
+	metrics.inc('tts.chunks', len(chunks))
+	semaphore = asyncio.Semaphore(config.get('tts.workers'))
+
+	async def synthesize(chunk):
+		async with semaphore:
+			return await asynthesize_pcm(ai, chunk)
+
+	# Results are returned in the chunks' order.
+	pcm = b''.join(await asyncio.gather(*map(synthesize, chunks)))
+
+	try:
+		return await asyncio.to_thread(encode_voice, pcm)
+	except (OSError, subprocess.CalledProcessError) as e:
+		print(f'ERROR - Speech could not be encoded, synthesizing it whole: {e}')
+		return await ai.tts(text)
+
+
+async def areply_voice_msg_stream(bot, msg, chunks, ai, config):
+	"""Async counterpart of reply_voice_msg_stream(), takes an async
+	iterable of chunks."""
+
+	start = time.monotonic()
+	splitter = SentenceSplitter(config.get('tts.min_chars'))
+	semaphore = asyncio.Semaphore(config.get('tts.workers'))
+	text_parts = []
+
+	async def synthesize(sentence):
+		async with semaphore:
+			# Raw audio can be joined, encode it once at the end.
+			return await asynthesize_pcm(ai, sentence)
+
+	tasks = []
+	async for chunk in chunks:
+		if chunk:
+			text_parts.append(chunk)
+		for sentence in splitter.feed(chunk):
+			tasks.append(asyncio.create_task(synthesize(sentence)))
+	for sentence in splitter.flush():
+		tasks.append(asyncio.create_task(synthesize(sentence)))
+
+	# Results are joined in the sentences' order.
+	pcm = b''.join(await asyncio.gather(*tasks))
+
+	text = ''.join(text_parts)
+	try:
+		voice = await asyncio.to_thread(encode_voice, pcm)
+	except (OSError, subprocess.CalledProcessError) as e:
+		print(f'ERROR - Speech could not be encoded, synthesizing it whole: {e}')
+		voice = await ai.tts(text)
+
+	metrics.inc('tts.sentences', len(tasks))
+	metrics.observe('tts.voice_reply_s', time.monotonic() - start)
+	return await bot.send_voice(
+		msg.chat.id,
+		voice,
+		message_thread_id=msg.message_thread_id,
+		reply_to_message_id=msg.id
+	), text
+
+
+async def aedit_chat_msg(bot, msg, text):
+	text = process_text(text)
+	return await bot.edit_message_text(text, msg.chat.id, msg.id, parse_mode='MarkdownV2')
+
+
+async def asend_message_draft(bot, msg, text):
+	# The async client stringifies every parameter, drop the unset ones.
+	params = {k: v for k, v in build_draft_params(msg, text).items() if v is not None}
+	with outbound_options(priority=PRIORITY_DRAFT, paced=True):
+		return await asyncio_helper._process_request(
+			bot.token,
+			'sendMessageDraft',
+			method='post',
+			params=params
+		)
+
+
+async def areply_chat_msg_stream(bot, msg, chunks):
+	stream = MarkdownStream()
+
+	async def send_draft(stream):
+		await asend_message_draft(bot, msg, stream.format())
+
+	scheduler = AsyncDraftScheduler(send_draft, draft_buckets.get(msg.chat.id))
+	try:
+		async for chunk in chunks:
+			if chunk:
+				stream.append(chunk)
+				scheduler.update(stream)
+	finally:
+		await scheduler.close()
+
+	return await bot.reply_to(
 		msg,
-		process_text(full_text),
+		stream.format(),
 		message_thread_id=msg.message_thread_id,
 		parse_mode='MarkdownV2'
-	)
\ No newline at end of file
+	)
+
+
+async def asend_reply_edits(bot, reply):
+	"""Async counterpart of send_reply_edits()."""
+	for i, text, tg_msg in reply.iter_pending():
+		if tg_msg is None:
+			tg_msg = await bot.reply_to(
+				reply.msg,
+				text,
+				message_thread_id=reply.msg.message_thread_id,
+				parse_mode='MarkdownV2'
+			)
+		else:
+			await bot.edit_message_text(text, tg_msg.chat.id, tg_msg.id, parse_mode='MarkdownV2')
+		reply.set_sent(i, text, tg_msg)
+
+
+async def areply_chat_msg_stream_edits(bot, msg, chunks):
+	"""Async counterpart of reply_chat_msg_stream_edits(), takes an
+	async iterable of chunks."""
+
+	reply = EditedReply(msg, await bot.reply_to(
+		msg,
+		process_text(STREAM_PLACEHOLDER),
+		message_thread_id=msg.message_thread_id,
+		parse_mode='MarkdownV2'
+	))
+
+	async def send_edits(reply):
+		with outbound_options(priority=PRIORITY_DRAFT, paced=True):
+			await asend_reply_edits(bot, reply)
+
+	scheduler = AsyncDraftScheduler(
+		send_edits,
+		outbound_limiter.get_chat_bucket(msg.chat.id),
+		min_interval=reply.get_edit_interval,
+		max_retry_after=STREAM_EDIT_MAX_RETRY_AFTER
+	)
+	try:
+		async for chunk in chunks:
+			if chunk:
+				reply.append(chunk)
+				scheduler.update(reply)
+	finally:
+		await scheduler.close()
+
+	await asend_reply_edits(bot, reply)
+
+	return reply.get_last_msg(), reply.get_text()
\ No newline at end of file
@@ -0,0 +1,140 @@
+import threading
+
+
+
+class Metrics:
+	"""
+	Thread-safe registry of runtime metrics.
+
+	There are three kinds of metrics:
+	- Counters, which only grow (e.g. handled messages).
+	- Gauges, which are either set or computed by a callback when
+	  taking a snapshot (e.g. queue depth).
+	- Timings, observed values of which count, average and maximum
+	  are kept (e.g. wait time).
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._counters = {}
+		self._gauges = {}
+		self._gauge_fns = {}
+		# name -> [count, total, max]
+		self._timings = {}
+
+
+	def inc(self, name, value=1):
+		"""Increase a counter."""
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + value
+
+
+	def set(self, name, value):
+		"""Set a gauge."""
+		with self._lock:
+			self._gauges[name] = value
+
+
+	def register_gauge(self, name, fn):
+		"""Register a gauge which value is computed by a callback when
+		taking a snapshot."""
+		with self._lock:
+			self._gauge_fns[name] = fn
+
+
+	def observe(self, name, value):
+		"""Record an observed value for a timing."""
+		with self._lock:
+			timing = self._timings.setdefault(name, [0, 0, value])
+			timing[0] += 1
+			timing[1] += value
+			timing[2] = max(timing[2], value)
+
+
+	def pop_state(self):
+		"""Return the recorded counters, set gauges and timings, and
+		forget them, e.g. to pass them to another process."""
+		with self._lock:
+			state = self._counters, self._gauges, self._timings
+			self._counters, self._gauges, self._timings = {}, {}, {}
+			return state
+
+
+	def add_state(self, state):
+		"""Add the metrics returned by pop_state(), usually in another
+		process."""
+		counters, gauges, timings = state
+		with self._lock:
+			for name, value in counters.items():
+				self._counters[name] = self._counters.get(name, 0) + value
+			self._gauges.update(gauges)
+			for name, (count, total, max_value) in timings.items():
+				timing = self._timings.setdefault(name, [0, 0, max_value])
+				timing[0] += count
+				timing[1] += total
+				timing[2] = max(timing[2], max_value)
+
+
+	def snapshot(self):
+		"""Return a dictionary with the current value of every
+		metric."""
+		with self._lock:
+			snap = dict(self._counters)
+			snap.update(self._gauges)
+			gauge_fns = dict(self._gauge_fns)
+			for name, (count, total, max_value) in self._timings.items():
+				snap[f'{name}.count'] = count
+				snap[f'{name}.avg'] = total / count
+				snap[f'{name}.max'] = max_value
+
+		# Callbacks may need locks of their own, call them after
+		# releasing the registry's one.
+		for name, fn in gauge_fns.items():
+			snap[name] = fn()
+
+		return snap
+
+
+	def to_text(self, snap=None):
+		"""Return a snapshot as human-readable text."""
+		snap = self.snapshot() if snap is None else snap
+		lines = []
+		for name, value in sorted(snap.items()):
+			if isinstance(value, float):
+				value = f'{value:.3f}'
+			lines.append(f'{name}: {value}')
+		return '\n'.join(lines)
+
+
+def merge_snapshots(snaps):
+	"""
+	Merge the snapshots of several processes into one. Maximums are
+	kept, averages are weighted by their counts and rates are averaged,
+	other values are added up.
+
+	Args:
+		snaps:			Snapshots, see Metrics.snapshot().
+	"""
+
+	merged = {}
+	# name -> [weighted total, weight]
+	averages = {}
+	for snap in snaps:
+		for name, value in snap.items():
+			if name.endswith('.max'):
+				merged[name] = max(merged.get(name, value), value)
+			elif name.endswith('.avg') or name.endswith('rate'):
+				weight = snap.get(f'{name[:-4]}.count', 1) if name.endswith('.avg') else 1
+				average = averages.setdefault(name, [0, 0])
+				average[0] += value * weight
+				average[1] += weight
+			else:
+				merged[name] = merged.get(name, 0) + value
+
+	for name, (total, weight) in averages.items():
+		merged[name] = total / weight if weight else 0.0
+	return merged
+
+
+# Process-wide registry.
+metrics = Metrics()
\ No newline at end of file
@@ -0,0 +1,417 @@
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from telebot import apihelper, asyncio_helper, types
+
+from constants.telegram import (
+	MAX_CHAT_MSG_BURST,
+	MAX_CHAT_MSG_REQS_PER_SEC,
+	MAX_GROUP_MSG_REQS_PER_MIN,
+	MAX_MSG_REQS_PER_SEC,
+	MAX_RATE_LIMITED_RETRIES
+)
+from utils.metrics import metrics
+from utils.rate_limit import TokenBucket, TokenBucketRegistry
+
+
+
+# Priorities of outbound requests, lower ones are sent first.
+PRIORITY_REPLY = 0
+PRIORITY_INFO = 1
+PRIORITY_DRAFT = 2
+
+PRIORITY_NAMES = {
+	PRIORITY_REPLY: 'reply',
+	PRIORITY_INFO: 'info',
+	PRIORITY_DRAFT: 'draft',
+}
+
+# Bot API methods sending or editing messages, which Telegram rate
+# limits.
+LIMITED_METHODS = {
+	'editMessageCaption',
+	'editMessageMedia',
+	'editMessageText',
+	'sendAnimation',
+	'sendAudio',
+	'sendDocument',
+	'sendMediaGroup',
+	'sendMessage',
+	'sendMessageDraft',
+	'sendPhoto',
+	'sendSticker',
+	'sendVideo',
+	'sendVoice',
+}
+
+# Options of the requests sent in the current context, see
+# outbound_options().
+priority_var = ContextVar('outbound_priority', default=PRIORITY_REPLY)
+paced_var = ContextVar('outbound_paced', default=False)
+
+
+def get_retry_after(exc):
+	"""Return the seconds to wait from a `Too many requests` Telegram
+	error, or None if the error is another one."""
+	if getattr(exc, 'error_code', None) == 429:
+		return exc.result_json.get('parameters', {}).get('retry_after', 1)
+
+
+@contextmanager
+def outbound_options(priority=PRIORITY_REPLY, paced=False):
+	"""
+	Set the options of the outbound requests sent in the context.
+
+	Args:
+		priority:		Priority of the requests.
+		paced:			Whether the chat's budget was taken already,
+						e.g. by a draft scheduler, in which case the
+						requests are neither limited by it nor retried.
+	"""
+	priority_token = priority_var.set(priority)
+	paced_token = paced_var.set(paced)
+	try:
+		yield
+	finally:
+		priority_var.reset(priority_token)
+		paced_var.reset(paced_token)
+
+
+class _Request:
+	"""Queued outbound request, sorted by priority then order."""
+
+	__slots__ = ('priority', 'order', 'bucket', 'wake', 'granted')
+
+	def __init__(self, priority, order, bucket, wake):
+		self.priority = priority
+		self.order = order
+		self.bucket = bucket
+		# Callable waking the request's waiter up, called with the lock
+		# held.
+		self.wake = wake
+		self.granted = False
+
+
+	def __lt__(self, other):
+		return (self.priority, self.order) < (other.priority, other.order)
+
+
+class OutboundLimiter:
+	"""
+	Thread-safe queue of outbound requests to Telegram which enforces
+	the global, per-chat and per-group rate limits with token buckets.
+	Queued requests are sent by priority, then in order, when their
+	budget allows.
+
+	Requests are queued by chat bucket. The head of each queue is kept
+	in a heap of requests allowed by their chat's budget, or in a heap
+	of the times the chat's budget allows them at, so that granting the
+	budget only looks at the requests that can be sent. Waiters sleep
+	until granted the budget, except one, the leader, which wakes up
+	when the next request may be granted it.
+	"""
+
+	def __init__(self):
+		self.bucket = TokenBucket(MAX_MSG_REQS_PER_SEC, MAX_MSG_REQS_PER_SEC)
+		self.chat_buckets = TokenBucketRegistry(MAX_CHAT_MSG_REQS_PER_SEC, MAX_CHAT_MSG_BURST)
+		self.group_buckets = TokenBucketRegistry(MAX_GROUP_MSG_REQS_PER_MIN / 60, MAX_CHAT_MSG_BURST)
+		self._lock = threading.Lock()
+		self._counter = itertools.count()
+		self._count = 0
+		# Heap of queued requests by chat bucket, None for the requests
+		# not limited by a chat's budget.
+		self._queues = {}
+		# Heads of the queues allowed by their chat's budget, which may
+		# include stale requests.
+		self._ready = []
+		# Heap of (time, order, bucket) of the queues waiting for their
+		# chat's budget.
+		self._timed = []
+		self._timed_buckets = set()
+		# Request waking up at the deadline to grant the budget.
+		self._leader = None
+		self._deadline = None
+
+		metrics.register_gauge('outbound.queued', lambda: self._count)
+
+
+	def set_share(self, share):
+		"""Keep the global budget to a share of Telegram's, e.g. when
+		several processes send requests with the same bot."""
+		rate = MAX_MSG_REQS_PER_SEC * share
+		with self._lock:
+			self.bucket = TokenBucket(rate, max(1, rate))
+
+
+	def get_chat_bucket(self, chat_id):
+		"""Return the bucket of a chat's message requests."""
+		# Group and channel ids are negative, and usernames are only
+		# given for channels.
+		if str(chat_id).startswith(('-', '@')):
+			return self.group_buckets.get(chat_id)
+		return self.chat_buckets.get(chat_id)
+
+
+	def _schedule(self, bucket):
+		"""Add the head of a queue to the ready requests, unless it's
+		waiting for its chat's budget."""
+		if bucket not in self._timed_buckets:
+			heapq.heappush(self._ready, self._queues[bucket][0])
+
+
+	def _enqueue(self, chat_id, wake):
+		bucket = None
+		if chat_id is not None and not paced_var.get():
+			bucket = self.get_chat_bucket(chat_id)
+
+		request = _Request(priority_var.get(), next(self._counter), bucket, wake)
+		queue = self._queues.setdefault(bucket, [])
+		heapq.heappush(queue, request)
+		self._count += 1
+		if queue[0] is request:
+			self._schedule(bucket)
+		self._dispatch()
+		return request
+
+
+	def _pop(self, request):
+		"""Take a request out of its queue."""
+		queue = self._queues[request.bucket]
+		was_head = queue[0] is request
+		if was_head:
+			heapq.heappop(queue)
+		else:
+			queue.remove(request)
+			heapq.heapify(queue)
+		self._count -= 1
+
+		if not queue:
+			del self._queues[request.bucket]
+		elif was_head:
+			self._schedule(request.bucket)
+		if self._leader is request:
+			self._leader = None
+
+
+	def _remove(self, request):
+		"""Take a request that won't be sent out of the queue."""
+		self._pop(request)
+		self._dispatch()
+
+
+	def _dispatch(self):
+		"""Grant the budget to the requests whose turn it is, and have
+		the leader wake up when the next one may be granted it."""
+		now = time.monotonic()
+		while self._timed and self._timed[0][0] <= now:
+			bucket = heapq.heappop(self._timed)[2]
+			self._timed_buckets.discard(bucket)
+			if bucket in self._queues:
+				self._schedule(bucket)
+
+		wait = 0
+		while self._ready:
+			request = self._ready[0]
+			queue = self._queues.get(request.bucket)
+			if (
+				request.granted
+				or not queue
+				or queue[0] is not request
+				or request.bucket in self._timed_buckets
+			):
+				heapq.heappop(self._ready)
+				continue
+
+			if (wait := self.bucket.get_wait_time()) > 0:
+				break
+
+			if request.bucket and not request.bucket.try_acquire():
+				# Requests of other chats may be sent meanwhile.
+				heapq.heappop(self._ready)
+				self._timed_buckets.add(request.bucket)
+				heapq.heappush(self._timed, (
+					now + request.bucket.get_wait_time(),
+					next(self._counter),
+					request.bucket
+				))
+				continue
+
+			if not self.bucket.try_acquire():
+				# Taken meanwhile, e.g. by a rate limit penalty.
+				if request.bucket:
+					request.bucket.consume(-1)
+				continue
+
+			heapq.heappop(self._ready)
+			self._pop(request)
+			request.granted = True
+			request.wake()
+
+		if not self._count:
+			self._leader = self._deadline = None
+			return
+
+		waits = [wait] if self._ready else []
+		if self._timed:
+			waits.append(self._timed[0][0] - now)
+		deadline = now + min(waits, default=0)
+		woken = self._leader is None or deadline < self._deadline
+		self._deadline = deadline
+		if self._leader is None:
+			self._leader = next(iter(self._queues.values()))[0]
+		if woken:
+			self._leader.wake()
+
+
+	def _get_timeout(self, request):
+		"""Return the seconds a waiter sleeps for, None until woken
+		up."""
+		if self._leader is request:
+			return max(0, self._deadline - time.monotonic())
+
+
+	def _observe(self, request, start):
+		queue_s = time.monotonic() - start
+		metrics.observe('outbound.queue_s', queue_s)
+		metrics.observe(f'outbound.queue_s.{PRIORITY_NAMES[request.priority]}', queue_s)
+
+
+	def acquire(self, chat_id):
+		"""Wait for the turn of a request to a chat, or to no chat in
+		particular if None."""
+		start = time.monotonic()
+		cond = threading.Condition(self._lock)
+		with self._lock:
+			request = self._enqueue(chat_id, cond.notify)
+			while not request.granted:
+				cond.wait(self._get_timeout(request))
+				if not request.granted:
+					self._dispatch()
+		self._observe(request, start)
+
+
+	async def aacquire(self, chat_id):
+		"""Async counterpart of acquire()."""
+		start = time.monotonic()
+		loop = asyncio.get_running_loop()
+		event = asyncio.Event()
+		with self._lock:
+			request = self._enqueue(chat_id, lambda: loop.call_soon_threadsafe(event.set))
+		try:
+			while True:
+				# Wake-ups are run by the loop, after this.
+				event.clear()
+				with self._lock:
+					if not request.granted:
+						self._dispatch()
+					if request.granted:
+						break
+					timeout = self._get_timeout(request)
+				try:
+					await asyncio.wait_for(event.wait(), timeout)
+				except asyncio.TimeoutError:
+					pass
+		except asyncio.CancelledError:
+			with self._lock:
+				if not request.granted:
+					self._remove(request)
+			raise
+		self._observe(request, start)
+
+
+	def on_rate_limited(self, chat_id, retry_after):
+		"""Wait for Telegram before sending more requests to a chat."""
+		metrics.inc('outbound.rate_limited')
+		if chat_id is not None:
+			self.get_chat_bucket(chat_id).penalize(retry_after)
+		else:
+			self.bucket.penalize(retry_after)
+
+
+# Process-wide limiter.
+outbound_limiter = OutboundLimiter()
+
+
+def should_retry(exc, chat_id, attempt):
+	"""Handle a failed request, return True if it must be retried."""
+	retry_after = get_retry_after(exc)
+	if retry_after is None:
+		return False
+
+	outbound_limiter.on_rate_limited(chat_id, retry_after)
+	# Paced requests are retried by their scheduler.
+	if paced_var.get() or attempt == MAX_RATE_LIMITED_RETRIES:
+		return False
+
+	metrics.inc('outbound.retries')
+	return True
+
+
+def rewind_files(files):
+	"""Seek the files of a request back to their start, as a failed
+	attempt may have read them already."""
+	for file in (files or {}).values():
+		if isinstance(file, tuple):
+			# (file name, file) tuples.
+			file = file[-1]
+		if isinstance(file, types.InputFile):
+			file = file.file
+		if hasattr(file, 'seek'):
+			try:
+				file.seek(0)
+			except (OSError, ValueError):
+				# Not seekable, or closed.
+				pass
+
+
+def install_outbound_limiter():
+	"""Send the message requests of the bots through the limiter."""
+
+	make_request = apihelper._make_request
+	process_request = asyncio_helper._process_request
+
+	def limited_make_request(token, method_name, method='get', params=None, files=None):
+		if method_name not in LIMITED_METHODS:
+			return make_request(token, method_name, method=method, params=params, files=files)
+
+		chat_id = (params or {}).get('chat_id')
+		for attempt in itertools.count():
+			outbound_limiter.acquire(chat_id)
+			if attempt:
+				rewind_files(files)
+			try:
+				return make_request(token, method_name, method=method, params=params, files=files)
+			except apihelper.ApiTelegramException as e:
+				if not should_retry(e, chat_id, attempt):
+					raise
+
+	async def limited_process_request(token, url, method='get', params=None, files=None, **kwargs):
+		if url not in LIMITED_METHODS:
+			return await process_request(token, url, method=method, params=params, files=files, **kwargs)
+
+		chat_id = (params or {}).get('chat_id')
+		for attempt in itertools.count():
+			await outbound_limiter.aacquire(chat_id)
+			if attempt:
+				rewind_files(files)
+			try:
+				# The params are consumed by the request.
+				return await process_request(
+					token,
+					url,
+					method=method,
+					params=dict(params) if params else params,
+					files=files,
+					**kwargs
+				)
+			except asyncio_helper.ApiTelegramException as e:
+				if not should_retry(e, chat_id, attempt):
+					raise
+
+	apihelper._make_request = limited_make_request
+	asyncio_helper._process_request = limited_process_request
\ No newline at end of file
@@ -1,6 +1,13 @@
 import re
-from utils.media import create_image_url, speed_up_audio
-from utils.telegram import get_telegram_file_bytes
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.blobs import get_blob_url, new_image_blob
+from utils.media import speed_up_audio, speed_up_audio_ffmpeg, split_audio_bytes
+from utils.media_executor import media_executor
+from utils.metrics import metrics
+from utils.telegram import download_telegram_file, adownload_telegram_file
 
 
 
@@ -9,18 +16,39 @@ def find_msg_audio(msg):
 	return msg.audio if msg.audio else msg.voice
 
 
-def prepare_audio(bot, msg_audio, config):
-	"""Build an audio data tuple to pass as "audio" argument to the AI."""
-	file_info = bot.get_file(msg_audio.file_id)
-	file_bytes = bot.download_file(file_info.file_path)
+def get_vad_options(config):
+	"""Return the options to remove silence from audio with, or None if
+	silence removal is disabled."""
+	vad = dict(config.get('prompt.audio.vad'))
+	if vad.pop('enabled'):
+		return vad
+
+
+def process_audio(file, config):
+	"""Process a downloaded audio file and build an audio data tuple to
+	pass as "audio" argument to the AI."""
 	
 	# Speed-up the audio wave to save on bandwidth and reduce API usage.
-	file_bytes = speed_up_audio(
-		file_bytes,
-		speed=config.get('prompt.audio.speed'),
-		chunk_size=config.get('prompt.audio.chunk_size'),
-		crossfade=config.get('prompt.audio.crossfade')
-	)
+	start = time.monotonic()
+	engine = config.get('prompt.audio.engine')
+	if engine == 'ffmpeg':
+		file_bytes = media_executor.run(
+			speed_up_audio_ffmpeg,
+			file,
+			speed=config.get('prompt.audio.speed'),
+			vad=get_vad_options(config)
+		)
+	else:
+		file_bytes = media_executor.run(
+			speed_up_audio,
+			file,
+			speed=config.get('prompt.audio.speed'),
+			chunk_size=config.get('prompt.audio.chunk_size'),
+			crossfade=config.get('prompt.audio.crossfade'),
+			vad=get_vad_options(config)
+		)
+	metrics.observe(f'media.audio_{engine}_s', time.monotonic() - start)
+	metrics.inc(f'media.audio_{engine}_bytes_out', len(file_bytes))
 	
 	# NOTE: OpenAI infers the file format by reading the filename extension.
 	#		So use OGG as that's the format audio files are compressed into
@@ -28,6 +56,89 @@ def prepare_audio(bot, msg_audio, config):
 	return '.ogg', file_bytes
 
 
+def prepare_audio(bot, msg_audio, config):
+	"""Build an audio data tuple to pass as "audio" argument to the AI."""
+	with download_telegram_file(bot, msg_audio.file_id) as file:
+		return process_audio(file, config)
+
+
+def split_audio(audio, config):
+	"""Split an audio data tuple into audio data tuples of segments
+	short enough to be transcribed concurrently."""
+	ext, file_bytes = audio
+	segment_config = config.get('prompt.audio.segments')
+	try:
+		segments = media_executor.run(
+			split_audio_bytes,
+			file_bytes,
+			max_segment_ms=segment_config['max_s'] * 1000,
+			overlap_ms=segment_config['overlap_s'] * 1000,
+			search_ms=segment_config['search_s'] * 1000
+		)
+	except Exception as e:
+		print(f'ERROR - Audio could not be split, transcribing it whole: {e}')
+		return [audio]
+
+	if not segments:
+		return [audio]
+	return [(ext, segment) for segment in segments]
+
+
+def merge_transcripts(texts, max_overlap_words=20):
+	"""Join the transcripts of consecutive audio segments, dropping the
+	words at the start of each transcript that repeat the end of the
+	previous one, as segments overlap."""
+
+	def normalize(word):
+		return re.sub(r'\W', '', word).lower()
+
+	words = []
+	for text in texts:
+		new_words = text.split()
+		normalized_tail = [normalize(w) for w in words[-max_overlap_words:]]
+		normalized_head = [normalize(w) for w in new_words[:max_overlap_words]]
+		# Find the longest repeated run.
+		for n in range(min(len(normalized_tail), len(normalized_head)), 0, -1):
+			if normalized_tail[-n:] == normalized_head[:n]:
+				new_words = new_words[n:]
+				break
+		words += new_words
+	return ' '.join(words)
+
+
+def transcribe(ai, audio, config):
+	"""
+	Transcribe an audio data tuple. Long audio is split into segments
+	transcribed concurrently, so that the time taken is about the time
+	taken by the longest segment.
+
+	Args:
+		ai:			AI instance.
+		audio:		Audio data tuple.
+		config:		Bot's configuration manager.
+	"""
+
+	audios = split_audio(audio, config)
+	if len(audios) == 1:
+		return ai.stt(audio).text
+
+	metrics.inc('stt.segments', len(audios))
+	with ThreadPoolExecutor(max_workers=config.get('prompt.audio.segments.workers')) as pool:
+		# Results are returned in the segments' order.
+		texts = list(pool.map(lambda a: ai.stt(a).text, audios))
+	return merge_transcripts(texts)
+
+
+def get_command_text(msg):
+	"""Return the text of a Telegram message without the leading command,
+	if any."""
+	text = msg.text
+	if text.startswith('/'):
+		# Get the part after the command.
+		text = ''.join(text.split(' ', 1)[1:])
+	return text
+
+
 def get_prompt(msg, type='text', from_reply=False, bot=None, ai=None, config=None):
 	"""
 	Get the prompt from a Telegram message or quoted message.
@@ -54,16 +165,13 @@ def get_prompt(msg, type='text', from_reply=False, bot=None, ai=None, config=Non
 		if msg_audio:
 			audio = prepare_audio(bot, msg_audio, config=config)
 			if type == 'text':
-				prompt = ai.stt(audio).text
+				prompt = transcribe(ai, audio, config)
 			elif type == 'audio':
 				prompt = audio
 			
 		else:
 			if type == 'text':
-				prompt = msg.text
-				if msg.text.startswith('/'):
-					# Get the part after the command.
-					prompt = ''.join(msg.text.split(' ', 1)[1:])
+				prompt = get_command_text(msg)
 	
 	return prompt if prompt else None
 
@@ -89,11 +197,43 @@ def find_e_replace_img_urls(text, index_start=1):
 	return url_matches, in_text_w_refs
 
 
-def extract_img_urls(bot, msg, text):
+def find_msg_photo(msg):
+	"""Find the photo quoted by a Telegram message, if any."""
+	if msg.reply_to_message and (msg.reply_to_message.content_type == 'photo'):
+		# NOTE: 'photo'' is a list where each item is a version of the same photo with
+		#		a different resolution, with the last one having the highest resolution.
+		#		See https://stackoverflow.com/questions/58674646/telegram-bot-api-using-getfile-with-a-high-quality-photos-file-id-yields
+		#		for further information.
+
+		# The first item from the 'photo' list is what gets used as media preview, pick it
+		# as the AI is good at analyzing even low-res images.
+		return msg.reply_to_message.photo[0]
+
+
+def merge_img_urls(text, img_urls):
+	"""Append the image URLs found in a text to a list of image URLs and
+	return a tuple with the text with URLs replaced by indexed image labels
+	and the merged list."""
+	text_img_urls, text = find_e_replace_img_urls(text, index_start=len(img_urls) + 1)
+	return text, img_urls + text_img_urls
+
+
+def get_image_encoding_options(ai, config):
+	"""Return the options to prepare images for the vision model
+	with."""
+	return {
+		'detail': ai.options.get('vision.detail'),
+		'format': config.get('prompt.image.format'),
+		'quality': config.get('prompt.image.quality'),
+	}
+
+
+def extract_img_urls(bot, msg, text, ai=None, config=None):
 	"""
-	Return a touple with the text with URLs replaced by indexed image labels and
+	Return a touple with the text with URLs replaced by indexed image labels,
 	the image URLs found in the text or the URL referencing an image present
-	in a Telegram message.
+	in a Telegram message, and the blobs of the images from the Telegram
+	message, which must be stored along with the message referencing them.
 
 	NOTE: There can only be one medium attachment per Telegram message, as media
 			are actually sent through multiple messages and linked together by the
@@ -106,24 +246,87 @@ def extract_img_urls(bot, msg, text):
 		bot:	Telegram bot instance.
 		msg:	Telegram message containing images.
 		text:	String containing image URLs.
+		ai:		AI instance.
+		config:	Bot's configuration manager.
 	"""
 	
 	img_urls = []
-	if msg.reply_to_message and (msg.reply_to_message.content_type == 'photo'):
-		# NOTE: 'photo'' is a list where each item is a version of the same photo with
-		#		a different resolution, with the last one having the highest resolution.
-		#		See https://stackoverflow.com/questions/58674646/telegram-bot-api-using-getfile-with-a-high-quality-photos-file-id-yields
-		#		for further information.
-		
+	blobs = []
+	if photo := find_msg_photo(msg):
 		# NOTE: file_unique_id can't be used to download media.
+		with download_telegram_file(bot, photo.file_id) as file:
+			blob = new_image_blob(file, **get_image_encoding_options(ai, config))
+		img_urls.append(get_blob_url(blob.sha256))
+		blobs.append(blob)
+	
+	return *merge_img_urls(text, img_urls), blobs
 
-		# The first item from the 'photo' list is what gets used as media preview, pick it
-		# as the AI is good at analyzing even low-res images.
-		file_bytes = get_telegram_file_bytes(bot, msg.reply_to_message.photo[0].file_id)
-		url = create_image_url(file_bytes)
-		img_urls.append(str(url))
+
+# Async counterparts for the asyncio runtime. CPU-bound media
+# processing runs in a thread to keep the event loop responsive.
+
+
+async def aprepare_audio(bot, msg_audio, config):
+	"""Async counterpart of prepare_audio()."""
+	with await adownload_telegram_file(bot, msg_audio.file_id) as file:
+		return await asyncio.to_thread(process_audio, file, config)
+
+
+async def atranscribe(ai, audio, config):
+	"""Async counterpart of transcribe()."""
+
+	audios = await asyncio.to_thread(split_audio, audio, config)
+	if len(audios) == 1:
+		return (await ai.stt(audio)).text
+
+	metrics.inc('stt.segments', len(audios))
+	semaphore = asyncio.Semaphore(config.get('prompt.audio.segments.workers'))
+
+	async def stt(audio):
+		async with semaphore:
+			return (await ai.stt(audio)).text
+
+	# Results are returned in the segments' order.
+	return merge_transcripts(await asyncio.gather(*map(stt, audios)))
+
+
+async def aget_prompt(msg, type='text', from_reply=False, bot=None, ai=None, config=None):
+	"""Async counterpart of get_prompt()."""
 	
-	text_img_urls, text = find_e_replace_img_urls(text, index_start=len(img_urls) + 1)
-	img_urls += text_img_urls
+	prompt = None
+
+	if from_reply:
+		msg = msg.reply_to_message
+	
+	if msg:
+		msg_audio = find_msg_audio(msg)
+		if msg_audio:
+			audio = await aprepare_audio(bot, msg_audio, config=config)
+			if type == 'text':
+				prompt = await atranscribe(ai, audio, config)
+			elif type == 'audio':
+				prompt = audio
+			
+		else:
+			if type == 'text':
+				prompt = get_command_text(msg)
+	
+	return prompt if prompt else None
+
 
-	return text, img_urls
+async def aextract_img_urls(bot, msg, text, ai=None, config=None):
+	"""Async counterpart of extract_img_urls()."""
+	
+	img_urls = []
+	blobs = []
+	if photo := find_msg_photo(msg):
+		with await adownload_telegram_file(bot, photo.file_id) as file:
+			blob = await asyncio.to_thread(
+				new_image_blob,
+				file,
+				**get_image_encoding_options(ai, config)
+			)
+		img_urls.append(get_blob_url(blob.sha256))
+		blobs.append(blob)
+	
+	return *merge_img_urls(text, img_urls), blobs
@@ -0,0 +1,96 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+
+class TokenBucket:
+	"""
+	Thread-safe token bucket. Tokens are added at a constant rate up
+	to a capacity and each request takes one.
+
+	Args:
+		rate:			Tokens added per second.
+		capacity:		Max tokens, which is the max burst of requests.
+	"""
+
+	def __init__(self, rate, capacity=1):
+		self.rate = rate
+		self.capacity = capacity
+		self._lock = threading.Lock()
+		self._tokens = capacity
+		self._updated_at = time.monotonic()
+
+
+	def _refill(self):
+		now = time.monotonic()
+		self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+		self._updated_at = now
+
+
+	def try_acquire(self, tokens=1):
+		"""Take tokens and return True if available, return False
+		otherwise."""
+		with self._lock:
+			self._refill()
+			if self._tokens >= tokens:
+				self._tokens -= tokens
+				return True
+			return False
+
+
+	def get_wait_time(self, tokens=1):
+		"""Return the seconds until tokens are available."""
+		with self._lock:
+			self._refill()
+			return max(0.0, (tokens - self._tokens) / self.rate)
+
+
+	def consume(self, tokens):
+		"""Take tokens even if unavailable, e.g. when the tokens a
+		request took are only known once done. Negative tokens are
+		given back."""
+		with self._lock:
+			self._refill()
+			self._tokens = min(self.capacity, self._tokens - tokens)
+
+
+	def penalize(self, seconds):
+		"""Empty the bucket for some seconds, e.g. when the server tells
+		to retry after them."""
+		with self._lock:
+			self._refill()
+			self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+class TokenBucketRegistry:
+	"""
+	Thread-safe registry of token buckets by key, e.g. by chat. The
+	least recently used buckets are forgotten past a number of them,
+	which are the ones most likely to be full again.
+
+	Args:
+		rate:			Tokens added per second to each bucket.
+		capacity:		Max tokens per bucket.
+		max_size:		Max buckets to remember.
+	"""
+
+	def __init__(self, rate, capacity=1, max_size=10000):
+		self.rate = rate
+		self.capacity = capacity
+		self.max_size = max_size
+		self._lock = threading.Lock()
+		self._buckets = OrderedDict()
+
+
+	def get(self, key):
+		"""Return the bucket for a key, creating it if nonexistent."""
+		with self._lock:
+			bucket = self._buckets.get(key)
+			if bucket is None:
+				bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+				if len(self._buckets) > self.max_size:
+					self._buckets.popitem(last=False)
+			else:
+				self._buckets.move_to_end(key)
+			return bucket
\ No newline at end of file
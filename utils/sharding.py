@@ -0,0 +1,408 @@
+import os
+import sys
+import time
+import asyncio
+import secrets
+import threading
+import subprocess
+import traceback
+import zlib
+from collections import deque
+from multiprocessing.connection import Client, Listener
+
+from telebot import apihelper
+from telebot.types import Update
+
+from utils.metrics import metrics, merge_snapshots
+from utils.webhook import run_webhook_server
+
+
+
+# Environment variables telling a process it's a worker and how to
+# reach its supervisor.
+SHARD_ENV = 'BOT_SHARD'
+SHARD_AUTHKEY_ENV = 'BOT_SHARD_AUTHKEY'
+
+# Seconds between metrics exchanges.
+METRICS_INTERVAL_S = 5
+
+# Max updates kept for a worker while it's down, older ones are
+# dropped.
+MAX_PENDING_UPDATES = 10000
+
+# A worker running longer than these seconds isn't crashing in a loop,
+# restarting it again doesn't wait.
+MIN_UPTIME_S = 60
+MAX_RESTART_DELAY_S = 60
+
+# Seconds to wait for an update when polling.
+POLLING_TIMEOUT_S = 20
+
+
+def get_update_chat_key(update_json):
+	"""Return the key of the chat an update belongs to, matching
+	get_chat_key(), or None if there's no chat."""
+	for name, value in update_json.items():
+		if not isinstance(value, dict):
+			continue
+		# Messages have a chat, callback queries have a message.
+		msg = value if 'chat' in value else value.get('message')
+		if msg and 'chat' in msg:
+			return msg['chat']['id'], msg.get('message_thread_id') or 0
+
+
+def get_shard_index(key, count):
+	"""Return the index of the worker a chat key is routed to, which is
+	the same in every process and run, unlike hash()."""
+	if key is None:
+		return 0
+	return zlib.crc32(repr(key).encode()) % count
+
+
+class WorkerProcess:
+	"""
+	A worker process run by the supervisor, along with the connection
+	its updates are sent through.
+
+	Args:
+		index:			Worker's index.
+	"""
+
+	def __init__(self, index):
+		self.index = index
+		self.proc = None
+		self.conn = None
+		self.started_at = None
+		self.restart_at = None
+		self.failures = 0
+		self.connected = threading.Event()
+		self._lock = threading.Lock()
+		# Updates received while disconnected.
+		self._pending = deque()
+
+
+	def send(self, msg):
+		"""Send a message to the worker, or keep it for when the worker
+		connects again if it's down."""
+		with self._lock:
+			if self.conn is not None:
+				try:
+					self.conn.send(msg)
+					return
+				except OSError:
+					self.conn = None
+
+			if msg[0] != 'update':
+				return
+			self._pending.append(msg)
+			if len(self._pending) > MAX_PENDING_UPDATES:
+				self._pending.popleft()
+				metrics.inc('supervisor.dropped')
+
+
+	def attach(self, conn):
+		"""Use a new connection, sending it the pending updates."""
+		with self._lock:
+			while self._pending:
+				conn.send(self._pending.popleft())
+			self.conn = conn
+		self.connected.set()
+
+
+	def detach(self, conn):
+		with self._lock:
+			if self.conn is conn:
+				self.conn = None
+				self.connected.clear()
+
+
+class Supervisor:
+	"""
+	Runs the bot in several worker processes so that CPU-bound work
+	isn't limited by a single process' GIL. Updates are routed to the
+	workers by chat, so each chat's updates are handled in order by a
+	single worker. Crashed workers are restarted, and the workers'
+	metrics are gathered and shared with all of them.
+
+	Workers are started with the command line of the supervisor.
+
+	Args:
+		workers:		Number of worker processes.
+	"""
+
+	def __init__(self, workers):
+		self.workers = [WorkerProcess(i) for i in range(workers)]
+		self.authkey = secrets.token_bytes(32)
+		self.listener = Listener(('127.0.0.1', 0), authkey=self.authkey)
+		# Latest metrics snapshot of each worker.
+		self.snapshots = {}
+		self._stopping = False
+
+		metrics.register_gauge('supervisor.workers_alive', lambda: sum(
+			1 for worker in self.workers if worker.connected.is_set()
+		))
+
+
+	def _spawn(self, worker):
+		host, port = self.listener.address
+		env = dict(os.environ)
+		env[SHARD_ENV] = f'{worker.index}:{len(self.workers)}:{host}:{port}'
+		env[SHARD_AUTHKEY_ENV] = self.authkey.hex()
+		worker.proc = subprocess.Popen([sys.executable] + sys.argv, env=env)
+		worker.started_at = time.monotonic()
+		worker.restart_at = None
+
+
+	def start(self):
+		"""Start the worker processes."""
+		for target in (self._accept, self._monitor, self._share_metrics):
+			threading.Thread(target=target, daemon=True).start()
+
+		# The first worker sets the database up alone.
+		first = self.workers[0]
+		self._spawn(first)
+		while not first.connected.wait(1):
+			if first.proc.poll() is not None:
+				raise RuntimeError(f'Worker 0 exited with code {first.proc.returncode}')
+
+		for worker in self.workers[1:]:
+			self._spawn(worker)
+
+
+	def stop(self):
+		"""Terminate the worker processes."""
+		self._stopping = True
+		for worker in self.workers:
+			if worker.proc and worker.proc.poll() is None:
+				worker.proc.terminate()
+		for worker in self.workers:
+			if worker.proc:
+				worker.proc.wait()
+
+
+	def route(self, update_json):
+		"""Send an update to the worker of its chat."""
+		key = get_update_chat_key(update_json)
+		worker = self.workers[get_shard_index(key, len(self.workers))]
+		worker.send(('update', update_json))
+		metrics.inc('supervisor.updates')
+
+
+	def _accept(self):
+		while True:
+			try:
+				conn = self.listener.accept()
+				kind, index = conn.recv()
+			except Exception as e:
+				print(f'ERROR - Worker could not connect: {e}')
+				continue
+			threading.Thread(target=self._receive, args=(self.workers[index], conn), daemon=True).start()
+
+
+	def _receive(self, worker, conn):
+		worker.attach(conn)
+		try:
+			while True:
+				kind, value = conn.recv()
+				if kind == 'metrics':
+					self.snapshots[worker.index] = value
+		except (EOFError, OSError):
+			worker.detach(conn)
+
+
+	def _monitor(self):
+		"""Restart the workers that exited, waiting longer if they keep
+		crashing."""
+		while not self._stopping:
+			time.sleep(1)
+			for worker in self.workers:
+				if self._stopping or worker.proc is None or worker.proc.poll() is None:
+					continue
+
+				if worker.restart_at is None:
+					print(f'ERROR - Worker {worker.index} exited with code {worker.proc.returncode}, restarting it.')
+					worker.connected.clear()
+					self.snapshots.pop(worker.index, None)
+					if time.monotonic() - worker.started_at > MIN_UPTIME_S:
+						worker.failures = 0
+					worker.restart_at = time.monotonic() + min(MAX_RESTART_DELAY_S, 2**worker.failures - 1)
+					worker.failures += 1
+
+				if time.monotonic() >= worker.restart_at:
+					metrics.inc('supervisor.restarts')
+					self._spawn(worker)
+
+
+	def _share_metrics(self):
+		"""Send every worker the metrics of the others and of the
+		supervisor."""
+		while True:
+			time.sleep(METRICS_INTERVAL_S)
+			snapshots = dict(self.snapshots)
+			snapshots['supervisor'] = metrics.snapshot()
+			for worker in self.workers:
+				worker.send(('metrics', snapshots))
+
+
+	def poll(self, token, allowed_updates):
+		"""Receive the updates through polling and route them,
+		forever."""
+		offset = None
+		while True:
+			try:
+				updates = apihelper.get_updates(
+					token,
+					offset=offset,
+					timeout=POLLING_TIMEOUT_S,
+					allowed_updates=allowed_updates,
+					long_polling_timeout=POLLING_TIMEOUT_S
+				)
+			except Exception as e:
+				print(f'ERROR - Updates could not be received: {e}')
+				time.sleep(1)
+				continue
+
+			for update_json in updates:
+				offset = update_json['update_id'] + 1
+				try:
+					self.route(update_json)
+				except Exception:
+					traceback.print_exc()
+
+
+def run_supervisor(workers, token, allowed_updates, webhook=None):
+	"""
+	Run the bot in worker processes and route them the updates received
+	through polling, or through a webhook if set, forever.
+
+	Args:
+		workers:			Number of worker processes.
+		token:				Telegram bot token.
+		allowed_updates:	Update types to receive.
+		webhook:			Dictionary with the 'url' of the webhook and
+							the arguments of run_webhook_server() other
+							than the bot, or None to poll.
+	"""
+
+	supervisor = Supervisor(workers)
+	supervisor.start()
+	print(f'Supervising {workers} workers')
+	try:
+		if webhook:
+			webhook = dict(webhook)
+			apihelper.set_webhook(
+				token,
+				url=webhook.pop('url'),
+				secret_token=webhook['secret_token'],
+				allowed_updates=allowed_updates
+			)
+			run_webhook_server(None, router=supervisor.route, **webhook)
+		else:
+			# Polling doesn't work while a webhook is set.
+			apihelper.delete_webhook(token)
+			supervisor.poll(token, allowed_updates)
+	finally:
+		supervisor.stop()
+
+
+class ShardWorker:
+	"""
+	The side of a worker process run by a supervisor, see Supervisor.
+
+	Args:
+		index:			Worker's index.
+		count:			Number of workers.
+		address:		Supervisor's address.
+		authkey:		Key authenticating the connection.
+	"""
+
+	def __init__(self, index, count, address, authkey):
+		self.index = index
+		self.count = count
+		self.address = address
+		self.authkey = authkey
+		self.conn = None
+		# Latest metrics snapshots of the other processes.
+		self.snapshots = {}
+
+
+	@classmethod
+	def from_env(cls):
+		"""Return the worker this process is, or None if it isn't run
+		by a supervisor."""
+		if not (shard := os.environ.get(SHARD_ENV)):
+			return None
+		index, count, host, port = shard.split(':')
+		return cls(
+			int(index),
+			int(count),
+			(host, int(port)),
+			bytes.fromhex(os.environ[SHARD_AUTHKEY_ENV])
+		)
+
+
+	def get_snapshot(self):
+		"""Return the metrics of all the processes merged."""
+		snapshots = [snap for key, snap in self.snapshots.items() if key != self.index]
+		return merge_snapshots(snapshots + [metrics.snapshot()])
+
+
+	def _connect(self):
+		self.conn = Client(self.address, authkey=self.authkey)
+		self.conn.send(('hello', self.index))
+		threading.Thread(target=self._publish_metrics, daemon=True).start()
+		print(f'Worker {self.index} of {self.count} connected')
+
+
+	def _publish_metrics(self):
+		while True:
+			time.sleep(METRICS_INTERVAL_S)
+			try:
+				self.conn.send(('metrics', metrics.snapshot()))
+			except OSError:
+				return
+
+
+	def _handle(self, msg):
+		"""Handle a message from the supervisor, return the update it
+		carries if any."""
+		kind, value = msg
+		if kind == 'metrics':
+			self.snapshots = value
+		elif kind == 'update':
+			return Update.de_json(value)
+
+
+	def run(self, bot):
+		"""Feed the bot the updates routed to this worker until the
+		supervisor stops."""
+		self._connect()
+		while True:
+			try:
+				msg = self.conn.recv()
+			except (EOFError, OSError):
+				print('ERROR - Supervisor disconnected, stopping.')
+				return
+
+			if update := self._handle(msg):
+				try:
+					bot.process_new_updates([update])
+				except Exception:
+					traceback.print_exc()
+
+
+	async def arun(self, bot):
+		"""Async counterpart of run()."""
+		self._connect()
+		while True:
+			try:
+				msg = await asyncio.to_thread(self.conn.recv)
+			except (EOFError, OSError):
+				print('ERROR - Supervisor disconnected, stopping.')
+				return
+
+			if update := self._handle(msg):
+				try:
+					await bot.process_new_updates([update])
+				except Exception:
+					traceback.print_exc()
\ No newline at end of file
@@ -0,0 +1,194 @@
+import time
+import asyncio
+import threading
+
+from constants.telegram import MAX_DRAFT_REQS_PER_MIN
+from utils.metrics import metrics
+from utils.outbound import get_retry_after
+from utils.rate_limit import TokenBucketRegistry
+
+
+
+# Draft request budget of each chat, shared by the replies streamed to
+# it.
+draft_buckets = TokenBucketRegistry(MAX_DRAFT_REQS_PER_MIN / 60)
+
+
+class BaseDraftScheduler:
+	"""
+	Sends the drafts of a streamed reply apart from the stream, as
+	often as the chat's request budget allows.
+
+	The text is updated on every chunk and only its latest state is
+	sent, so reading the stream never waits for Telegram.
+
+	Args:
+		send:			Callable sending a draft of the text passed to
+						update().
+		bucket:			Token bucket of the chat's draft requests.
+		min_interval:	Callable returning the min seconds between
+						drafts, otherwise only the bucket limits them.
+		max_retry_after:	Max seconds to wait for when rate limited,
+						past them no more drafts are sent.
+	"""
+
+	def __init__(self, send, bucket, min_interval=None, max_retry_after=None):
+		self.send = send
+		self.bucket = bucket
+		self.min_interval = min_interval
+		self.max_retry_after = max_retry_after
+		self.draft_count = 0
+		# Latest text not sent yet.
+		self._text = None
+		self._closed = False
+		self._start = time.monotonic()
+		self._sent_at = None
+
+
+	def _get_ready_text(self):
+		"""
+		Take the pending text if the budget allows sending it.
+
+		Returns:
+			(text, wait):	The text, or None along with the seconds to
+							wait for, None meaning until updated.
+		"""
+		if self._text is None:
+			return None, None
+
+		wait = self.bucket.get_wait_time()
+		if self.min_interval and self._sent_at is not None:
+			wait = max(wait, self._sent_at + self.min_interval() - time.monotonic())
+		if wait > 0 or not self.bucket.try_acquire():
+			return None, wait
+
+		text, self._text = self._text, None
+		return text, 0
+
+
+	def _on_sent(self):
+		self._sent_at = time.monotonic()
+		self.draft_count += 1
+		if self.draft_count == 1:
+			metrics.observe('drafts.first_draft_s', self._sent_at - self._start)
+
+
+	def _on_error(self, exc, text):
+		"""Handle an error sending a draft, return False if no more
+		drafts must be sent."""
+		retry_after = get_retry_after(exc)
+		if retry_after is None:
+			# Drafts are a preview, the reply is sent anyway.
+			print(f'ERROR - Draft could not be sent, no more drafts will be sent: {exc}')
+			return False
+
+		# Telegram's budget is stricter than expected, wait for it.
+		self.bucket.penalize(retry_after)
+		metrics.inc('drafts.rate_limited')
+		if self.max_retry_after is not None and retry_after > self.max_retry_after:
+			metrics.inc('drafts.stopped')
+			return False
+
+		# Send it later unless there's a newer text.
+		if self._text is None:
+			self._text = text
+		return True
+
+
+	def _on_closed(self):
+		metrics.observe('drafts.per_reply', self.draft_count)
+
+
+class DraftScheduler(BaseDraftScheduler):
+	"""Draft scheduler sending from a background thread, see
+	BaseDraftScheduler."""
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._cond = threading.Condition()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+
+	def update(self, text):
+		"""Set the text of the next draft, replacing the unsent one."""
+		with self._cond:
+			self._text = text
+			self._cond.notify()
+
+
+	def close(self):
+		"""Stop sending drafts, waiting for the one being sent."""
+		with self._cond:
+			self._closed = True
+			self._cond.notify()
+		self._thread.join()
+		self._on_closed()
+
+
+	def _run(self):
+		while True:
+			with self._cond:
+				while not self._closed:
+					text, wait = self._get_ready_text()
+					if text is not None:
+						break
+					self._cond.wait(wait)
+				else:
+					return
+
+			try:
+				self.send(text)
+			except Exception as e:
+				with self._cond:
+					if not self._on_error(e, text):
+						return
+			else:
+				self._on_sent()
+
+
+class AsyncDraftScheduler(BaseDraftScheduler):
+	"""Draft scheduler sending from an asyncio task, see
+	BaseDraftScheduler."""
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._event = asyncio.Event()
+		self._task = asyncio.create_task(self._run())
+
+
+	def update(self, text):
+		"""Set the text of the next draft, replacing the unsent one."""
+		self._text = text
+		self._event.set()
+
+
+	async def close(self):
+		"""Stop sending drafts, waiting for the one being sent."""
+		self._closed = True
+		self._event.set()
+		await self._task
+		self._on_closed()
+
+
+	async def _run(self):
+		while True:
+			while not self._closed:
+				text, wait = self._get_ready_text()
+				if text is not None:
+					break
+				self._event.clear()
+				try:
+					await asyncio.wait_for(self._event.wait(), wait)
+				except asyncio.TimeoutError:
+					pass
+			else:
+				return
+
+			try:
+				await self.send(text)
+			except Exception as e:
+				if not self._on_error(e, text):
+					return
+			else:
+				self._on_sent()
\ No newline at end of file
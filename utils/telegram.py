@@ -1,28 +1,60 @@
-from utils.messages import reply_error
+from tempfile import SpooledTemporaryFile
 
+from telebot import apihelper, asyncio_helper
 
+from constants.telegram import DOWNLOAD_CHUNK_BYTES, DOWNLOAD_SPOOL_MAX_BYTES
+from utils.messages import reply_error, areply_error
+from utils.metrics import metrics
 
-def get_telegram_file_bytes(bot, file_id):
-	"""Download a file stored in the Telegram servers and return its content."""
-	cloud_file = bot.get_file(file_id)
-	#url = f'https://api.telegram.org/file/bot{os.environ['TELEGRAM_API_KEY']}/{cloud_file.file_path}'
-	return bot.download_file(cloud_file.file_path)
 
 
-def parse_cmd_args(bot, msg, args_str, *parms_data):
+def get_telegram_file_url(token, file_path):
+	if apihelper.FILE_URL is None:
+		return f'https://api.telegram.org/file/bot{token}/{file_path}'
+	return apihelper.FILE_URL.format(token, file_path)
+
+
+def download_telegram_file(bot, file_id):
 	"""
-	Parse a command arguments string into separate arguments, return
-	the part of string that was not parsed and each parsed argument.
-	
+	Download a file stored in the Telegram servers in chunks and return
+	it as a temporary binary file, which is kept in memory unless large.
+	Raise ApiHTTPException if the download fails, or the exception of
+	requests if the server stops sending it for the read timeout.
+
 	Args:
-		bot:			Telegram bot.
-		msg:			Telegram message.
-		args_str:		Command arguments string.
-		parms_data:		A list of parameter data tuples, where each
-						tuple contains:
-						- Display name (str)
-						- Allowed choices (list)
-						- Type (type)
+		bot:			Telegram bot instance.
+		file_id:		Telegram file id.
+	"""
+
+	cloud_file = bot.get_file(file_id)
+	url = get_telegram_file_url(bot.token, cloud_file.file_path)
+	file = SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MAX_BYTES)
+	try:
+		with apihelper._get_req_session().get(
+			url,
+			proxies=apihelper.proxy,
+			stream=True,
+			# Streamed responses have no timeout otherwise.
+			timeout=(apihelper.CONNECT_TIMEOUT, apihelper.READ_TIMEOUT)
+		) as resp:
+			if resp.status_code != 200:
+				raise apihelper.ApiHTTPException('Download file', resp)
+			for chunk in resp.iter_content(DOWNLOAD_CHUNK_BYTES):
+				file.write(chunk)
+	except BaseException:
+		# It may be on disk already.
+		file.close()
+		raise
+
+	metrics.inc('media.download_bytes', file.tell())
+	file.seek(0)
+	return file
+
+
+def _parse_cmd_args(args_str, *parms_data):
+	"""
+	Parse a command arguments string. Return a tuple with the result
+	parse_cmd_args() must return, or None, and an error text, or None.
 	"""
 
 	args_str = args_str or ''
@@ -38,22 +70,81 @@ def parse_cmd_args(bot, msg, args_str, *parms_data):
 		parm_name, parm_items, parm_type = parms_data[i]
 
 		if parm_items and (arg not in parm_items):
-			reply_error(bot, msg, f"{parm_name} must be one of these: [{', '.join(parm_items)}].")
-			return
+			return None, f"{parm_name} must be one of these: [{', '.join(parm_items)}]."
 		
 		if parm_type:
 			try:
 				arg = parm_type(arg)
 			except ValueError:
-				reply_error(bot, msg, f"{parm_name} must be of type '{parm_type.__name__}'.")
-				return
+				return None, f"{parm_name} must be of type '{parm_type.__name__}'."
 			
 		parsed_args.append(arg)
 
 	if len(split_args) < len(parms_data):
 		# Get the missing arg data.
 		parm_name, _, _ = parms_data[len(split_args)]
-		reply_error(bot, msg, f'You must specify the {parm_name}.')
-		return
+		return None, f'You must specify the {parm_name}.'
+
+	return (' '.join(split_args[len(parsed_args):]), *parsed_args), None
+
+
+def parse_cmd_args(bot, msg, args_str, *parms_data):
+	"""
+	Parse a command arguments string into separate arguments, return
+	the part of string that was not parsed and each parsed argument.
+	
+	Args:
+		bot:			Telegram bot.
+		msg:			Telegram message.
+		args_str:		Command arguments string.
+		parms_data:		A list of parameter data tuples, where each
+						tuple contains:
+						- Display name (str)
+						- Allowed choices (list)
+						- Type (type)
+	"""
+
+	parsed_args, err_text = _parse_cmd_args(args_str, *parms_data)
+	if err_text:
+		reply_error(bot, msg, err_text)
+	return parsed_args
+
+
+# Async counterparts for the asyncio runtime.
+
+
+async def adownload_telegram_file(bot, file_id):
+	"""Async counterpart of download_telegram_file()."""
+	# Only the asyncio runtime depends on aiohttp.
+	import aiohttp
+
+	cloud_file = await bot.get_file(file_id)
+	url = get_telegram_file_url(bot.token, cloud_file.file_path)
+	file = SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MAX_BYTES)
+	session = await asyncio_helper.session_manager.get_session()
+	try:
+		async with session.get(
+			url,
+			proxy=asyncio_helper.proxy,
+			# Large files take long, only the reads are timed out.
+			timeout=aiohttp.ClientTimeout(total=None, sock_read=asyncio_helper.REQUEST_TIMEOUT)
+		) as resp:
+			if resp.status != 200:
+				raise asyncio_helper.ApiHTTPException('Download file', resp)
+			async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_BYTES):
+				file.write(chunk)
+	except BaseException:
+		file.close()
+		raise
+
+	metrics.inc('media.download_bytes', file.tell())
+	file.seek(0)
+	return file
+
 
-	return ' '.join(split_args[len(parsed_args):]), *parsed_args
\ No newline at end of file
+async def aparse_cmd_args(bot, msg, args_str, *parms_data):
+	"""Async counterpart of parse_cmd_args()."""
+	parsed_args, err_text = _parse_cmd_args(args_str, *parms_data)
+	if err_text:
+		await areply_error(bot, msg, err_text)
+	return parsed_args
\ No newline at end of file
@@ -0,0 +1,174 @@
+import hmac
+import json
+import asyncio
+import threading
+import traceback
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from telebot.types import Update
+
+from utils.metrics import metrics
+
+
+
+# Header Telegram sends the secret token set with setWebhook in.
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class UpdateDeduplicator:
+	"""
+	Bounded, thread-safe record of recently seen update ids.
+	Telegram retries an update if the webhook doesn't acknowledge it in
+	time, retried updates must be dropped or they would trigger a second
+	AI call.
+
+	Args:
+		max_size:		Number of update ids to remember.
+	"""
+
+	def __init__(self, max_size=10000):
+		self.max_size = max_size
+		self._lock = threading.Lock()
+		self._seen = OrderedDict()
+
+
+	def seen(self, update_id):
+		"""Record an update id and return True if it was already
+		recorded."""
+		with self._lock:
+			if update_id in self._seen:
+				self._seen.move_to_end(update_id)
+				return True
+
+			self._seen[update_id] = None
+			if len(self._seen) > self.max_size:
+				self._seen.popitem(last=False)
+			return False
+
+
+def is_valid_secret_token(token, secret_token):
+	return hmac.compare_digest((token or '').encode(), secret_token.encode())
+
+
+def parse_update_json(body, dedup):
+	"""Parse a webhook request body, return None if the update was
+	already seen."""
+	update_json = json.loads(body)
+	if dedup.seen(update_json['update_id']):
+		metrics.inc('webhook.duplicates')
+		return None
+
+	metrics.inc('webhook.updates')
+	return update_json
+
+
+def parse_update(body, dedup):
+	"""Parse a webhook request body into an update, return None if the
+	update was already seen."""
+	if update_json := parse_update_json(body, dedup):
+		return Update.de_json(update_json)
+
+
+def run_webhook_server(bot, host, port, path, secret_token, dedup, router=None):
+	"""
+	Serve the Telegram webhook and feed the updates to a bot, forever.
+
+	NOTE: Requests are served one at a time to keep the order in which
+			updates are received, handling them only takes queueing them
+			into the dispatcher.
+
+	Args:
+		bot:			Telegram bot instance.
+		host:			Address to listen on.
+		port:			Port to listen on.
+		path:			URL path of the webhook.
+		secret_token:	Token Telegram must send with every request.
+		dedup:			Update deduplicator.
+		router:			Callable taking the updates' JSON instead of the
+						bot, e.g. to route them to other processes.
+	"""
+
+	class WebhookHandler(BaseHTTPRequestHandler):
+
+		def do_POST(self):
+			if self.path != path:
+				return self._respond(404)
+
+			if not is_valid_secret_token(self.headers.get(SECRET_TOKEN_HEADER), secret_token):
+				metrics.inc('webhook.unauthorized')
+				return self._respond(403)
+
+			try:
+				body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+				update_json = parse_update_json(body, dedup)
+			except (ValueError, KeyError):
+				return self._respond(400)
+
+			if update_json:
+				try:
+					if router:
+						router(update_json)
+					else:
+						bot.process_new_updates([Update.de_json(update_json)])
+				except Exception:
+					# Telegram would retry the update, which the
+					# deduplicator would drop anyway.
+					traceback.print_exc()
+
+			self._respond(200)
+
+
+		def _respond(self, code):
+			self.send_response(code)
+			self.send_header('Content-Length', '0')
+			self.end_headers()
+
+
+		def log_message(self, format, *args):
+			# Don't log every request.
+			pass
+
+
+	server = HTTPServer((host, port), WebhookHandler)
+	print(f'Webhook listening on {host}:{port}{path}')
+	server.serve_forever()
+
+
+async def arun_webhook_server(bot, host, port, path, secret_token, dedup):
+	"""Async counterpart of run_webhook_server()."""
+
+	# Only the asyncio runtime depends on aiohttp.
+	from aiohttp import web
+
+	async def handle(request):
+		if not is_valid_secret_token(request.headers.get(SECRET_TOKEN_HEADER), secret_token):
+			metrics.inc('webhook.unauthorized')
+			return web.Response(status=403)
+
+		try:
+			update = parse_update(await request.read(), dedup)
+		except (ValueError, KeyError):
+			return web.Response(status=400)
+
+		if update:
+			try:
+				await bot.process_new_updates([update])
+			except Exception:
+				traceback.print_exc()
+
+		return web.Response()
+
+	app = web.Application()
+	app.router.add_post(path, handle)
+
+	runner = web.AppRunner(app, access_log=None)
+	await runner.setup()
+	await web.TCPSite(runner, host, port).start()
+	print(f'Webhook listening on {host}:{port}{path}')
+
+	try:
+		# Serve until cancelled.
+		await asyncio.Event().wait()
+	finally:
+		await runner.cleanup()
\ No newline at end of file